@@ -0,0 +1,61 @@
+"""
+Measures the throughput of `format_json` and `format_json_fast` on synthetic responses.
+
+Run it from the root of the repository:
+
+    python -m benchmarks.format_benchmark --rows 2000
+"""
+import argparse
+import json
+import time
+from utils.fake_utils import build_synthetic_response
+from utils.format_utils import format_json
+from utils.fast_format_utils import format_json_fast
+
+# Synthetic response shapes: (name, build_synthetic_response arguments)
+PROFILES = [
+    ("empty", dict(num_text=0, num_faces=0, num_labels=0, num_logos=0, num_objects=0, num_colors=0, num_web_entities=0)),
+    ("typical", dict(num_text=20, num_faces=1, num_labels=10, num_logos=1, num_objects=5, num_colors=10, num_web_entities=10)),
+    ("ocr_heavy", dict(num_text=1000, num_faces=0, num_labels=10, num_logos=0, num_objects=2, num_colors=10, num_web_entities=10)),
+    ("face_heavy", dict(num_text=5, num_faces=20, num_labels=10, num_logos=0, num_objects=20, num_colors=10, num_web_entities=10)),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000, help="Number of rows formatted per profile and formatter")
+    parser.add_argument("--distinct_responses", type=int, default=20, help="Number of distinct synthetic responses per profile")
+    return parser.parse_args()
+
+
+def measure(formatter, responses, rows):
+    """
+    Formats `rows` rows cycling over the responses and returns the rows per second.
+    """
+    start = time.perf_counter()
+    for count in range(rows):
+        formatter(responses[count % len(responses)], creative_id=count, creative_uri=f"gs://bucket/{count}.png")
+    return rows / (time.perf_counter() - start)
+
+
+def main():
+    args = parse_args()
+
+    print(f"{'profile':<12} {'row bytes':>10} {'format_json':>14} {'format_json_fast':>18} {'speedup':>8}")
+    for name, shape in PROFILES:
+        responses = [build_synthetic_response(seed=seed, **shape) for seed in range(args.distinct_responses)]
+
+        # The fast formatter must produce exactly the same rows
+        for response in responses:
+            expected = format_json(response, creative_id="id", creative_uri="uri")
+            if format_json_fast(response, creative_id="id", creative_uri="uri") != expected:
+                raise AssertionError(f"format_json_fast differs from format_json on profile '{name}'")
+
+        row_bytes = len(json.dumps(format_json(responses[0], creative_id="id", creative_uri="uri")))
+        reference = measure(format_json, responses, args.rows)
+        fast = measure(format_json_fast, responses, args.rows)
+        print(f"{name:<12} {row_bytes:>10} {reference:>10.0f} r/s {fast:>14.0f} r/s {fast / reference:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Measures the startup time of the entry points and checks it against a budget.
+
+Each entry point runs with `--help` in a fresh interpreter, which imports the script and parses
+its arguments, like a usage error or the cold start of the Cloud Function loading its module.
+The time over a bare interpreter must stay within `--budget_ms`, and none of the client
+libraries may be imported.
+
+The module of the event-driven processor is also imported cold, like a new Cloud Function
+instance loading its handler. It needs the Vision client, but must stay within
+`--streaming_budget_ms` without loading the libraries of the optional stages. Run it from the
+root of the repository:
+
+    python -m benchmarks.import_benchmark --budget_ms 150 --streaming_budget_ms 1000
+
+It exits with an error when an entry point is over budget. `tests/test_import_budget.py` runs
+the same checks with the default budgets under pytest.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Scripts measured, run from the root of the repository
+ENTRY_POINTS = ["gcs_to_bq_processing.py", "gcs_event_processing.py", "merge_shards.py", "reformat_archive.py"]
+
+# Libraries that must only be imported by the stage that uses them
+HEAVY_MODULES = ["google.cloud.vision", "google.cloud.storage", "google.cloud.bigquery", "google.oauth2.service_account", "grpc", "pyarrow", "PIL"]
+
+# Default budgets over a bare interpreter, in milliseconds, also asserted by tests/test_import_budget.py
+BUDGET_MS = 150
+STREAMING_BUDGET_MS = 1000
+
+# Module imported by a new instance of the event-driven processor
+STREAMING_MODULE = "utils.streaming_utils"
+
+# Libraries of the optional stages (downscaling, deduplication, cache, columnar output) and of
+# the clients the event-driven processor does not use
+STREAMING_EXCLUDED_MODULES = ["google.cloud.storage", "google.cloud.bigquery", "pyarrow", "PIL", "sqlite3"]
+
+# Runs a script with `--help` and reports the heavy modules it imported
+CHILD = """
+import json, runpy, sys
+sys.argv = [{script!r}, "--help"]
+try:
+    runpy.run_path({script!r}, run_name="__main__")
+except SystemExit:
+    pass
+print(json.dumps([name for name in {heavy!r} if name in sys.modules]), file=sys.stderr)
+"""
+
+# Imports a module and reports the heavy modules it imported
+CHILD_IMPORT = """
+import importlib, json, sys
+importlib.import_module({module!r})
+print(json.dumps([name for name in {heavy!r} if name in sys.modules]), file=sys.stderr)
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each entry point, the median is reported")
+    parser.add_argument("--budget_ms", type=float, default=BUDGET_MS, help="Maximum startup time of an entry point over a bare interpreter, in milliseconds")
+    parser.add_argument("--streaming_budget_ms", type=float, default=STREAMING_BUDGET_MS, help="Maximum time to import the event-driven processor over a bare interpreter, in milliseconds")
+    return parser.parse_args()
+
+
+def measure(code, repeat):
+    """
+    Runs `code` in `repeat` fresh interpreters and returns the median wall time in seconds and
+    what the last run wrote to stderr.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result.stderr
+
+
+def main():
+    args = parse_args()
+
+    interpreter, _ = measure("pass", args.repeat)
+    print(f"Bare interpreter: {interpreter * 1000:.0f} ms")
+    print(f"{'entry point':<26} {'--help':>8} {'overhead':>9}  heavy modules")
+
+    failures = []
+    for script in ENTRY_POINTS:
+        elapsed, stderr = measure(CHILD.format(script=script, heavy=HEAVY_MODULES), args.repeat)
+        heavy = json.loads(stderr.strip().splitlines()[-1])
+        overhead = (elapsed - interpreter) * 1000
+        print(f"{script:<26} {elapsed * 1000:>5.0f} ms {overhead:>6.0f} ms  {', '.join(heavy) or '-'}")
+
+        if overhead > args.budget_ms:
+            failures.append(f"{script} starts in {overhead:.0f} ms over the interpreter, the budget is {args.budget_ms:.0f} ms")
+        if heavy:
+            failures.append(f"{script} imports {', '.join(heavy)} before parsing its arguments")
+
+    elapsed, stderr = measure(CHILD_IMPORT.format(module=STREAMING_MODULE, heavy=STREAMING_EXCLUDED_MODULES), args.repeat)
+    heavy = json.loads(stderr.strip().splitlines()[-1])
+    overhead = (elapsed - interpreter) * 1000
+    print(f"{STREAMING_MODULE:<26} {elapsed * 1000:>5.0f} ms {overhead:>6.0f} ms  {', '.join(heavy) or '-'}")
+
+    if overhead > args.streaming_budget_ms:
+        failures.append(f"{STREAMING_MODULE} imports in {overhead:.0f} ms over the interpreter, the budget is {args.streaming_budget_ms:.0f} ms")
+    if heavy:
+        failures.append(f"{STREAMING_MODULE} imports {', '.join(heavy)} without using them")
+
+    if failures:
+        raise AssertionError("Startup budget exceeded: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
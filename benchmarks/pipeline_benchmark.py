@@ -0,0 +1,158 @@
+"""
+Measures the end-to-end throughput of `process_images` against in-process fakes of GCS, the
+Vision API and BigQuery, so it runs without a GCP project.
+
+Each bucket size runs in a fresh process, which reports its images per second, its peak RSS
+and the time spent in each stage of the pipeline. Run it from the root of the repository:
+
+    python -m benchmarks.pipeline_benchmark --bucket_sizes 1000,10000 --latency 0.2 --concurrency 8
+
+Save the results with `--output` before and after a change to compare them.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from benchmarks.format_benchmark import PROFILES
+
+# Stages reported in the table, see `metrics_utils.MetricsRegistry.timer`
+STAGES = ["listing", "vision_call", "format", "serialize", "sink_write", "bq_load"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bucket_sizes", default="1000,5000", help="Comma-separated numbers of images in the fake bucket")
+    parser.add_argument("--payload", choices=[name for name, _ in PROFILES], default="typical", help="Shape of the synthetic responses")
+    parser.add_argument("--distinct_responses", type=int, default=64, help="Number of distinct synthetic responses handed out by the fake Vision API")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds each Vision API call takes")
+    parser.add_argument("--latency_jitter", type=float, default=0.05, help="Random extra seconds added to each Vision API call, up to this value")
+    parser.add_argument("--error_rate", type=float, default=0.01, help="Fraction of the images failing with INVALID_ARGUMENT")
+    parser.add_argument("--transient_error_rate", type=float, default=0.0, help="Probability that an image fails with UNAVAILABLE and is retried")
+    parser.add_argument("--page_latency", type=float, default=0.02, help="Seconds each page of the bucket listing takes")
+    parser.add_argument("--load_latency", type=float, default=0.5, help="Seconds each BigQuery load job takes")
+    parser.add_argument("--batch_size", type=int, default=16, help="Number of images sent in each Vision API call")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of Vision API calls in flight")
+    parser.add_argument("--format_workers", type=int, default=0, help="Number of processes formatting the rows")
+    parser.add_argument("--features", default="full", help="Feature profile or comma-separated Vision feature types")
+    parser.add_argument("--sink", choices=["file", "bigquery"], default="file", help="Sink of the rows")
+    parser.add_argument("--output_format", choices=["ndjson", "parquet"], default="ndjson", help="Format of the files written by the file sink")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency jitter and transient errors")
+    parser.add_argument("--output", help="JSON file receiving the configuration and the results")
+    return parser.parse_args()
+
+
+def run_once(bucket_size, options):
+    """
+    Runs `process_images` over a fake bucket of `bucket_size` images in the current process.
+
+    Returns:
+        dict: Images per second, elapsed seconds, peak RSS, counters and time per stage.
+    """
+    from utils.fake_utils import FakeBigQueryClient, FakeClientRegistry, FakeImageAnnotatorClient, FakeStorageClient
+    from utils.metrics_utils import get_metrics
+    from utils.vision_utils import process_images
+
+    storage_client = FakeStorageClient(page_latency=options["page_latency"])
+    for index in range(bucket_size):
+        storage_client.add_blob("benchmark-bucket", f"creatives/{index % 100:03d}/creative-{index:07d}.png", b"\x89PNG", "image/png")
+
+    vision_client = FakeImageAnnotatorClient(
+        storage_client,
+        response_kwargs=dict(PROFILES)[options["payload"]],
+        latency=options["latency"],
+        latency_jitter=options["latency_jitter"],
+        error_rate=options["error_rate"],
+        transient_error_rate=options["transient_error_rate"],
+        distinct_responses=options["distinct_responses"],
+        seed=options["seed"]
+    )
+    registry = FakeClientRegistry(storage_client, vision_client, FakeBigQueryClient(load_latency=options["load_latency"], keep_rows=False))
+
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        process_images(
+            "benchmark-bucket",
+            os.path.join(directory, "output"),
+            None,
+            None,
+            "WRITE_TRUNCATE",
+            batch_size=options["batch_size"],
+            concurrency=options["concurrency"],
+            sink_type=options["sink"],
+            output_format=options["output_format"],
+            features=options["features"],
+            format_workers=options["format_workers"],
+            registry=registry
+        )
+
+    report = get_metrics().report()
+    counters = report["counters"]
+    return {
+        "bucket_size": bucket_size,
+        "images_per_second": report["images_per_second"],
+        "elapsed_seconds": report["elapsed_seconds"],
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "rows": counters.get("rows_emitted", {}).get("total", 0),
+        "bytes": counters.get("bytes_emitted", {}).get("total", 0),
+        "vision_calls": counters.get("vision_calls", {}).get("total", 0),
+        "errors": sum(counters.get("vision_errors", {}).values()),
+        "retries": counters.get("vision_retries", {}).get("total", 0),
+        "stage_seconds": {stage: counters.get("stage_seconds", {}).get(f'{{stage="{stage}"}}', 0.0) for stage in STAGES},
+    }
+
+
+def _run_in_child(connection, bucket_size, options):
+    try:
+        connection.send(run_once(bucket_size, options))
+    except BaseException as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+def main():
+    args = parse_args()
+    options = {key: value for key, value in vars(args).items() if key not in ("bucket_sizes", "output")}
+    bucket_sizes = [int(size) for size in args.bucket_sizes.split(",")]
+
+    print(f"{'images':>8} {'images/s':>9} {'elapsed':>8} {'peak RSS':>9} {'errors':>7} {'retries':>8}  " + " ".join(f"{stage:>11}" for stage in STAGES))
+
+    # A fresh process per size, so the peak RSS of one run does not hide the next one
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for bucket_size in bucket_sizes:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_in_child, args=(sender, bucket_size, options))
+        process.start()
+        result = receiver.recv()
+        process.join()
+        if isinstance(result, BaseException):
+            raise result
+        results.append(result)
+        print(
+            f"{bucket_size:>8} {result['images_per_second']:>9.1f} {result['elapsed_seconds']:>7.1f}s {result['peak_rss_mib']:>6.0f} MiB "
+            f"{result['errors']:>7.0f} {result['retries']:>8.0f}  " + " ".join(f"{result['stage_seconds'][stage]:>10.2f}s" for stage in STAGES)
+        )
+
+    print("Stage times add up the time of every thread, so they can exceed the elapsed time.")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "options": options,
+                "results": results,
+            }, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.client_utils import get_default_registry
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher(registry=None) -> "MicroBatcher":
+    """
+    Returns the batcher shared by the events handled by this instance, built the first time
+    from the environment:
+
+    * `OUTPUT_DATASET_NAME` (required) and `OUTPUT_TABLE_NAME` (default `gcp_vision_api_annotations`).
+    * `FEATURES`: feature profile or comma-separated feature types (default `full`).
+    * `MAX_BATCH_SIZE` (default 64) and `MAX_WAIT_SECONDS` (default 2).
+    * `CONCURRENCY`: Vision API calls in flight for each batch (default 4).
+
+    Args:
+        registry (ClientRegistry): Registry of the clients. Defaults to the application default credentials.
+
+    Returns:
+        MicroBatcher: The batcher.
+    """
+    # Imported by the first event rather than when the instance loads the module
+    from utils.streaming_utils import GcsEventProcessor, MicroBatcher
+    from utils.vision_utils import parse_features
+
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            processor = GcsEventProcessor(
+                registry or get_default_registry(),
+                os.environ["OUTPUT_DATASET_NAME"],
+                os.environ.get("OUTPUT_TABLE_NAME", "gcp_vision_api_annotations"),
+                parse_features(os.environ.get("FEATURES", "full")),
+                concurrency=int(os.environ.get("CONCURRENCY", 4))
+            )
+            _batcher = MicroBatcher(
+                processor.process_batch,
+                max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 64)),
+                max_wait_seconds=float(os.environ.get("MAX_WAIT_SECONDS", 2.0))
+            )
+        return _batcher
+
+
+def handle_gcs_event(cloud_event):
+    """
+    Entry point of the Cloud Function triggered by `google.cloud.storage.object.v1.finalized`.
+
+    The event joins the current micro-batch, and the call returns once the batch has been
+    loaded into BigQuery. If the batch fails, or the image of the event keeps failing with a
+    transient error, the exception is raised, so the event is retried.
+
+    Args:
+        cloud_event (CloudEvent): The event, or its payload as a dict.
+    """
+    from utils.streaming_utils import GcsObjectEvent
+
+    get_batcher().submit(GcsObjectEvent.from_cloud_event(cloud_event)).result()
+
+
+def read_events(path):
+    """
+    Reads an NDJSON file of events, one object resource or CloudEvent with `data` per line.
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                yield event.get("data", event)
+
+
+def synthetic_events(bucket_name, count):
+    """
+    Generates finalize events of `count` images uploaded one every 100ms.
+    """
+    start = datetime.datetime.now(datetime.timezone.utc)
+    for index in range(count):
+        yield {
+            "bucket": bucket_name,
+            "name": f"synthetic/creative-{index:06d}.png",
+            "generation": str(index + 1),
+            "contentType": "image/png",
+            "size": "1024",
+            "updated": (start + datetime.timedelta(milliseconds=100 * index)).isoformat(),
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays GCS finalize events locally through the streaming processor")
+    parser.add_argument("--replay", help="NDJSON file of events, one object resource or CloudEvent per line")
+    parser.add_argument("--synthetic_events", type=int, help="Replay this many generated events instead of a file")
+    parser.add_argument("--bucket_name", default="synthetic-bucket", help="Bucket of the generated events")
+    parser.add_argument("--fake", action="store_true", help="Use in-memory Vision and BigQuery clients instead of GCP")
+    parser.add_argument("--project_id", help="Project ID")
+    parser.add_argument("--auth_file", help="Path to GCP authentication JSON file")
+    parser.add_argument("--output_dataset_name", default="vision_streaming", help="Output dataset name")
+    parser.add_argument("--output_table_name", default="gcp_vision_api_annotations", help="Output table name")
+    parser.add_argument("--features", default="full", help="Feature profile (full, creative, safety, text) or comma-separated Vision feature types")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="Number of events that triggers a batch")
+    parser.add_argument("--max_wait_seconds", type=float, default=2.0, help="Maximum time an event waits for its batch to fill up")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of Vision API calls in flight for each batch")
+    parser.add_argument("--speed", type=float, default=0, help="Replay speed relative to the `updated` times of the events. 0 replays them as fast as possible")
+    parser.add_argument("--handlers", type=int, default=64, help="Number of events handled at the same time, like concurrent function requests")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Imported once the arguments are parsed, so `--help` and usage errors do not load the client libraries
+    from utils.streaming_utils import GcsEventProcessor, GcsObjectEvent, MicroBatcher
+    from utils.vision_utils import parse_features
+
+    if args.fake:
+        from utils.fake_utils import FakeClientRegistry
+        registry = FakeClientRegistry()
+    else:
+        from utils.client_utils import ClientRegistry
+        registry = ClientRegistry(project_id=args.project_id, auth_file=args.auth_file)
+
+    events = read_events(args.replay) if args.replay else synthetic_events(args.bucket_name, args.synthetic_events or 0)
+
+    processor = GcsEventProcessor(registry, args.output_dataset_name, args.output_table_name, parse_features(args.features), concurrency=args.concurrency)
+    batcher = MicroBatcher(processor.process_batch, max_batch_size=args.max_batch_size, max_wait_seconds=args.max_wait_seconds)
+
+    start_time = time.perf_counter()
+    first_updated = None
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.handlers) as handlers:
+        for data in events:
+            event = GcsObjectEvent(data)
+
+            # Keep the pace of the original uploads
+            if args.speed > 0 and event.updated is not None:
+                first_updated = first_updated or event.updated
+                delay = (event.updated - first_updated).total_seconds() / args.speed - (time.perf_counter() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+
+            futures.append(handlers.submit(lambda event=event: batcher.submit(event).result()))
+
+    batcher.close()
+    failed = sum(1 for future in futures if future.exception() is not None)
+    elapsed = time.perf_counter() - start_time
+
+    print(f"Replayed {len(futures)} events in {batcher.batches} batches ({failed} failed) in {elapsed:.2f}s")
+    print(f"Loaded {processor.rows_written} rows into {args.output_table_name} table")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,190 @@
 import argparse
-from utils.vision_utils import process_images
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--project_id", help="Project ID")
     parser.add_argument("--input_bucket_name", help="Input bucket name")
+    parser.add_argument("--input_dir", help="Local directory of images to annotate instead of the input bucket. The files are sent as content without being uploaded")
     parser.add_argument("--output_dataset_name", help="Output dataset name")
     parser.add_argument("--auth_file", help="Path to GCP authentication JSON file")
-    parser.add_argument("--write_disposition", help="BigQuery write disposition. WRITE_TRUNCATE, WRITE_APPEND or WRITE_EMPTY.")
+    parser.add_argument("--write_disposition", help="BigQuery write disposition. WRITE_TRUNCATE, WRITE_APPEND or WRITE_EMPTY. Must be WRITE_APPEND with --sink bigquery and --checkpoint_path.")
+    parser.add_argument("--input_prefix", help="Only annotate the objects whose name starts with this prefix")
+    parser.add_argument("--input_glob", help="Only annotate the objects whose name matches this pattern, e.g. '*/banners/*.png'")
+    parser.add_argument("--content_types", default="image/", help="Comma-separated accepted content types, or prefixes ending with '/'. Use '*' to accept any")
+    parser.add_argument("--min_size", type=int, default=1, help="Minimum object size in bytes")
+    parser.add_argument("--max_size", type=int, help="Maximum object size in bytes")
+    parser.add_argument("--updated_after", help="Only annotate the objects updated after this ISO datetime, e.g. 2024-01-31T00:00:00Z")
+    parser.add_argument("--num_shards", type=int, default=1, help="Number of workers the bucket is split across by a hash of the object names")
+    parser.add_argument("--shard_index", type=int, default=0, help="Shard processed by this worker, from 0 to num_shards - 1")
+    parser.add_argument("--listing_workers", type=int, default=1, help="Number of prefix shards of the bucket listed in parallel")
+    parser.add_argument("--listing_shard_depth", type=int, default=1, help="Number of folder levels used to split the listing into prefix shards")
+    parser.add_argument("--batch_size", type=int, default=16, help="Number of images sent in each Vision API call (max 16)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Maximum number of Vision API calls in flight")
+    parser.add_argument("--ordered", action="store_true", help="Keep the output in the same order as the bucket listing")
+    parser.add_argument("--format_workers", type=int, default=0, help="Number of processes formatting and serializing the rows. 0 formats them in the main process")
+    parser.add_argument("--format_chunk_rows", type=int, default=256, help="Number of rows sent to a formatting process at once")
+    parser.add_argument("--pipeline_queue_size", type=int, help="Maximum number of row chunks between the annotation and the sink. Defaults to twice format_workers")
+    parser.add_argument("--metrics_path", help="JSON file receiving the run report with the per-stage timings, throughput, error and retry counts")
+    parser.add_argument("--openmetrics_path", help="File receiving the run metrics in the OpenMetrics text format")
+    parser.add_argument("--metrics_port", type=int, help="Serve the metrics in the OpenMetrics text format on this port while the run lasts")
+    parser.add_argument("--profile_functions", default="", help="Comma-separated cProfile hooks: vision_call, format, serialize, sink_write, bq_load")
+    parser.add_argument("--profile_dir", default="profiles", help="Directory receiving a .prof file per profiled hook")
+    parser.add_argument("--channel_pool_size", type=int, default=1, help="Number of gRPC channels shared by the Vision API calls")
+    parser.add_argument("--max_images_per_minute", type=float, help="Images sent to the Vision API per minute, usually the project quota. No rate limit if not set")
+    parser.add_argument("--max_attempts", type=int, default=5, help="Number of attempts of the images failing with a transient Vision API error")
+    parser.add_argument("--dead_letter_path", help="NDJSON file where the images that could not be annotated are appended")
+    parser.add_argument("--downscale_max_dimension", type=int, help="Downscale the images larger than this many pixels and send them as content. Requires Pillow")
+    parser.add_argument("--downscale_quality", type=int, default=85, help="JPEG quality of the downscaled images")
+    parser.add_argument("--dedup", choices=["phash", "dhash"], help="Annotate a single image per group of near-duplicates found with this perceptual hash. Requires Pillow")
+    parser.add_argument("--dedup_threshold", type=int, default=8, help="Maximum Hamming distance, out of 64 bits, between near-duplicate hashes")
+    parser.add_argument("--cache_backend", choices=["sqlite", "disk"], help="Annotation cache backend. The cache is disabled if not set")
+    parser.add_argument("--cache_path", default="vision_annotation_cache", help="SQLite database file or directory of the annotation cache")
+    parser.add_argument("--cache_max_entries", type=int, help="Maximum number of entries kept in the annotation cache")
+    parser.add_argument("--cache_max_bytes", type=int, help="Maximum total size in bytes of the annotation cache")
+    parser.add_argument("--cache_max_age_seconds", type=float, help="Maximum age in seconds of an annotation cache entry")
+    parser.add_argument("--checkpoint_path", help="Path to the checkpoint manifest. Enables incremental, resumable processing. A changed object gets a new row on top of the row of its previous version, so consumers must dedupe on creative_id, keeping the last row of the output files")
+    parser.add_argument("--checkpoint_interval", type=int, default=1000, help="Number of processed images between two checkpoints")
+    parser.add_argument("--output_max_rows", type=int, help="Maximum number of rows per output file")
+    parser.add_argument("--output_max_bytes", type=int, help="Maximum size in bytes of each output file")
+    parser.add_argument("--sink", choices=["file", "bigquery"], default="file", help="Write the rows to local NDJSON files or stream them into BigQuery")
+    parser.add_argument("--output_format", choices=["ndjson", "parquet"], default="ndjson", help="Format of the output files written by the file sink")
+    parser.add_argument("--features", default="full", help="Feature profile (full, creative, safety, text) or comma-separated Vision feature types, e.g. LABEL_DETECTION,LOGO_DETECTION")
+    parser.add_argument("--formatter", choices=["fast", "reference"], default="fast", help="Formatter of the Vision API responses. Both produce the same rows")
+    parser.add_argument("--output_layout", choices=["nested", "normalized"], default="nested", help="One nested row per creative, or a creatives table plus a child table per annotation type keyed by creative_id")
+    parser.add_argument("--ocr_mode", choices=["full", "full_text", "words", "words_packed"], default="full", help="Entries of the text annotations: every entry with its bounding box, the full text only, every entry without its bounding box, or every entry with its bounding box packed into eight integers")
+    parser.add_argument("--archive_dir", help="Directory of the raw response archive used by reformat_archive.py")
+    parser.add_argument("--mode", choices=["sync", "async_batch"], default="sync", help="Annotate with synchronous batch calls or with async batch operations writing to --async_output_uri")
+    parser.add_argument("--async_output_uri", help="GCS prefix receiving the output of the async batch operations, e.g. gs://BUCKET/vision_output/")
+    parser.add_argument("--async_shard_size", type=int, default=2000, help="Number of images per async batch operation (max 2000)")
+    parser.add_argument("--async_max_pending_operations", type=int, default=10, help="Maximum number of async batch operations running at the same time")
+    parser.add_argument("--async_poll_interval", type=float, default=10.0, help="Seconds between two polls of the async batch operations")
+    parser.add_argument("--bq_chunk_rows", type=int, default=5000, help="Number of rows per BigQuery load job")
+    parser.add_argument("--bq_max_pending_jobs", type=int, default=4, help="Maximum number of BigQuery load jobs running in parallel")
     return parser.parse_args()
 
 def main():
     args = parse_args()
 
+    # Imported once the arguments are parsed, so `--help` and usage errors do not load the client libraries
+    from utils.vision_utils import process_images
+
     project_id = args.project_id
     input_bucket_name = args.input_bucket_name
+    input_dir = args.input_dir
     output_dataset_name = args.output_dataset_name
     auth_file = args.auth_file
     write_disposition = args.write_disposition
+    input_prefix = args.input_prefix
+    input_glob = args.input_glob
+    content_types = None if args.content_types == "*" else [content_type.strip() for content_type in args.content_types.split(",") if content_type.strip()]
+    min_size = args.min_size
+    max_size = args.max_size
+    updated_after = args.updated_after
+    num_shards = args.num_shards
+    shard_index = args.shard_index
+    listing_workers = args.listing_workers
+    listing_shard_depth = args.listing_shard_depth
+    batch_size = args.batch_size
+    concurrency = args.concurrency
+    ordered = args.ordered
+    channel_pool_size = args.channel_pool_size
+    format_workers = args.format_workers
+    format_chunk_rows = args.format_chunk_rows
+    pipeline_queue_size = args.pipeline_queue_size
+    metrics_path = args.metrics_path
+    openmetrics_path = args.openmetrics_path
+    metrics_port = args.metrics_port
+    profile_functions = [name.strip() for name in args.profile_functions.split(",") if name.strip()]
+    profile_dir = args.profile_dir
+    max_images_per_minute = args.max_images_per_minute
+    max_attempts = args.max_attempts
+    dead_letter_path = args.dead_letter_path
+    downscale_max_dimension = args.downscale_max_dimension
+    downscale_quality = args.downscale_quality
+    dedup = args.dedup
+    dedup_threshold = args.dedup_threshold
+    cache_backend = args.cache_backend
+    cache_path = args.cache_path
+    cache_max_entries = args.cache_max_entries
+    cache_max_bytes = args.cache_max_bytes
+    cache_max_age_seconds = args.cache_max_age_seconds
+    checkpoint_path = args.checkpoint_path
+    checkpoint_interval = args.checkpoint_interval
+    output_max_rows = args.output_max_rows
+    output_max_bytes = args.output_max_bytes
+    sink_type = args.sink
+    output_format = args.output_format
+    bq_chunk_rows = args.bq_chunk_rows
+    features = args.features
+    formatter = args.formatter
+    output_layout = args.output_layout
+    ocr_mode = args.ocr_mode
+    archive_dir = args.archive_dir
+    bq_max_pending_jobs = args.bq_max_pending_jobs
+    mode = args.mode
+    async_output_uri = args.async_output_uri
+    async_shard_size = args.async_shard_size
+    async_max_pending_operations = args.async_max_pending_operations
+    async_poll_interval = args.async_poll_interval
 
     process_images(input_bucket_name, 
                    output_dataset_name, 
                    project_id, 
                    auth_file,
-                   write_disposition
+                   write_disposition,
+                   batch_size=batch_size,
+                   concurrency=concurrency,
+                   ordered=ordered,
+                   channel_pool_size=channel_pool_size,
+                   cache_backend=cache_backend,
+                   cache_path=cache_path,
+                   cache_max_entries=cache_max_entries,
+                   cache_max_bytes=cache_max_bytes,
+                   cache_max_age_seconds=cache_max_age_seconds,
+                   checkpoint_path=checkpoint_path,
+                   checkpoint_interval=checkpoint_interval,
+                   output_max_rows=output_max_rows,
+                   output_max_bytes=output_max_bytes,
+                   sink_type=sink_type,
+                   output_format=output_format,
+                   bq_chunk_rows=bq_chunk_rows,
+                   bq_max_pending_jobs=bq_max_pending_jobs,
+                   features=features,
+                   formatter=formatter,
+                   output_layout=output_layout,
+                   ocr_mode=ocr_mode,
+                   archive_dir=archive_dir,
+                   mode=mode,
+                   async_output_uri=async_output_uri,
+                   async_shard_size=async_shard_size,
+                   async_max_pending_operations=async_max_pending_operations,
+                   async_poll_interval=async_poll_interval,
+                   input_dir=input_dir,
+                   input_prefix=input_prefix,
+                   input_glob=input_glob,
+                   content_types=content_types,
+                   min_size=min_size,
+                   max_size=max_size,
+                   updated_after=updated_after,
+                   listing_workers=listing_workers,
+                   listing_shard_depth=listing_shard_depth,
+                   max_images_per_minute=max_images_per_minute,
+                   max_attempts=max_attempts,
+                   dead_letter_path=dead_letter_path,
+                   downscale_max_dimension=downscale_max_dimension,
+                   downscale_quality=downscale_quality,
+                   dedup=dedup,
+                   dedup_threshold=dedup_threshold,
+                   num_shards=num_shards,
+                   shard_index=shard_index,
+                   format_workers=format_workers,
+                   format_chunk_rows=format_chunk_rows,
+                   pipeline_queue_size=pipeline_queue_size,
+                   metrics_path=metrics_path,
+                   openmetrics_path=openmetrics_path,
+                   metrics_port=metrics_port,
+                   profile_functions=profile_functions,
+                   profile_dir=profile_dir
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+import argparse
+from utils.client_utils import ClientRegistry
+from utils.gcp_utils import load_files_to_bq
+from utils.schema_utils import to_bigquery_schema
+from utils.shard_utils import find_shard_parts, merge_shard_parts, shard_schema
+from utils.sink_utils import NdjsonSink, ParquetSink
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project_id", help="Project ID")
+    parser.add_argument("--auth_file", help="Path to GCP authentication JSON file")
+    parser.add_argument("--output_dataset_name", help="Output dataset name, also the output prefix given to every shard")
+    parser.add_argument("--num_shards", type=int, help="Number of shards of the run")
+    parser.add_argument("--output_format", choices=["ndjson", "parquet"], default="ndjson", help="Format of the shard output files")
+    parser.add_argument("--write_disposition", default="WRITE_TRUNCATE", help="BigQuery write disposition. WRITE_TRUNCATE, WRITE_APPEND or WRITE_EMPTY.")
+    parser.add_argument("--skip_load", action="store_true", help="Only write the merged file, without loading it into BigQuery")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    output_dataset_name = args.output_dataset_name
+    num_shards = args.num_shards
+    extension = f".{args.output_format}"
+
+    # Fail before loading anything if a shard is missing or did not finish
+    paths = find_shard_parts(output_dataset_name, num_shards, extension)
+    schema = shard_schema(output_dataset_name, num_shards)
+    print(f"Merging {len(paths)} files of {num_shards} shards")
+
+    merged_prefix = f"{output_dataset_name}-merged"
+    if args.output_format == "parquet":
+        sink = ParquetSink(merged_prefix, schema)
+    else:
+        sink = NdjsonSink(merged_prefix)
+    with sink:
+        duplicates = merge_shard_parts(paths, sink)
+    print(f"Wrote {sink.rows_written} rows to {', '.join(sink.paths)} ({duplicates} duplicates dropped)")
+
+    if args.skip_load or not sink.paths:
+        return
+
+    # A single load job, so the table never holds part of the shards
+    registry = ClientRegistry(project_id=args.project_id, auth_file=args.auth_file)
+    load_files_to_bq(registry.bigquery_client(), output_dataset_name, "gcp_vision_api_annotations", sink.paths, args.write_disposition, schema=to_bigquery_schema(schema))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive_dir", help="Directory of the raw response archive written with --archive_dir")
+    parser.add_argument("--output_prefix", help="Prefix of the output files")
+    parser.add_argument("--features", default="full", help="Feature profile (full, creative, safety, text) or comma-separated Vision feature types whose columns are formatted")
+    parser.add_argument("--output_format", choices=["ndjson", "parquet"], default="ndjson", help="Format of the output files")
+    parser.add_argument("--output_max_rows", type=int, help="Maximum number of rows per output file")
+    parser.add_argument("--ocr_mode", choices=["full", "full_text", "words", "words_packed"], default="full", help="Entries of the text annotations: every entry with its bounding box, the full text only, every entry without its bounding box, or every entry with its bounding box packed into eight integers")
+    parser.add_argument("--workers", type=int, help="Number of worker processes. Defaults to the number of CPUs")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    # Imported once the arguments are parsed, so `--help` and usage errors do not load the client libraries
+    from utils.archive_utils import reformat_archive
+    from utils.vision_utils import parse_features
+
+    reformat_archive(args.archive_dir,
+                     args.output_prefix,
+                     features=parse_features(args.features),
+                     output_format=args.output_format,
+                     output_max_rows=args.output_max_rows,
+                     workers=args.workers,
+                     ocr_mode=args.ocr_mode
+    )
+
+if __name__ == "__main__":
+    main()
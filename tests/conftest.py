@@ -0,0 +1,66 @@
+import contextlib
+import glob
+import io
+
+import pytest
+
+from utils.fake_utils import FakeBigQueryClient, FakeClientRegistry, FakeImageAnnotatorClient, FakeStorageClient
+from utils.shard_utils import iter_part_rows
+from utils.vision_utils import process_images
+
+# Bucket of the images listed by the pipelines
+BUCKET = "creatives"
+
+# Number of images in the bucket
+NUM_IMAGES = 40
+
+# Leading bytes of a PNG, so the images are typed like the uploads of a DSP
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@pytest.fixture
+def storage_client():
+    client = FakeStorageClient()
+    for index in range(NUM_IMAGES):
+        client.add_blob(BUCKET, f"ads/{index}.png", PNG_SIGNATURE + bytes([index]) * 16, "image/png")
+    return client
+
+
+@pytest.fixture
+def vision_client(storage_client):
+    return FakeImageAnnotatorClient(storage_client, distinct_responses=4)
+
+
+@pytest.fixture
+def bigquery_client():
+    return FakeBigQueryClient()
+
+
+@pytest.fixture
+def run_pipeline(tmp_path, monkeypatch, storage_client, vision_client, bigquery_client):
+    """
+    Returns a function running `process_images` on the bucket in `tmp_path`, which returns
+    what the run printed.
+    """
+    monkeypatch.chdir(tmp_path)
+
+    def run(output_dataset_name="out", write_disposition="WRITE_TRUNCATE", **kwargs):
+        registry = FakeClientRegistry(storage_client, kwargs.pop("vision_client", vision_client), bigquery_client)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            process_images(BUCKET, output_dataset_name, None, None, write_disposition, registry=registry, **kwargs)
+        return output.getvalue()
+
+    return run
+
+
+@pytest.fixture
+def read_rows(tmp_path):
+    """
+    Returns a function reading the rows of every output file of a prefix, in order.
+    """
+
+    def read(path_prefix="out", extension=""):
+        paths = sorted(glob.glob(str(tmp_path / f"{path_prefix}-[0-9]*{extension}")))
+        return [row for path in paths for row in iter_part_rows(path)]
+
+    return read
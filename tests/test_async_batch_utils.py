@@ -0,0 +1,75 @@
+import json
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from tests.conftest import BUCKET, NUM_IMAGES
+from utils.async_batch_utils import INTERNAL, analyze_images_async
+from utils.fake_utils import FakeImageAnnotatorClient, FakeOperation
+
+IMAGE_URIS = [f"gs://{BUCKET}/ads/{index}.png" for index in range(NUM_IMAGES)]
+
+
+class PartialOutputClient(FakeImageAnnotatorClient):
+    """
+    Vision client whose operations write no `context.uri` for the images of `lost_uris`.
+    """
+
+    def __init__(self, storage_client, lost_uris):
+        super().__init__(storage_client)
+        self.lost_uris = set(lost_uris)
+
+    def _annotate(self, request):
+        response = super()._annotate(request)
+        if response.context.uri in self.lost_uris:
+            response.context.uri = ""
+        return response
+
+
+class FailingClient(FakeImageAnnotatorClient):
+    """
+    Vision client whose operations fail with `exception`.
+    """
+
+    def __init__(self, storage_client, exception):
+        super().__init__(storage_client)
+        self.exception = exception
+
+    def async_batch_annotate_images(self, requests, output_config, **kwargs):
+        return FakeOperation(exception=self.exception)
+
+
+def analyze(vision_client, storage_client):
+    return list(analyze_images_async(vision_client, storage_client, IMAGE_URIS, [], "gs://output/run/", shard_size=15, poll_interval=0))
+
+
+def test_every_image_is_yielded_once(storage_client, vision_client):
+    responses = analyze(vision_client, storage_client)
+
+    assert sorted(uri for uri, _ in responses) == sorted(IMAGE_URIS)
+    assert not any(response.error.code for _, response in responses)
+
+
+def test_images_missing_from_the_output_fail(storage_client):
+    lost_uris = set(IMAGE_URIS[3:5] + IMAGE_URIS[20:21])
+    responses = analyze(PartialOutputClient(storage_client, lost_uris), storage_client)
+
+    assert sorted(uri for uri, _ in responses) == sorted(IMAGE_URIS)
+    assert {uri for uri, response in responses if response.error.code == INTERNAL} == lost_uris
+
+
+@pytest.mark.parametrize("exception, code", [(api_exceptions.PermissionDenied("denied"), 7), (RuntimeError("lost"), INTERNAL)])
+def test_images_of_failed_operations_get_its_status_code(storage_client, exception, code):
+    responses = analyze(FailingClient(storage_client, exception), storage_client)
+
+    assert sorted(uri for uri, _ in responses) == sorted(IMAGE_URIS)
+    assert {response.error.code for _, response in responses} == {code}
+
+
+def test_pipeline_sends_the_missing_images_to_the_dead_letter(run_pipeline, read_rows, storage_client, tmp_path):
+    lost_uris = {IMAGE_URIS[3], IMAGE_URIS[30]}
+    run_pipeline(vision_client=PartialOutputClient(storage_client, lost_uris), mode="async_batch", async_output_uri="gs://output/async", async_poll_interval=0, dead_letter_path="dead_letter.ndjson")
+
+    with open(tmp_path / "dead_letter.ndjson") as file:
+        assert {json.loads(line)["creative_uri"] for line in file} == lost_uris
+    assert len(read_rows()) == NUM_IMAGES - len(lost_uris)
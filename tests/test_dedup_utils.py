@@ -0,0 +1,95 @@
+import io
+import json
+import random
+from collections import defaultdict
+
+import pytest
+from google.cloud import vision
+
+from utils.archive_utils import reformat_archive
+from utils.dedup_utils import NearDuplicateDeduper, hamming_distance, phash
+from utils.fake_utils import FakeClientRegistry, FakeImageAnnotatorClient, FakeStorageClient
+from utils.shard_utils import iter_part_rows
+from utils.vision_utils import process_images
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+
+# Sizes of each creative, like the formats of a DSP campaign
+SIZES = [(400, 400), (300, 300), (200, 200)]
+
+
+def creative(seed, width, height) -> bytes:
+    """
+    Draws the creative `seed` at a size, as a JPEG.
+    """
+    rng = random.Random(seed)
+    image = Image.new("RGB", (400, 400), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randint(0, 350), rng.randint(0, 350)
+        draw.rectangle([x, y, x + rng.randint(20, 120), y + rng.randint(20, 120)], fill=(rng.randint(0, 255),) * 3)
+    output = io.BytesIO()
+    image.resize((width, height)).save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+
+def test_sizes_of_a_creative_are_near_duplicates():
+    hashes = [phash(Image.open(io.BytesIO(creative(1, width, height)))) for width, height in SIZES]
+    other = phash(Image.open(io.BytesIO(creative(2, 400, 400))))
+
+    assert max(hamming_distance(hashes[0], value) for value in hashes[1:]) <= 8
+    assert hamming_distance(hashes[0], other) > 8
+
+
+def test_members_get_the_response_scaled_to_their_size():
+    deduper = NearDuplicateDeduper(None)
+    response = vision.AnnotateImageResponse(text_annotations=[{"description": "sale", "bounding_poly": {"vertices": [{"x": 100, "y": 50}]}}])
+
+    assert deduper.assign("representative", (0, (300, 250)))
+    assert not deduper.assign("waiting", (0, (600, 500)))
+    responses = dict(deduper.fan_out([("representative", response)]))
+    assert not deduper.assign("ready", (0, (150, 125)))
+    responses.update(deduper.fan_out([]))
+
+    vertices = {uri: responses[uri].text_annotations[0].bounding_poly.vertices[0] for uri in responses}
+    assert {uri: (vertex.x, vertex.y) for uri, vertex in vertices.items()} == {"representative": (100, 50), "waiting": (200, 100), "ready": (50, 25)}
+    assert response.text_annotations[0].bounding_poly.vertices[0].x == 100
+
+
+def test_evicted_clusters_are_annotated_again():
+    deduper = NearDuplicateDeduper(None, max_responses=1)
+    response = vision.AnnotateImageResponse()
+
+    assert deduper.assign("a1", (0, (10, 10)))
+    list(deduper.fan_out([("a1", response)]))
+    assert deduper.assign("b1", ((1 << 64) - 1, (10, 10)))
+    list(deduper.fan_out([("b1", response)]))
+
+    assert deduper.assign("a2", (0, (10, 10)))
+    assert not deduper.assign("a3", (0, (10, 10)))
+    assert [uri for uri, _ in deduper.fan_out([("a2", response)])] == ["a2", "a3"]
+    assert deduper.reannotated == 1
+
+
+def test_pipeline_annotates_one_image_per_cluster(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    storage_client = FakeStorageClient()
+    for seed in range(5):
+        for index, (width, height) in enumerate(SIZES):
+            storage_client.add_blob("creatives", f"c{seed}_{index}.jpg", creative(seed, width, height), "image/jpeg")
+    vision_client = FakeImageAnnotatorClient(storage_client)
+
+    process_images("creatives", "out", None, None, None, registry=FakeClientRegistry(storage_client, vision_client), dedup="phash", batch_size=4, archive_dir="archive")
+
+    with open(tmp_path / "out-00000.ndjson") as file:
+        rows = [json.loads(line) for line in file]
+    reformatted = [row for path in reformat_archive(str(tmp_path / "archive"), str(tmp_path / "re"), workers=1) for row in iter_part_rows(path)]
+    assert sorted(reformatted, key=json.dumps) == sorted(rows, key=json.dumps)
+
+    clusters = defaultdict(set)
+    for row in rows:
+        clusters[row["cluster_id"]].add(json.dumps(row["label_annotations"]))
+    assert len(rows) == 5 * len(SIZES)
+    assert vision_client.images == len(clusters) == 5
+    assert all(len(labels) == 1 for labels in clusters.values())
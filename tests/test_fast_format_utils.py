@@ -0,0 +1,16 @@
+import pytest
+
+from benchmarks.format_benchmark import PROFILES
+from utils.fake_utils import build_synthetic_response
+from utils.fast_format_utils import format_json_fast
+from utils.format_utils import OCR_MODES, format_json
+
+
+@pytest.mark.parametrize("ocr_mode", OCR_MODES)
+@pytest.mark.parametrize("name, shape", PROFILES)
+def test_fast_formatter_matches_the_reference(name, shape, ocr_mode):
+    for seed in range(5):
+        response = build_synthetic_response(seed=seed, **shape)
+
+        expected = format_json(response, creative_id="id", creative_uri="uri", ocr_mode=ocr_mode)
+        assert format_json_fast(response, creative_id="id", creative_uri="uri", ocr_mode=ocr_mode) == expected
@@ -0,0 +1,32 @@
+from utils.fake_utils import FakeBigQueryClient
+from utils.gcp_utils import build_load_job_config, load_files_to_bq
+from utils.schema_utils import annotation_schema, to_bigquery_schema
+from utils.sink_utils import ParquetSink
+from utils.vision_utils import parse_features
+
+
+def test_parquet_load_jobs_enable_list_inference():
+    job_config = build_load_job_config("WRITE_APPEND", source_format="PARQUET")
+
+    assert job_config.parquet_options.enable_list_inference is True
+    assert job_config.to_api_repr()["load"]["parquetOptions"] == {"enableListInference": True}
+
+
+def test_ndjson_load_jobs_have_no_parquet_options():
+    job_config = build_load_job_config("WRITE_APPEND")
+
+    assert "parquetOptions" not in job_config.to_api_repr()["load"]
+
+
+def test_load_files_to_bq_loads_parquet_lists(tmp_path):
+    features = parse_features("LABEL_DETECTION")
+    schema = annotation_schema(features)
+    row = {"creative_id": "gs://b/a.png", "creative_uri": "gs://b/a.png", "label_annotations": [{"description": "ad", "score": 0.9}]}
+    with ParquetSink(str(tmp_path / "out"), schema) as sink:
+        sink.write(row)
+
+    bq_client = FakeBigQueryClient()
+    load_files_to_bq(bq_client, "ds", "t", sink.paths, "WRITE_TRUNCATE", to_bigquery_schema(schema))
+
+    [loaded] = bq_client.tables[("ds", "t")]
+    assert loaded["label_annotations"][0]["description"] == "ad"
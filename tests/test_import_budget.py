@@ -0,0 +1,37 @@
+import json
+import os
+
+import pytest
+
+from benchmarks.import_benchmark import BUDGET_MS, CHILD, CHILD_IMPORT, ENTRY_POINTS, HEAVY_MODULES, STREAMING_BUDGET_MS, STREAMING_EXCLUDED_MODULES, STREAMING_MODULE, measure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs of each measure, the median is compared with the budget
+REPEAT = 3
+
+
+@pytest.fixture(scope="module")
+def interpreter():
+    return measure("pass", REPEAT)[0]
+
+
+def imported(stderr):
+    return json.loads(stderr.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("script", ENTRY_POINTS)
+def test_entry_point_startup(script, interpreter, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    elapsed, stderr = measure(CHILD.format(script=script, heavy=HEAVY_MODULES), REPEAT)
+
+    assert imported(stderr) == []
+    assert (elapsed - interpreter) * 1000 <= BUDGET_MS
+
+
+def test_streaming_import(interpreter, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    elapsed, stderr = measure(CHILD_IMPORT.format(module=STREAMING_MODULE, heavy=STREAMING_EXCLUDED_MODULES), REPEAT)
+
+    assert imported(stderr) == []
+    assert (elapsed - interpreter) * 1000 <= STREAMING_BUDGET_MS
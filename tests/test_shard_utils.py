@@ -0,0 +1,48 @@
+import pytest
+
+from tests.conftest import BUCKET, NUM_IMAGES
+from utils.fake_utils import FakeImageAnnotatorClient
+from utils.shard_utils import find_shard_parts, iter_part_rows, merge_shard_parts, shard_of
+from utils.sink_utils import NdjsonSink
+
+NUM_SHARDS = 3
+
+
+def test_shards_split_the_bucket(run_pipeline, read_rows, vision_client):
+    for shard_index in range(NUM_SHARDS):
+        run_pipeline(num_shards=NUM_SHARDS, shard_index=shard_index)
+
+    paths = find_shard_parts("out", NUM_SHARDS, ".ndjson")
+    creative_ids = [row["creative_id"] for path in paths for row in iter_part_rows(path)]
+    assert sorted(creative_ids) == sorted(f"gs://{BUCKET}/ads/{index}.png" for index in range(NUM_IMAGES))
+    assert vision_client.images == NUM_IMAGES
+
+
+def test_merge_keeps_the_last_row_of_each_creative(run_pipeline, read_rows, storage_client):
+    for shard_index in range(NUM_SHARDS):
+        run_pipeline(num_shards=NUM_SHARDS, shard_index=shard_index, checkpoint_path=f"manifest-{shard_index}")
+
+    # A changed creative is appended by the next incremental run of its shard, with other labels
+    vision_client = FakeImageAnnotatorClient(storage_client, response_kwargs={"num_labels": 3})
+    name = "ads/7.png"
+    storage_client.bucket(BUCKET).blob(name).upload_from_string(b"new content", content_type="image/png")
+    shard_index = shard_of(name, NUM_SHARDS)
+    run_pipeline(num_shards=NUM_SHARDS, shard_index=shard_index, checkpoint_path=f"manifest-{shard_index}", vision_client=vision_client)
+
+    paths = find_shard_parts("out", NUM_SHARDS, ".ndjson")
+    with NdjsonSink("merged") as sink:
+        duplicates = merge_shard_parts(paths, sink)
+
+    rows = read_rows("merged")
+    versions = [row for path in paths for row in iter_part_rows(path) if row["creative_id"] == f"gs://{BUCKET}/{name}"]
+    assert duplicates == 1
+    assert len(rows) == NUM_IMAGES
+    assert len(versions) == 2 and versions[0] != versions[1]
+    assert [row for row in rows if row["creative_id"] == f"gs://{BUCKET}/{name}"] == versions[-1:]
+
+
+def test_merge_refuses_unfinished_shards(run_pipeline):
+    run_pipeline(num_shards=NUM_SHARDS, shard_index=0)
+
+    with pytest.raises(ValueError, match="shard 1 has no marker"):
+        find_shard_parts("out", NUM_SHARDS, ".ndjson")
@@ -0,0 +1,32 @@
+import json
+
+from tests.conftest import PNG_SIGNATURE
+from utils.source_utils import InMemorySource
+from utils.vision_utils import MAX_IMAGE_BYTES
+
+
+def test_local_directory_images_are_sent_as_content(run_pipeline, read_rows, vision_client, tmp_path):
+    directory = tmp_path / "images"
+    (directory / "sub").mkdir(parents=True)
+    for index in range(6):
+        (directory / ("sub" if index % 2 else "") / f"{index}.png").write_bytes(PNG_SIGNATURE + bytes([index]) * 16)
+    (directory / ".DS_Store").write_bytes(b"x")
+    (directory / "notes.txt").write_bytes(b"x")
+
+    run_pipeline(input_dir=str(directory))
+
+    rows = read_rows()
+    assert len(rows) == vision_client.images == 6
+    assert all(row["creative_id"].startswith("file://") for row in rows)
+
+
+def test_oversized_images_go_to_the_dead_letter_without_a_call(run_pipeline, read_rows, vision_client, tmp_path):
+    images = {f"small{index}": PNG_SIGNATURE + bytes([index]) * 16 for index in range(3)}
+    images["huge"] = PNG_SIGNATURE + bytes(MAX_IMAGE_BYTES)
+
+    run_pipeline(source=InMemorySource(images), dead_letter_path="dead_letter.ndjson")
+
+    with open(tmp_path / "dead_letter.ndjson") as file:
+        dead_letters = [json.loads(line) for line in file]
+    assert [entry["creative_uri"] for entry in dead_letters] == ["memory://huge"]
+    assert len(read_rows()) == vision_client.images == 3
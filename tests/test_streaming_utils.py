@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from utils.fake_utils import FakeBigQueryClient, FakeClientRegistry, FakeImageAnnotatorClient
+from utils.listing_utils import BlobFilter
+from utils.streaming_utils import GcsEventProcessor, GcsObjectEvent, MicroBatcher
+from utils.vision_utils import parse_features
+
+
+def event(name, generation=1, content_type="image/png"):
+    return GcsObjectEvent({"bucket": "creatives", "name": name, "generation": str(generation), "contentType": content_type, "size": "10"})
+
+
+def test_full_batches_are_processed_right_away():
+    batches = []
+    with MicroBatcher(batches.append, max_batch_size=3, max_wait_seconds=60) as batcher:
+        futures = [batcher.submit(index) for index in range(7)]
+        assert batches == [[0, 1, 2], [3, 4, 5]]
+        assert all(future.done() for future in futures[:6])
+
+    assert batches[-1] == [6]
+    assert batcher.items == 7
+
+
+def test_expired_batches_are_processed_by_the_timer():
+    processed = threading.Event()
+    with MicroBatcher(lambda batch: processed.set(), max_batch_size=100, max_wait_seconds=0.05) as batcher:
+        future = batcher.submit("item")
+        assert processed.wait(5)
+        future.result(5)
+
+
+def test_a_failed_batch_fails_every_future():
+    def fail(batch):
+        raise RuntimeError("load failed")
+
+    with MicroBatcher(fail, max_batch_size=2) as batcher:
+        futures = [batcher.submit(index) for index in range(2)]
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match="load failed"):
+            future.result()
+
+
+def test_only_the_failed_items_fail_their_future():
+    with MicroBatcher(lambda batch: {item: ValueError(item) for item in batch if item % 2}, max_batch_size=4) as batcher:
+        futures = [batcher.submit(index) for index in range(4)]
+
+    assert [future.exception() is None for future in futures] == [True, False, True, False]
+
+
+def test_transient_failures_are_delivered_again():
+    bigquery_client = FakeBigQueryClient()
+    vision_client = FakeImageAnnotatorClient(transient_error_rate=0.3, error_uris={"gs://creatives/bad.png"}, seed=1)
+    processor = GcsEventProcessor(FakeClientRegistry(vision_client=vision_client, bigquery_client=bigquery_client), "ds", "t", parse_features("LABEL_DETECTION"))
+    processor.scheduler.max_attempts = 1
+
+    events = [event(f"{index}.png") for index in range(20)] + [event("bad.png")]
+    with MicroBatcher(processor.process_batch, max_batch_size=len(events)) as batcher:
+        futures = [batcher.submit(item) for item in events]
+
+    failed = [item.name for item, future in zip(events, futures) if future.exception() is not None]
+    loaded = [row["creative_id"] for row in bigquery_client.tables[("ds", "t")]]
+    # Permanent errors are acked, transient ones are retried by the platform
+    assert failed and "bad.png" not in failed
+    assert sorted(failed + [uri.rsplit("/", 1)[1] for uri in loaded]) == sorted(item.name for item in events[:-1])
+
+
+def test_only_the_latest_generation_is_annotated():
+    vision_client = FakeImageAnnotatorClient()
+    processor = GcsEventProcessor(FakeClientRegistry(vision_client=vision_client), "ds", "t", parse_features("LABEL_DETECTION"))
+
+    processor.process_batch([event("a.png", 1), event("a.png", 2), event("notes.txt", content_type="text/plain")])
+
+    assert vision_client.images == 1
+    assert processor.rows_written == 1
+
+
+def test_blob_filter_counts_are_exact_across_threads():
+    blob_filter = BlobFilter()
+    events = [event("a.png"), event(".hidden.png")]
+
+    def accept():
+        for _ in range(5000):
+            for item in events:
+                blob_filter.accepts(item)
+
+    threads = [threading.Thread(target=accept) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert blob_filter.accepted == 8 * 5000
+    assert blob_filter.rejected == {"hidden": 8 * 5000}
@@ -0,0 +1,195 @@
+import json
+
+import pytest
+
+from tests.conftest import BUCKET, NUM_IMAGES
+from utils import gcp_utils, sink_utils
+from utils.fake_utils import FakeImageAnnotatorClient
+from utils.shard_utils import iter_part_rows
+
+# Checkpoint interval of the incremental runs, and the write at which a run crashes
+CHECKPOINT_INTERVAL = 5
+CRASH_AT_WRITE = 23
+
+
+def creative_ids(rows):
+    return sorted(row["creative_id"] for row in rows)
+
+
+def crash_at(monkeypatch, cls, method, on_crash=None, at=CRASH_AT_WRITE):
+    """
+    Makes the `at`-th call to `cls.method` fail, after `on_crash` has left what a crash would
+    on disk.
+    """
+    original = getattr(cls, method)
+    calls = [0]
+
+    def write(self, row):
+        calls[0] += 1
+        if calls[0] == at:
+            if on_crash is not None:
+                on_crash(self, row)
+            raise RuntimeError("crash")
+        original(self, row)
+
+    monkeypatch.setattr(cls, method, write)
+    return lambda: monkeypatch.setattr(cls, method, original)
+
+
+@pytest.mark.parametrize("output_format", ["ndjson", "parquet"])
+def test_writes_a_row_per_image(run_pipeline, read_rows, vision_client, output_format):
+    run_pipeline(output_format=output_format, output_max_rows=15)
+
+    rows = read_rows()
+    assert len(rows) == NUM_IMAGES
+    assert creative_ids(rows) == sorted(f"gs://{BUCKET}/ads/{index}.png" for index in range(NUM_IMAGES))
+    assert vision_client.images == NUM_IMAGES
+
+
+@pytest.mark.parametrize("options", [dict(formatter="reference"), dict(format_workers=2), dict(concurrency=4, ordered=True)])
+def test_configurations_write_the_same_rows(run_pipeline, read_rows, options):
+    run_pipeline("expected")
+    run_pipeline(**options)
+
+    assert sorted(read_rows(), key=json.dumps) == sorted(read_rows("expected"), key=json.dumps)
+
+
+@pytest.mark.parametrize("batch_size", [0, -1])
+def test_batch_size_must_be_positive(run_pipeline, vision_client, batch_size):
+    with pytest.raises(ValueError, match="batch_size"):
+        run_pipeline(batch_size=batch_size)
+    assert vision_client.images == 0
+
+
+def test_normalized_layout_writes_a_table_per_annotation(run_pipeline, read_rows):
+    run_pipeline(output_layout="normalized")
+
+    creatives = read_rows("out-creatives")
+    labels = read_rows("out-labels")
+    assert len(creatives) == NUM_IMAGES
+    assert labels and {row["creative_id"] for row in labels} <= {row["creative_id"] for row in creatives}
+
+
+def test_bigquery_sink_loads_every_row(run_pipeline, bigquery_client):
+    run_pipeline(sink_type="bigquery", bq_chunk_rows=7)
+
+    rows = bigquery_client.tables[("out", "gcp_vision_api_annotations")]
+    assert len(rows) == NUM_IMAGES
+    assert bigquery_client.load_jobs[0]["write_disposition"] == "WRITE_TRUNCATE"
+    assert {job["write_disposition"] for job in bigquery_client.load_jobs[1:]} == {"WRITE_APPEND"}
+
+
+@pytest.mark.parametrize("cache_backend", ["sqlite", "disk"])
+def test_cache_reuses_the_responses_of_known_content(run_pipeline, storage_client, vision_client, cache_backend, tmp_path):
+    cache_path = str(tmp_path / "cache")
+    run_pipeline(cache_backend=cache_backend, cache_path=cache_path)
+    assert vision_client.images == NUM_IMAGES
+
+    # Copies of known creatives under new names are cache hits
+    storage_client.add_blob(BUCKET, "copies/0.png", storage_client.bucket(BUCKET).blob("ads/0.png").data, "image/png")
+    output = run_pipeline(cache_backend=cache_backend, cache_path=cache_path)
+
+    assert vision_client.images == NUM_IMAGES
+    assert f"Annotation cache: {NUM_IMAGES + 1} hits, 0 misses" in output
+
+
+def test_checkpoint_only_annotates_new_generations(run_pipeline, read_rows, storage_client, vision_client):
+    run_pipeline(checkpoint_path="manifest")
+    run_pipeline(checkpoint_path="manifest")
+    assert vision_client.images == NUM_IMAGES
+
+    storage_client.bucket(BUCKET).blob("ads/3.png").upload_from_string(b"new content", content_type="image/png")
+    run_pipeline(checkpoint_path="manifest")
+
+    assert vision_client.images == NUM_IMAGES + 1
+    assert len(read_rows()) == NUM_IMAGES + 1
+
+
+@pytest.mark.parametrize("output_format, crash", [
+    # A line cut in the middle
+    ("ndjson", lambda sink, line: (sink._file.write(line[:10]), sink._file.flush())),
+    # Row groups written after the last checkpoint
+    ("parquet", lambda sink, row: sink._write_row_group()),
+])
+def test_resumed_run_rolls_the_files_back_to_the_checkpoint(run_pipeline, read_rows, monkeypatch, output_format, crash):
+    cls, method = (sink_utils.NdjsonSink, "write_line") if output_format == "ndjson" else (sink_utils.ParquetSink, "write")
+    restore = crash_at(monkeypatch, cls, method, crash)
+    options = dict(output_format=output_format, checkpoint_path="manifest", checkpoint_interval=CHECKPOINT_INTERVAL, output_max_rows=8)
+    with pytest.raises(RuntimeError):
+        run_pipeline(**options)
+    restore()
+
+    run_pipeline(**options)
+
+    rows = read_rows()
+    assert len(rows) == NUM_IMAGES
+    assert len(set(creative_ids(rows))) == NUM_IMAGES
+
+
+def test_crash_before_the_first_checkpoint_is_rolled_back(run_pipeline, read_rows, monkeypatch, tmp_path):
+    # A flush cut before its sink_files record, on top of the rows written so far
+    def crash(sink, line):
+        sink._file.flush()
+        with open(tmp_path / "manifest", "a") as file:
+            file.write(json.dumps({"name": "ads/0.png", "generation": 1}) + "\n")
+
+    restore = crash_at(monkeypatch, sink_utils.NdjsonSink, "write_line", crash, at=CHECKPOINT_INTERVAL - 1)
+    options = dict(checkpoint_path="manifest", checkpoint_interval=CHECKPOINT_INTERVAL)
+    with pytest.raises(RuntimeError):
+        run_pipeline(**options)
+    restore()
+
+    run_pipeline(**options)
+
+    rows = read_rows()
+    assert len(rows) == NUM_IMAGES
+    assert len(set(creative_ids(rows))) == NUM_IMAGES
+
+
+def test_resumed_run_does_not_load_rows_twice_into_bigquery(run_pipeline, bigquery_client, monkeypatch):
+    restore = crash_at(monkeypatch, gcp_utils.BigQuerySink, "write_line")
+    options = dict(sink_type="bigquery", write_disposition="WRITE_APPEND", checkpoint_path="manifest", checkpoint_interval=CHECKPOINT_INTERVAL, bq_chunk_rows=3)
+    with pytest.raises(RuntimeError):
+        run_pipeline(**options)
+    restore()
+
+    # Only the rows of the checkpointed blobs were loaded
+    rows = bigquery_client.tables[("out", "gcp_vision_api_annotations")]
+    assert len(rows) == (CRASH_AT_WRITE - 1) // CHECKPOINT_INTERVAL * CHECKPOINT_INTERVAL
+
+    run_pipeline(**options)
+
+    assert len(rows) == NUM_IMAGES
+    assert len(set(creative_ids(rows))) == NUM_IMAGES
+
+
+def test_incremental_bigquery_runs_require_write_append(run_pipeline):
+    with pytest.raises(ValueError, match="WRITE_APPEND"):
+        run_pipeline(sink_type="bigquery", write_disposition="WRITE_TRUNCATE", checkpoint_path="manifest")
+
+
+def test_failed_images_go_to_the_dead_letter(run_pipeline, read_rows, storage_client, tmp_path):
+    error_uris = {f"gs://{BUCKET}/ads/1.png", f"gs://{BUCKET}/ads/2.png"}
+    run_pipeline(vision_client=FakeImageAnnotatorClient(storage_client, error_uris=error_uris), dead_letter_path="dead_letter.ndjson")
+
+    with open(tmp_path / "dead_letter.ndjson") as file:
+        dead_letters = [json.loads(line) for line in file]
+    assert {entry["creative_uri"] for entry in dead_letters} == error_uris
+    assert len(read_rows()) == NUM_IMAGES - len(error_uris)
+
+
+def test_reformatted_archive_has_a_row_per_creative(run_pipeline, read_rows, monkeypatch, tmp_path):
+    from utils.archive_utils import reformat_archive
+
+    # The responses archived after the last checkpoint are archived again by the resumed run
+    restore = crash_at(monkeypatch, sink_utils.NdjsonSink, "write_line")
+    options = dict(archive_dir="archive", checkpoint_path="manifest", checkpoint_interval=CHECKPOINT_INTERVAL)
+    with pytest.raises(RuntimeError):
+        run_pipeline(**options)
+    restore()
+    run_pipeline(**options)
+
+    output_paths = reformat_archive(str(tmp_path / "archive"), str(tmp_path / "re"), workers=1)
+
+    rows = [row for path in output_paths for row in iter_part_rows(path)]
+    assert sorted(rows, key=json.dumps) == sorted(read_rows(), key=json.dumps)
@@ -0,0 +1,301 @@
+from google.cloud import vision
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from utils.fast_format_utils import format_json_fast
+from utils.schema_utils import annotation_schema
+from utils.sink_utils import NdjsonSink, ParquetSink
+
+# Every record of a segment is its payload preceded by the payload length
+RECORD_HEADER = struct.Struct("<I")
+
+
+class ResponseArchiveWriter:
+    """
+    Archives the raw serialized AnnotateImageResponse of every image, so rows can be
+    regenerated later without calling the Vision API again.
+
+    Responses are appended to segment files (`segment-00000.seg`, ...) as length-prefixed
+    records. Each segment has an index (`segment-00000.idx`) with one NDJSON line per record:
+    `{"creative_id", "creative_uri", "offset", "length"}`, where `offset` points to the payload,
+    and `columns` with the extra columns of the row, such as `cluster_id`, if there are any.
+    A new segment is started once the current one reaches `segment_max_bytes`, and every
+    writer starts a new segment, so the segments of previous runs are never modified.
+
+    Args:
+        directory (str): Directory of the archive. It is created if it does not exist.
+        segment_max_bytes (int): Maximum size in bytes of each segment.
+    """
+
+    def __init__(self, directory, segment_max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.records_written = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._segment = None
+        self._index = None
+        self._next_index = max((int(os.path.basename(path)[len("segment-"):-len(".seg")]) + 1 for path in list_segments(directory)), default=0)
+
+    def write(self, creative_id, creative_uri, response, extra_columns=None):
+        """
+        Appends the response of an image to the archive.
+
+        Args:
+            creative_id (str): ID of the creative.
+            creative_uri (str): URI of the creative.
+            response (vision.AnnotateImageResponse): Response from the Vision API.
+            extra_columns (dict): Columns of the row that do not come from the response.
+        """
+        payload = vision.AnnotateImageResponse.serialize(response)
+
+        with self._lock:
+            if self._segment is not None and self._segment.tell() + RECORD_HEADER.size + len(payload) > self.segment_max_bytes:
+                self._close_segment()
+            if self._segment is None:
+                self._open_segment()
+
+            offset = self._segment.tell() + RECORD_HEADER.size
+            self._segment.write(RECORD_HEADER.pack(len(payload)))
+            self._segment.write(payload)
+            record = {"creative_id": str(creative_id), "creative_uri": str(creative_uri), "offset": offset, "length": len(payload)}
+            if extra_columns:
+                record["columns"] = extra_columns
+            self._index.write(json.dumps(record) + "\n")
+            self.records_written += 1
+
+    def _open_segment(self):
+        segment_path = os.path.join(self.directory, f"segment-{self._next_index:05d}.seg")
+        self._next_index += 1
+        self._segment = open(segment_path, "wb")
+        self._index = open(segment_path[:-len(".seg")] + ".idx", "w")
+
+    def _close_segment(self):
+        self._sync()
+        self._segment.close()
+        self._index.close()
+        self._segment = None
+        self._index = None
+
+    def _sync(self):
+        # The segment is synced first so the index never points past its end
+        for file in (self._segment, self._index):
+            file.flush()
+            os.fsync(file.fileno())
+
+    def flush(self):
+        """
+        Makes every record written so far durable on disk.
+        """
+        with self._lock:
+            if self._segment is not None:
+                self._sync()
+
+    def close(self):
+        """
+        Flushes and closes the current segment.
+        """
+        with self._lock:
+            if self._segment is not None:
+                self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def list_segments(directory) -> List[str]:
+    """
+    Lists the segment files of an archive in order.
+
+    Args:
+        directory (str): Directory of the archive.
+
+    Returns:
+        List[str]: Paths to the segment files.
+    """
+    return sorted(glob.glob(os.path.join(glob.escape(directory), "segment-[0-9][0-9][0-9][0-9][0-9].seg")))
+
+
+def iter_segment_index(segment_path) -> Iterator[dict]:
+    """
+    Reads the index records of a segment, without its payloads.
+
+    Index lines pointing past the end of the segment, left by a crash, are ignored.
+
+    Args:
+        segment_path (str): Path to the segment file.
+
+    Yields:
+        dict: The index record of each response.
+    """
+    size = os.path.getsize(segment_path)
+    with open(segment_path[:-len(".seg")] + ".idx") as index:
+        for line in index:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record["offset"] + record["length"] <= size:
+                yield record
+
+
+def iter_segment_records(segment_path) -> Iterator[Tuple[dict, bytes]]:
+    """
+    Reads the records of a segment through a memory map.
+
+    Args:
+        segment_path (str): Path to the segment file.
+
+    Yields:
+        Tuple[dict, bytes]: Index record and serialized response of each record.
+    """
+    if os.path.getsize(segment_path) == 0:
+        return
+
+    with open(segment_path, "rb") as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for record in iter_segment_index(segment_path):
+            yield record, data[record["offset"]:record["offset"] + record["length"]]
+
+
+def iter_segment(segment_path) -> Iterator[Tuple[str, str, bytes]]:
+    """
+    Reads the records of a segment through a memory map.
+
+    Args:
+        segment_path (str): Path to the segment file.
+
+    Yields:
+        Tuple[str, str, bytes]: Creative ID, creative URI and serialized response of each record.
+    """
+    for record, payload in iter_segment_records(segment_path):
+        yield record["creative_id"], record["creative_uri"], payload
+
+
+def latest_records(segment_paths: List[str]) -> Tuple[List[Set[int]], bool]:
+    """
+    Finds the last record of each creative across the segments, from their indexes only.
+
+    An incremental run archives a creative again when it changes, and a resumed run archives
+    again the responses of the images written after its last checkpoint, so only the last
+    record of each `creative_id` is kept, like `shard_utils.merge_shard_parts` does.
+
+    Args:
+        segment_paths (List[str]): Paths to the segment files, in the order they were written.
+
+    Returns:
+        Tuple[List[Set[int]], bool]: Positions of the records to keep in each segment, and
+            whether the rows have a `cluster_id` column.
+    """
+    last_records: Dict[str, Tuple[int, int]] = {}
+    with_cluster_id = False
+    for segment_number, segment_path in enumerate(segment_paths):
+        for position, record in enumerate(iter_segment_index(segment_path)):
+            last_records[record["creative_id"]] = (segment_number, position)
+            with_cluster_id = with_cluster_id or "cluster_id" in record.get("columns", {})
+
+    keep = [set() for _ in segment_paths]
+    for segment_number, position in last_records.values():
+        keep[segment_number].add(position)
+    return keep, with_cluster_id
+
+
+def iter_archive(directory) -> Iterator[Tuple[str, str, vision.AnnotateImageResponse]]:
+    """
+    Reads every response of an archive.
+
+    Args:
+        directory (str): Directory of the archive.
+
+    Yields:
+        Tuple[str, str, vision.AnnotateImageResponse]: Creative ID, creative URI and response.
+    """
+    for segment_path in list_segments(directory):
+        for creative_id, creative_uri, payload in iter_segment(segment_path):
+            yield creative_id, creative_uri, vision.AnnotateImageResponse.deserialize(payload)
+
+
+def reformat_segment(segment_path, output_prefix, features=None, output_format="ndjson", output_max_rows=None, ocr_mode="full", keep: Optional[Set[int]] = None, with_cluster_id=False) -> Tuple[int, List[str]]:
+    """
+    Regenerates the rows of the responses of a segment, without any network call.
+
+    Args:
+        segment_path (str): Path to the segment file.
+        output_prefix (str): Prefix of the output files. The name of the segment is appended to it.
+        features (list): Feature types whose columns are formatted. If None, every column is formatted.
+        output_format (str): "ndjson" or "parquet".
+        output_max_rows (int): Maximum number of rows per output file.
+        ocr_mode (str): Entries of the text annotations, see `format_utils.OCR_MODES`.
+        keep (Optional[Set[int]]): Positions of the records to format, see `latest_records`.
+            None formats every record.
+        with_cluster_id (bool): Add the `cluster_id` column of the runs with deduplication.
+
+    Returns:
+        Tuple[int, List[str]]: Number of rows written and paths to the output files.
+    """
+    # Parse straight into the protobuf message, which is what the fast formatter reads
+    response_class = vision.AnnotateImageResponse.pb()
+
+    segment_prefix = f"{output_prefix}-{os.path.basename(segment_path)[:-len('.seg')]}"
+    if output_format == "parquet":
+        sink = ParquetSink(segment_prefix, annotation_schema(features, with_cluster_id=with_cluster_id, ocr_mode=ocr_mode), max_rows=output_max_rows)
+    else:
+        sink = NdjsonSink(segment_prefix, max_rows=output_max_rows)
+
+    with sink:
+        for position, (record, payload) in enumerate(iter_segment_records(segment_path)):
+            if keep is not None and position not in keep:
+                continue
+            response = response_class.FromString(payload)
+            row = format_json_fast(response, record["creative_id"], record["creative_uri"], features, ocr_mode)
+            if with_cluster_id:
+                row["cluster_id"] = record.get("columns", {}).get("cluster_id")
+            sink.write(row)
+
+    return sink.rows_written, sink.paths
+
+
+def reformat_archive(directory, output_prefix, features=None, output_format="ndjson", output_max_rows=None, workers=None, ocr_mode="full") -> List[str]:
+    """
+    Regenerates the rows of every response of an archive, formatting the segments in parallel
+    in a process pool. Only the last response of each creative is formatted, see
+    `latest_records`.
+
+    Args:
+        directory (str): Directory of the archive.
+        output_prefix (str): Prefix of the output files.
+        features (list): Feature types whose columns are formatted. If None, every column is formatted.
+        output_format (str): "ndjson" or "parquet".
+        output_max_rows (int): Maximum number of rows per output file.
+        workers (int): Number of worker processes. Defaults to the number of CPUs.
+        ocr_mode (str): Entries of the text annotations, see `format_utils.OCR_MODES`.
+
+    Returns:
+        List[str]: Paths to the output files.
+    """
+    segment_paths = list_segments(directory)
+    keep, with_cluster_id = latest_records(segment_paths)
+
+    rows_written = 0
+    output_paths = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(reformat_segment, segment_path, output_prefix, features, output_format, output_max_rows, ocr_mode, segment_keep, with_cluster_id)
+            for segment_path, segment_keep in zip(segment_paths, keep)
+        ]
+        for future in futures:
+            segment_rows, segment_output_paths = future.result()
+            rows_written += segment_rows
+            output_paths.extend(segment_output_paths)
+
+    print(f"Reformatted {rows_written} responses from {len(segment_paths)} segments into {len(output_paths)} files")
+
+    return output_paths
@@ -0,0 +1,216 @@
+from google.api_core import exceptions as api_exceptions
+from google.cloud import vision
+from collections import deque
+from typing import Iterable, Iterator, List, Tuple
+import time
+from utils.concurrency_utils import bounded_map
+from utils.vision_utils import build_annotate_request, chunk_iterable
+
+# Maximum number of images accepted by a single async_batch_annotate_images operation
+MAX_IMAGES_PER_ASYNC_REQUEST = 2000
+
+# Maximum number of responses the Vision API writes into each output JSON file
+MAX_RESPONSES_PER_OUTPUT_FILE = 100
+
+# Status code of the images of an operation that failed without a gRPC status, or wrote no response for them
+INTERNAL = 13
+
+
+def split_gcs_uri(uri: str) -> Tuple[str, str]:
+    """
+    Splits a `gs://bucket/path` URI into its bucket name and object path.
+
+    Args:
+        uri (str): The GCS URI.
+
+    Returns:
+        Tuple[str, str]: The bucket name and the object path, which may be empty.
+    """
+    if not uri.startswith("gs://"):
+        raise ValueError(f"Expected a gs:// URI, got '{uri}'")
+    bucket_name, _, path = uri[len("gs://"):].partition("/")
+    return bucket_name, path
+
+
+def submit_async_batch(client: vision.ImageAnnotatorClient, image_uris: List[str], feature_types: List[str], output_uri: str, output_batch_size: int = MAX_RESPONSES_PER_OUTPUT_FILE):
+    """
+    Starts an async_batch_annotate_images operation over a shard of images.
+
+    The Vision API annotates the images on the server and writes the responses as JSON
+    files under `output_uri`, `output_batch_size` responses per file.
+
+    Args:
+        client (vision.ImageAnnotatorClient): Client for the Vision API.
+        image_uris (List[str]): URIs of the images, at most MAX_IMAGES_PER_ASYNC_REQUEST.
+        feature_types (List[str]): A list of feature types to include in the analysis.
+        output_uri (str): GCS prefix of the output JSON files, ending with "/".
+        output_batch_size (int): Number of responses per output file, up to MAX_RESPONSES_PER_OUTPUT_FILE.
+
+    Returns:
+        google.api_core.operation.Operation: The long-running operation.
+    """
+    if len(image_uris) > MAX_IMAGES_PER_ASYNC_REQUEST:
+        raise ValueError(f"An async batch can contain at most {MAX_IMAGES_PER_ASYNC_REQUEST} images, got {len(image_uris)}")
+
+    # Create one request per image
+    requests = [build_annotate_request(image_uri, feature_types) for image_uri in image_uris]
+
+    # Write the responses to the output prefix instead of returning them
+    output_config = vision.OutputConfig(
+        gcs_destination=vision.GcsDestination(uri=output_uri),
+        batch_size=min(output_batch_size, MAX_RESPONSES_PER_OUTPUT_FILE)
+    )
+
+    return client.async_batch_annotate_images(requests=requests, output_config=output_config)
+
+
+def parse_output_file(data) -> List[Tuple[str, vision.AnnotateImageResponse]]:
+    """
+    Parses an output JSON file of an async batch.
+
+    The responses are mapped back to their image through `response.context.uri`, since the
+    output files do not keep the order of the requests.
+
+    Args:
+        data (Union[bytes, str]): Content of the output file.
+
+    Returns:
+        List[Tuple[str, vision.AnnotateImageResponse]]: Pairs of image URI and its response.
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+
+    batch_response = vision.BatchAnnotateImagesResponse.from_json(data, ignore_unknown_fields=True)
+
+    return [(response.context.uri, response) for response in batch_response.responses]
+
+
+def ingest_output_files(storage_client, output_uri: str, concurrency: int = 1) -> Iterator[Tuple[str, vision.AnnotateImageResponse]]:
+    """
+    Downloads and parses the output JSON files of an async batch, several at a time.
+
+    Args:
+        storage_client (storage.Client): Client for GCS.
+        output_uri (str): GCS prefix of the output files.
+        concurrency (int): Maximum number of files downloaded in parallel.
+
+    Yields:
+        Tuple[str, vision.AnnotateImageResponse]: Pairs of image URI and its response.
+    """
+    bucket_name, prefix = split_gcs_uri(output_uri)
+    output_blobs = (blob for blob in storage_client.list_blobs(bucket_name, prefix=prefix) if blob.name.endswith(".json"))
+
+    def ingest(blob):
+        return parse_output_file(blob.download_as_bytes())
+
+    for file_results in bounded_map(ingest, output_blobs, concurrency):
+        yield from file_results
+
+
+def operation_error_code(error: Exception) -> int:
+    """
+    Returns the gRPC status code of the error raised by a failed operation, INTERNAL when it
+    has none.
+
+    Args:
+        error (Exception): The error raised by `operation.result()`.
+
+    Returns:
+        int: The status code.
+    """
+    if isinstance(error, api_exceptions.GoogleAPICallError) and error.grpc_status_code is not None:
+        return error.grpc_status_code.value[0]
+    return INTERNAL
+
+
+def wait_for_any(pending: deque, poll_interval: float = 10.0):
+    """
+    Polls the pending operations until one of them is done and removes it from `pending`.
+
+    Args:
+        pending (deque): Pairs of output URI and (operation, image URIs).
+        poll_interval (float): Seconds between two polls of the whole queue.
+
+    Returns:
+        Tuple[str, Tuple[google.api_core.operation.Operation, List[str]]]: The output URI, the
+            finished operation and the URIs of its images.
+    """
+    while True:
+        for index, (output_uri, (operation, shard)) in enumerate(pending):
+            if operation.done():
+                del pending[index]
+                return output_uri, (operation, shard)
+        time.sleep(poll_interval)
+
+
+def analyze_images_async(client: vision.ImageAnnotatorClient, storage_client, image_uris: Iterable[str], feature_types: List[str], output_uri: str, shard_size: int = MAX_IMAGES_PER_ASYNC_REQUEST, max_pending_operations: int = 10, poll_interval: float = 10.0, concurrency: int = 1) -> Iterator[Tuple[str, vision.AnnotateImageResponse]]:
+    """
+    Annotates images with async_batch_annotate_images operations and yields their responses.
+
+    The URIs are split into shards of `shard_size` images, each one submitted as an operation
+    writing to its own `shard-NNNNN/` folder under `output_uri`. At most `max_pending_operations`
+    run at the same time, and the output of each operation is ingested as soon as it finishes,
+    so the URIs are only pulled from `image_uris` as operations complete. Rate limiting and
+    retries of the individual images are handled by the Vision API.
+
+    The images of an operation that fails are yielded with the error of the operation in
+    `response.error`. The images of a successful operation missing from its output files are
+    yielded with an INTERNAL error, so every image of a shard is yielded once.
+
+    Args:
+        client (vision.ImageAnnotatorClient): Client for the Vision API.
+        storage_client (storage.Client): Client for GCS, used to read the output files.
+        image_uris (Iterable[str]): URIs of the images to analyze.
+        feature_types (List[str]): A list of feature types to include in the analysis.
+        output_uri (str): GCS prefix of the output of this run, ending with "/".
+        shard_size (int): Number of images per operation, up to MAX_IMAGES_PER_ASYNC_REQUEST.
+        max_pending_operations (int): Maximum number of operations running at the same time.
+        poll_interval (float): Seconds between two polls of the running operations.
+        concurrency (int): Maximum number of output files downloaded in parallel.
+
+    Yields:
+        Tuple[str, vision.AnnotateImageResponse]: Pairs of image URI and its response.
+    """
+    if not output_uri.endswith("/"):
+        output_uri += "/"
+
+    pending = deque()
+
+    def ingest(finished):
+        shard_output_uri, (operation, shard) = finished
+        try:
+            operation.result()
+        except Exception as e:
+            print(f"ERROR - {shard_output_uri}: {e}")
+            # Report every image of the shard as failed
+            code = operation_error_code(e)
+            for image_uri in shard:
+                yield image_uri, vision.AnnotateImageResponse(error={"code": code, "message": str(e)})
+            return
+
+        # Responses that cannot be matched with an image of the shard are dropped
+        missing = set(shard)
+        for image_uri, response in ingest_output_files(storage_client, shard_output_uri, concurrency):
+            if image_uri not in missing:
+                print(f"ERROR - {shard_output_uri}: Unexpected response for image '{image_uri}'")
+                continue
+            missing.discard(image_uri)
+            yield image_uri, response
+
+        # Report the images the operation wrote no response for as failed
+        for image_uri in shard:
+            if image_uri in missing:
+                yield image_uri, vision.AnnotateImageResponse(error={"code": INTERNAL, "message": f"No response in the output of {shard_output_uri}"})
+
+    shards = chunk_iterable(image_uris, min(shard_size, MAX_IMAGES_PER_ASYNC_REQUEST))
+    for index, shard in enumerate(shards):
+        # Wait for a slot before starting another operation
+        while len(pending) >= max_pending_operations:
+            yield from ingest(wait_for_any(pending, poll_interval))
+
+        shard_output_uri = f"{output_uri}shard-{index:05d}/"
+        pending.append((shard_output_uri, (submit_async_batch(client, shard, feature_types, shard_output_uri), shard)))
+        print(f"Submitted async batch {index} with {len(shard)} images")
+
+    while pending:
+        yield from ingest(wait_for_any(pending, poll_interval))
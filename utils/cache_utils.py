@@ -0,0 +1,288 @@
+from google.cloud import vision
+from typing import List, Optional
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def annotation_cache_key(blob, feature_types: List[str], variant: str = None) -> Optional[str]:
+    """
+    Builds the cache key of a blob from its content hash and the requested features.
+
+    The key only depends on the content of the object, so the same creative uploaded under
+    different names shares the same entry.
+
+    Args:
+        blob (storage.Blob): Blob from the bucket listing.
+        feature_types (List[str]): Feature types requested to the Vision API.
+        variant (str): Identifies any preprocessing changing the image sent, e.g. downscaling.
+
+    Returns:
+        Optional[str]: The cache key, or None if the listing has no hash for the blob.
+    """
+    # Composite objects have no md5, fall back to crc32c plus the size
+    if blob.md5_hash:
+        content_hash = f"md5:{blob.md5_hash}"
+    elif blob.crc32c:
+        content_hash = f"crc32c:{blob.crc32c}:{blob.size}"
+    else:
+        return None
+
+    feature_names = ",".join(sorted(vision.Feature.Type(feature_type).name for feature_type in feature_types))
+
+    key = f"{content_hash}|{feature_names}"
+
+    return f"{key}|{variant}" if variant else key
+
+
+class AnnotationCache:
+    """
+    Base class of the annotation cache backends.
+
+    Entries map a cache key to the serialized AnnotateImageResponse of the image. Backends
+    evict entries older than `max_age_seconds` and, once the cache holds more than
+    `max_entries` entries or `max_bytes` bytes, the least recently used ones.
+
+    Args:
+        max_entries (int): Maximum number of entries. None for no limit.
+        max_bytes (int): Maximum total size of the stored responses. None for no limit.
+        max_age_seconds (float): Maximum age of an entry. None for no limit.
+    """
+
+    # Number of writes between two eviction passes
+    EVICTION_INTERVAL = 1000
+
+    def __init__(self, max_entries=None, max_bytes=None, max_age_seconds=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[vision.AnnotateImageResponse]:
+        """
+        Looks up the response stored for a key.
+
+        Args:
+            key (str): Cache key built by `annotation_cache_key`.
+
+        Returns:
+            Optional[vision.AnnotateImageResponse]: The stored response, or None on a miss.
+        """
+        with self._lock:
+            data = self._get(key, time.time())
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return vision.AnnotateImageResponse.deserialize(data)
+
+    def put(self, key: str, response: vision.AnnotateImageResponse):
+        """
+        Stores the response of an image. Responses with an error are not cached.
+
+        Args:
+            key (str): Cache key built by `annotation_cache_key`.
+            response (vision.AnnotateImageResponse): Response from the Vision API.
+        """
+        if response.error.code:
+            return
+
+        data = vision.AnnotateImageResponse.serialize(response)
+        with self._lock:
+            self._put(key, data, time.time())
+            self._writes += 1
+            if self._writes % self.EVICTION_INTERVAL == 0:
+                self._evict(time.time())
+
+    def close(self):
+        """
+        Runs a last eviction pass and releases the backend.
+        """
+        with self._lock:
+            self._evict(time.time())
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get(self, key, now):
+        raise NotImplementedError
+
+    def _put(self, key, data, now):
+        raise NotImplementedError
+
+    def _evict(self, now):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class SQLiteAnnotationCache(AnnotationCache):
+    """
+    Annotation cache stored in a local SQLite database.
+
+    Args:
+        path (str): Path to the database file.
+        **kwargs: Eviction limits, see `AnnotationCache`.
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS annotations ("
+            "key TEXT PRIMARY KEY, response BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS annotations_accessed_at ON annotations (accessed_at)")
+        self._connection.commit()
+
+    def _get(self, key, now):
+        row = self._connection.execute(
+            "SELECT response, created_at FROM annotations WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        data, created_at = row
+        if self.max_age_seconds is not None and now - created_at > self.max_age_seconds:
+            return None
+        self._connection.execute("UPDATE annotations SET accessed_at = ? WHERE key = ?", (now, key))
+        return data
+
+    def _put(self, key, data, now):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO annotations (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, data, len(data), now, now),
+        )
+        self._connection.commit()
+
+    def _evict(self, now):
+        # Drop the expired entries
+        if self.max_age_seconds is not None:
+            self._connection.execute("DELETE FROM annotations WHERE created_at < ?", (now - self.max_age_seconds,))
+
+        # Drop the least recently used entries above the count limit
+        if self.max_entries is not None:
+            self._connection.execute(
+                "DELETE FROM annotations WHERE key IN ("
+                "SELECT key FROM annotations ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+        # Drop the least recently used entries above the size limit
+        if self.max_bytes is not None:
+            self._connection.execute(
+                "DELETE FROM annotations WHERE key IN ("
+                "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM annotations) "
+                "WHERE total > ?)",
+                (self.max_bytes,),
+            )
+        self._connection.commit()
+
+    def _close(self):
+        self._connection.commit()
+        self._connection.close()
+
+
+class DiskAnnotationCache(AnnotationCache):
+    """
+    Annotation cache stored as one file per entry in a local directory.
+
+    Files are named after the SHA-1 of the key and spread over 256 subdirectories. The
+    modification time of a file is its creation time and the access time is set explicitly
+    on every hit, so eviction does not depend on how the filesystem is mounted.
+
+    Args:
+        directory (str): Directory holding the entries.
+        **kwargs: Eviction limits, see `AnnotationCache`.
+    """
+
+    def __init__(self, directory, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _get(self, key, now):
+        path = self._entry_path(key)
+        try:
+            stat = os.stat(path)
+            if self.max_age_seconds is not None and now - stat.st_mtime > self.max_age_seconds:
+                return None
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path, (now, stat.st_mtime))
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _put(self, key, data, now):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self, now):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if self.max_age_seconds is not None and now - stat.st_mtime > self.max_age_seconds:
+                    os.remove(path)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+
+        # Keep the most recently used entries within the limits
+        entries.sort(reverse=True)
+        total_bytes = 0
+        for count, (_, size, path) in enumerate(entries, start=1):
+            total_bytes += size
+            over_entries = self.max_entries is not None and count > self.max_entries
+            over_bytes = self.max_bytes is not None and total_bytes > self.max_bytes
+            if over_entries or over_bytes:
+                os.remove(path)
+
+
+def create_annotation_cache(backend: str, path: str, **kwargs) -> AnnotationCache:
+    """
+    Creates an annotation cache for the given backend.
+
+    Args:
+        backend (str): "sqlite" or "disk".
+        path (str): Database file for "sqlite", directory for "disk".
+        **kwargs: Eviction limits, see `AnnotationCache`.
+
+    Returns:
+        AnnotationCache: The cache.
+    """
+    backends = {
+        "sqlite": SQLiteAnnotationCache,
+        "disk": DiskAnnotationCache,
+    }
+    if backend not in backends:
+        raise ValueError(f"Unknown cache backend '{backend}'. Use one of: {', '.join(backends)}")
+
+    return backends[backend](path, **kwargs)
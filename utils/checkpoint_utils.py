@@ -0,0 +1,125 @@
+import json
+import os
+
+
+class CheckpointManifest:
+    """
+    Manifest of the blobs already processed, used to resume a run and to only process new or
+    changed objects on the next one.
+
+    The manifest is an append-only NDJSON file with one `{"name", "generation"}` record per
+    processed blob. A new generation of an object gets a new record, and the last record of a
+    name wins when the manifest is loaded.
+
+    Each flush ends with a `{"sink_files"}` record holding the size of every output file once
+    the rows of the flushed blobs were synced, see `RotatingFileSink.committed_files`. A run
+    resumed after a crash truncates the output files back to these sizes, so the rows written
+    after the last flush are not duplicated when their blobs are annotated again. The blob
+    records after the last `sink_files` record come from an interrupted flush and are ignored.
+    A run records the files it starts from before writing any row, so a crash before its
+    first flush is rolled back too.
+
+    Args:
+        path (str): Path to the manifest file. It is created if it does not exist.
+        flush_interval (int): Number of marked blobs after which `should_flush` is True.
+    """
+
+    def __init__(self, path, flush_interval=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._generations = {}
+        self._pending = []
+        self._needs_newline = False
+        # Size of each output file at the last flush, None if the manifest has no record of it
+        self.sink_files = None
+        self._load()
+
+    def _load(self):
+        """
+        Loads the records of previous runs, ignoring a partially written last line and the
+        records of an interrupted flush.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        # Blob records are only committed by the sink_files record closing their flush
+        uncommitted = []
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "sink_files" in record:
+                    self.sink_files = record["sink_files"]
+                    self._generations.update(uncommitted)
+                    uncommitted = []
+                else:
+                    uncommitted.append((record["name"], record["generation"]))
+
+        # Terminate a line cut by a crash so the next record starts on its own line
+        with open(self.path, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell():
+                file.seek(-1, os.SEEK_END)
+                self._needs_newline = file.read(1) != b"\n"
+
+    def __len__(self):
+        return len(self._generations)
+
+    def is_processed(self, name, generation) -> bool:
+        """
+        Checks whether a blob was already processed in its current generation.
+
+        Args:
+            name (str): Name of the blob.
+            generation (int): Generation of the blob.
+
+        Returns:
+            bool: True if the same generation of the blob is in the manifest.
+        """
+        return self._generations.get(name) == generation
+
+    def mark(self, name, generation):
+        """
+        Records a blob as processed. The record is only durable after the next `flush`.
+
+        Args:
+            name (str): Name of the blob.
+            generation (int): Generation of the blob.
+        """
+        self._generations[name] = generation
+        self._pending.append({"name": name, "generation": generation})
+
+    @property
+    def should_flush(self) -> bool:
+        """
+        Returns:
+            bool: True once `flush_interval` blobs were marked since the last flush.
+        """
+        return len(self._pending) >= self.flush_interval
+
+    def flush(self, sink_files=None):
+        """
+        Appends the pending records to the manifest file and syncs it to disk. Without pending
+        records, only a change of `sink_files` is recorded, e.g. the files a run starts from.
+
+        Args:
+            sink_files (Dict[str, int]): Size of each output file once the rows of the pending
+                blobs were synced. None if the sink cannot be rolled back, e.g. BigQuery.
+        """
+        if not self._pending and sink_files == self.sink_files:
+            return
+
+        with open(self.path, "a") as file:
+            if self._needs_newline:
+                file.write("\n")
+                self._needs_newline = False
+            for record in self._pending:
+                file.write(json.dumps(record) + "\n")
+            file.write(json.dumps({"sink_files": sink_files}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+        self._pending = []
+        self.sink_files = sink_files
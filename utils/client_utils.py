@@ -0,0 +1,155 @@
+import itertools
+import threading
+
+# Scopes of the shared credentials, the `AUTH_SCOPES` of the Vision transport without importing it
+AUTH_SCOPES = ("https://www.googleapis.com/auth/cloud-platform", "https://www.googleapis.com/auth/cloud-vision")
+
+
+class ClientRegistry:
+    """
+    Builds the Vision, Storage and BigQuery clients once from a single credential source
+    and shares them across every annotation call, worker and thread.
+
+    Vision calls are spread round-robin over a pool of gRPC channels. Each channel keeps its
+    own connection, so concurrent batches do not queue behind a single HTTP/2 connection and
+    no call pays credential discovery or a TLS handshake again.
+
+    The client libraries are only imported when their first client is built, so a run that
+    never writes to BigQuery does not pay for importing its library.
+
+    Args:
+        project_id (str): GCP project used by the Storage and BigQuery clients.
+        auth_file (str): Path to a service account JSON file. If None, the application
+            default credentials are used.
+        channel_pool_size (int): Number of gRPC channels used for the Vision API.
+    """
+
+    def __init__(self, project_id=None, auth_file=None, channel_pool_size=1):
+        if channel_pool_size < 1:
+            raise ValueError(f"channel_pool_size must be at least 1, got {channel_pool_size}")
+
+        self.project_id = project_id
+        self.auth_file = auth_file
+        self.channel_pool_size = channel_pool_size
+
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._vision_clients = None
+        self._vision_cycle = None
+        self._storage_client = None
+        self._bigquery_client = None
+
+    @property
+    def credentials(self):
+        """
+        Loads the credentials the first time they are needed.
+
+        Returns:
+            google.auth.credentials.Credentials: Credentials shared by every client.
+        """
+        with self._lock:
+            if self._credentials is None:
+                if self.auth_file:
+                    from google.oauth2 import service_account
+                    self._credentials = service_account.Credentials.from_service_account_file(
+                        self.auth_file, scopes=AUTH_SCOPES
+                    )
+                else:
+                    import google.auth
+                    self._credentials, default_project_id = google.auth.default(
+                        scopes=AUTH_SCOPES
+                    )
+                    self.project_id = self.project_id or default_project_id
+            return self._credentials
+
+    def vision_client(self) -> "vision.ImageAnnotatorClient":
+        """
+        Returns the next Vision client of the channel pool.
+
+        Returns:
+            vision.ImageAnnotatorClient: Client bound to one of the pooled gRPC channels.
+        """
+        from google.cloud import vision
+        from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+
+        credentials = self.credentials
+        with self._lock:
+            if self._vision_clients is None:
+                self._vision_clients = [
+                    vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=self._create_vision_channel(credentials)))
+                    for _ in range(self.channel_pool_size)
+                ]
+                self._vision_cycle = itertools.cycle(self._vision_clients)
+            return next(self._vision_cycle)
+
+    def storage_client(self) -> "storage.Client":
+        """
+        Returns the shared Storage client.
+
+        Returns:
+            storage.Client: Client for Google Cloud Storage.
+        """
+        from google.cloud import storage
+
+        credentials = self.credentials
+        with self._lock:
+            if self._storage_client is None:
+                self._storage_client = storage.Client(project=self.project_id, credentials=credentials)
+            return self._storage_client
+
+    def bigquery_client(self) -> "bigquery.Client":
+        """
+        Returns the shared BigQuery client.
+
+        Returns:
+            bigquery.Client: Client for BigQuery.
+        """
+        from google.cloud import bigquery
+
+        credentials = self.credentials
+        with self._lock:
+            if self._bigquery_client is None:
+                self._bigquery_client = bigquery.Client(project=self.project_id, credentials=credentials)
+            return self._bigquery_client
+
+    def _create_vision_channel(self, credentials):
+        """
+        Creates a gRPC channel for the Vision API with its own connection.
+
+        Args:
+            credentials (google.auth.credentials.Credentials): Credentials for the channel.
+
+        Returns:
+            grpc.Channel: The new channel.
+        """
+        from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+
+        return ImageAnnotatorGrpcTransport.create_channel(
+            credentials=credentials,
+            scopes=AUTH_SCOPES,
+            options=[
+                # Do not share the underlying connection with the other channels of the pool
+                ("grpc.use_local_subchannel_pool", 1),
+                ("grpc.max_send_message_length", -1),
+                ("grpc.max_receive_message_length", -1),
+            ],
+        )
+
+
+# Registry used when no registry is passed explicitly
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_default_registry() -> ClientRegistry:
+    """
+    Returns the process-wide registry built from the application default credentials.
+
+    Returns:
+        ClientRegistry: The default registry.
+    """
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = ClientRegistry()
+        return _default_registry
@@ -0,0 +1,160 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from collections import deque
+from typing import Any, Callable, Iterable, Iterator
+import threading
+import time
+
+
+def bounded_map(fn: Callable[[Any], Any], iterable: Iterable, max_workers: int, ordered: bool = False) -> Iterator[Any]:
+    """
+    Applies a function to every element of an iterable on a thread pool, keeping a bounded
+    number of tasks in flight.
+
+    The iterable is consumed lazily: a new element is only pulled once one of the in-flight
+    tasks has finished, so a huge (or endless) input never queues unbounded work.
+
+    Args:
+        fn (Callable[[Any], Any]): Function applied to each element.
+        iterable (Iterable): Elements to process.
+        max_workers (int): Number of threads and maximum number of tasks in flight.
+        ordered (bool): If True, results are yielded in the same order as the input.
+            Otherwise they are yielded as soon as they complete.
+
+    Yields:
+        Any: The result of `fn` for each element.
+    """
+    if max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+
+    # Run in the calling thread when there is nothing to parallelize
+    if max_workers == 1:
+        for element in iterable:
+            yield fn(element)
+        return
+
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if ordered:
+            # Keep the futures in submission order and always wait for the oldest one
+            in_flight = deque()
+            for element in iterator:
+                in_flight.append(executor.submit(fn, element))
+                if len(in_flight) >= max_workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        else:
+            # Yield whichever task finishes first and refill the free slots
+            in_flight = set()
+            for element in iterator:
+                in_flight.add(executor.submit(fn, element))
+                if len(in_flight) >= max_workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(in_flight):
+                yield future.result()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of an operation.
+
+    Tokens are added at `rate` per second up to `capacity`. Acquiring more tokens than are
+    available reserves them anyway and sleeps until they have been produced, so callers are
+    served in arrival order and a large acquisition never starves.
+
+    Args:
+        rate (float): Tokens produced per second.
+        capacity (float): Maximum number of tokens stored, i.e. the largest burst allowed.
+            Defaults to one second of tokens.
+        clock (Callable[[], float]): Monotonic clock, in seconds.
+        sleep (Callable[[float], None]): Function used to wait.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        """
+        Takes `tokens` from the bucket, waiting until they are available.
+
+        Args:
+            tokens (float): Number of tokens to take.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            self._sleep(wait)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of calls in flight, adjusting the limit additively up and
+    multiplicatively down (AIMD).
+
+    Every call that succeeds raises the limit by `1 / limit`, i.e. by one after a full window
+    of successful calls. A throttled call multiplies the limit by `decrease_factor`. Calls
+    started before a decrease do not decrease it again, so a single burst of throttling only
+    halves the limit once.
+
+    Args:
+        maximum (int): Highest limit.
+        initial (int): Starting limit. Defaults to `maximum`.
+        minimum (int): Lowest limit.
+        decrease_factor (float): Factor applied to the limit on throttling.
+    """
+
+    def __init__(self, maximum: int, initial: int = None, minimum: int = 1, decrease_factor: float = 0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease_factor = decrease_factor
+        self.limit = float(min(initial or maximum, maximum))
+        self.decreases = 0
+        self._in_flight = 0
+        self._epoch = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> int:
+        """
+        Waits for a free slot under the current limit.
+
+        Returns:
+            int: Ticket to hand back to `release`.
+        """
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+            return self._epoch
+
+    def release(self, ticket: int, throttled: bool = False):
+        """
+        Frees the slot of a finished call and adjusts the limit.
+
+        Args:
+            ticket (int): Value returned by `acquire` for this call.
+            throttled (bool): Whether the call was throttled.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if not throttled:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif ticket == self._epoch:
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self._epoch += 1
+                self.decreases += 1
+            self._condition.notify_all()
@@ -0,0 +1,360 @@
+from google.cloud import vision
+from collections import OrderedDict, defaultdict, deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import io
+import math
+import threading
+from utils.concurrency_utils import bounded_map
+from utils.image_utils import import_pillow, rescale_response
+
+# Side of the grid a perceptual hash is computed on, giving HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+# The pHash DCT runs on an image HIGHFREQ_FACTOR times larger than the hash grid
+HIGHFREQ_FACTOR = 4
+
+# Cosines of the low frequencies of the pHash DCT, indexed by frequency and then by pixel
+_DCT_SIZE = HASH_SIZE * HIGHFREQ_FACTOR
+_DCT_COSINES = [
+    [math.cos(math.pi * frequency * (2 * pixel + 1) / (2 * _DCT_SIZE)) for pixel in range(_DCT_SIZE)]
+    for frequency in range(HASH_SIZE)
+]
+
+
+def _grayscale_pixels(image, width, height) -> List[int]:
+    Image = import_pillow()
+    return list(image.convert("L").resize((width, height), getattr(Image, "Resampling", Image).LANCZOS).getdata())
+
+
+def dhash(image) -> int:
+    """
+    Computes the difference hash of an image: one bit per pair of horizontally adjacent pixels
+    of a 9x8 grayscale thumbnail, set when the left pixel is brighter.
+
+    Args:
+        image (PIL.Image.Image): The image.
+
+    Returns:
+        int: The 64-bit hash.
+    """
+    pixels = _grayscale_pixels(image, HASH_SIZE + 1, HASH_SIZE)
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+
+    return value
+
+
+def phash(image) -> int:
+    """
+    Computes the perceptual hash of an image: the 8x8 lowest frequencies of the DCT of a 32x32
+    grayscale thumbnail, one bit per coefficient set when it is above their median.
+
+    Args:
+        image (PIL.Image.Image): The image.
+
+    Returns:
+        int: The 64-bit hash.
+    """
+    pixels = _grayscale_pixels(image, _DCT_SIZE, _DCT_SIZE)
+
+    # Separable DCT, keeping only the low frequencies: along the rows, then along the columns
+    rows = [
+        [sum(cosine * pixel for cosine, pixel in zip(cosines, pixels[y * _DCT_SIZE:(y + 1) * _DCT_SIZE])) for cosines in _DCT_COSINES]
+        for y in range(_DCT_SIZE)
+    ]
+    coefficients = [
+        sum(cosines[y] * rows[y][u] for y in range(_DCT_SIZE))
+        for cosines in _DCT_COSINES
+        for u in range(HASH_SIZE)
+    ]
+
+    median = sorted(coefficients)[len(coefficients) // 2]
+
+    value = 0
+    for coefficient in coefficients:
+        value = (value << 1) | (coefficient > median)
+
+    return value
+
+
+HASH_FUNCTIONS = {"phash": phash, "dhash": dhash}
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """
+    Returns the number of bits that differ between two hashes.
+    """
+    return bin(a ^ b).count("1")
+
+
+def member_response(response: vision.AnnotateImageResponse, representative_size: Tuple[int, int], size: Tuple[int, int]) -> vision.AnnotateImageResponse:
+    """
+    Returns the response of a representative for a member of its cluster, with the pixel
+    coordinates scaled to the dimensions of the member. Errors, normalized vertices and the
+    rest of the response do not depend on the size of the image.
+
+    Args:
+        response (vision.AnnotateImageResponse): Response of the representative.
+        representative_size (Tuple[int, int]): Width and height of the representative.
+        size (Tuple[int, int]): Width and height of the member.
+
+    Returns:
+        vision.AnnotateImageResponse: The same response if both images have the same size, a
+            scaled copy otherwise.
+    """
+    if size == representative_size or response.error.code:
+        return response
+
+    pb = vision.AnnotateImageResponse.pb(response)
+    scaled = type(pb)()
+    scaled.CopyFrom(pb)
+    rescale_response(scaled, size[0] / representative_size[0], size[1] / representative_size[1])
+    return vision.AnnotateImageResponse.wrap(scaled)
+
+
+class HashClusterIndex:
+    """
+    Finds the cluster of a hash among clusters of near-identical hashes.
+
+    Each cluster is represented by the hash of its first image. Hashes are split into
+    `threshold + 1` bands: two hashes within `threshold` bits of each other share at least one
+    identical band, so only the clusters sharing a band are compared.
+
+    Args:
+        threshold (int): Maximum Hamming distance to the representative of a cluster.
+        bits (int): Number of bits of the hashes.
+    """
+
+    def __init__(self, threshold: int, bits: int = HASH_SIZE * HASH_SIZE):
+        self.threshold = threshold
+        self._hashes = {}
+
+        band_count = min(threshold + 1, bits)
+        self._bands = []
+        start = 0
+        for index in range(band_count):
+            width = bits // band_count + (index < bits % band_count)
+            self._bands.append((start, (1 << width) - 1))
+            start += width
+        self._tables = [defaultdict(set) for _ in self._bands]
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _band_values(self, value):
+        return [(value >> shift) & mask for shift, mask in self._bands]
+
+    def find(self, value: int) -> Optional[str]:
+        """
+        Returns the closest cluster within the threshold, or None.
+        """
+        candidates = set()
+        for table, band_value in zip(self._tables, self._band_values(value)):
+            candidates.update(table.get(band_value, ()))
+
+        best_cluster, best_distance = None, self.threshold + 1
+        for cluster_id in candidates:
+            distance = hamming_distance(value, self._hashes[cluster_id])
+            if distance < best_distance or (distance == best_distance and cluster_id < best_cluster):
+                best_cluster, best_distance = cluster_id, distance
+
+        return best_cluster
+
+    def add(self, cluster_id: str, value: int):
+        """
+        Adds a cluster represented by `value`.
+        """
+        self._hashes[cluster_id] = value
+        for table, band_value in zip(self._tables, self._band_values(value)):
+            table[band_value].add(cluster_id)
+
+    def remove(self, cluster_id: str):
+        """
+        Removes a cluster, so the next matching hash starts a new one.
+        """
+        value = self._hashes.pop(cluster_id)
+        for table, band_value in zip(self._tables, self._band_values(value)):
+            table[band_value].discard(cluster_id)
+
+
+class NearDuplicateDeduper:
+    """
+    Annotates a single representative of each group of near-identical images, such as the
+    sizes of the same DSP creative, and reuses its response for the rest of the group.
+
+    Every image is downloaded and hashed with a perceptual hash. An image within `threshold`
+    bits of the representative of an existing cluster joins it; otherwise it starts a new
+    cluster and is annotated. The ID of a cluster is the hexadecimal hash of its representative.
+
+    Members found before the response of their representative is back wait for it; the ones
+    found after are answered straight away. Near-duplicates are often other sizes of the same
+    creative, so each member gets a copy of the response with its pixel coordinates scaled by
+    the ratio between its dimensions and those of the representative. When a representative fails, its waiting members
+    get the same error and the cluster is dropped, so the next member starts a new one.
+
+    Only the responses of the `max_responses` most recently used clusters are kept, so the
+    memory does not grow with the number of clusters. A member whose cluster response was
+    evicted is annotated itself, and its response is kept for the next members.
+
+    Args:
+        storage_client (storage.Client): Client for GCS.
+        algorithm (str): "phash" or "dhash".
+        threshold (int): Maximum Hamming distance, out of 64 bits, to the representative.
+        workers (int): Number of images downloaded and hashed at the same time.
+        max_responses (int): Maximum number of cluster responses kept in memory.
+    """
+
+    def __init__(self, storage_client, algorithm="phash", threshold=8, workers=8, max_responses=256):
+        if algorithm not in HASH_FUNCTIONS:
+            raise ValueError(f"Unknown hash algorithm '{algorithm}'. Use one of: {', '.join(HASH_FUNCTIONS)}")
+
+        self._image = import_pillow()
+        self.storage_client = storage_client
+        self.hash_function = HASH_FUNCTIONS[algorithm]
+        self.workers = workers
+        self.index = HashClusterIndex(threshold)
+
+        # Cluster of each image not formatted yet
+        self.cluster_ids: Dict[str, Optional[str]] = {}
+
+        self.max_responses = max_responses
+        self.images = 0
+        self.reused = 0
+        self.reannotated = 0
+        self._representatives = {}
+        self._pending = set()
+        self._responses = OrderedDict()
+        self._waiting = defaultdict(list)
+        self._ready = deque()
+        self._lock = threading.Lock()
+
+    def hash_blob(self, blob) -> Optional[Tuple[int, Tuple[int, int]]]:
+        """
+        Downloads and hashes a blob.
+
+        Args:
+            blob (storage.Blob): The blob.
+
+        Returns:
+            Optional[Tuple[int, Tuple[int, int]]]: The hash and the width and height of the
+                image, or None if the blob cannot be decoded.
+        """
+        try:
+            with self._image.open(io.BytesIO(blob.download_as_bytes())) as image:
+                size = image.size
+                # Let the JPEG decoder skip the detail that is thrown away anyway
+                image.draft("L", (_DCT_SIZE * 2, _DCT_SIZE * 2))
+                return self.hash_function(image), size
+        except (OSError, SyntaxError, ValueError, self._image.DecompressionBombError):
+            return None
+
+    def hash_blobs(self, blobs: Iterable) -> Iterator[Tuple[object, Optional[Tuple[int, Tuple[int, int]]]]]:
+        """
+        Hashes the blobs on a thread pool, keeping their order.
+
+        Yields:
+            Tuple[storage.Blob, Optional[Tuple[int, Tuple[int, int]]]]: Each blob and the
+                result of `hash_blob`.
+        """
+        return bounded_map(lambda blob: (blob, self.hash_blob(blob)), blobs, self.workers, ordered=True)
+
+    def assign(self, image_uri: str, hashed: Optional[Tuple[int, Tuple[int, int]]]) -> bool:
+        """
+        Puts an image in its cluster.
+
+        Args:
+            image_uri (str): URI of the image.
+            hashed (Optional[Tuple[int, Tuple[int, int]]]): Hash and dimensions of the image,
+                see `hash_blob`. Images without hash are annotated alone.
+
+        Returns:
+            bool: True if the image has to be annotated, False if it reuses the response of
+                its cluster, yielded later by `fan_out`.
+        """
+        self.images += 1
+
+        if hashed is None:
+            self.cluster_ids[image_uri] = None
+            return True
+        value, size = hashed
+
+        with self._lock:
+            cluster_id = self.index.find(value)
+            if cluster_id is None:
+                cluster_id = f"{value:016x}"
+                self.index.add(cluster_id, value)
+                self._representatives[image_uri] = (cluster_id, size)
+                self._pending.add(cluster_id)
+                self.cluster_ids[image_uri] = cluster_id
+                return True
+
+            self.cluster_ids[image_uri] = cluster_id
+            if cluster_id in self._responses:
+                self._responses.move_to_end(cluster_id)
+                response, representative_size = self._responses[cluster_id]
+                self._ready.append((image_uri, response, representative_size, size))
+            elif cluster_id in self._pending:
+                self._waiting[cluster_id].append((image_uri, size))
+            else:
+                # The response of the cluster was evicted, annotate this member instead
+                self._representatives[image_uri] = (cluster_id, size)
+                self._pending.add(cluster_id)
+                self.reannotated += 1
+                return True
+
+            self.reused += 1
+            return False
+
+    def _ready_responses(self):
+        while self._ready:
+            image_uri, response, representative_size, size = self._ready.popleft()
+            yield image_uri, member_response(response, representative_size, size)
+
+    def fan_out(self, responses: Iterable[Tuple[str, vision.AnnotateImageResponse]]) -> Iterator[Tuple[str, vision.AnnotateImageResponse]]:
+        """
+        Yields the responses of the annotated images, followed by the response of their
+        cluster, scaled to its dimensions, for each member.
+
+        Args:
+            responses (Iterable[Tuple[str, vision.AnnotateImageResponse]]): Responses of the
+                images for which `assign` returned True.
+
+        Yields:
+            Tuple[str, vision.AnnotateImageResponse]: Pairs of image URI and its response.
+        """
+        for image_uri, response in responses:
+            # Members found while listing the next images
+            yield from self._ready_responses()
+
+            yield image_uri, response
+
+            with self._lock:
+                representative = self._representatives.pop(image_uri, None)
+                if representative is None:
+                    continue
+                cluster_id, representative_size = representative
+
+                self._pending.discard(cluster_id)
+                if response.error.code:
+                    self.index.remove(cluster_id)
+                else:
+                    self._responses[cluster_id] = (response, representative_size)
+                    self._responses.move_to_end(cluster_id)
+                    while len(self._responses) > self.max_responses:
+                        self._responses.popitem(last=False)
+                members = self._waiting.pop(cluster_id, ())
+
+            for member_uri, size in members:
+                yield member_uri, member_response(response, representative_size, size)
+
+        yield from self._ready_responses()
+
+    def summary(self) -> str:
+        """
+        Returns a one-line summary of the deduplication.
+        """
+        return f"{self.images} images in {len(self.index)} clusters, {self.reused} annotations reused, {self.reannotated} members annotated again after their cluster was evicted"
@@ -0,0 +1,476 @@
+import base64
+import datetime
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import zlib
+
+
+class FakeTableReference:
+    """
+    Stand-in for bigquery.TableReference.
+    """
+
+    def __init__(self, dataset_id, table_id):
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+
+
+class FakeDatasetReference:
+    """
+    Stand-in for bigquery.DatasetReference.
+    """
+
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return FakeTableReference(self.dataset_id, table_id)
+
+
+class FakeLoadJob:
+    """
+    Stand-in for bigquery.LoadJob. The rows are already loaded when the job is created.
+    """
+
+    def __init__(self, output_rows):
+        self.output_rows = output_rows
+
+    def result(self, timeout=None):
+        return self
+
+
+class FakeBigQueryClient:
+    """
+    In-process stand-in for the parts of bigquery.Client used by the pipelines.
+
+    Load jobs parse the NDJSON (or Parquet) source and store the rows in `tables`, keyed by
+    `(dataset_id, table_id)`, honouring WRITE_TRUNCATE, WRITE_APPEND and WRITE_EMPTY. Like
+    BigQuery, Parquet sources are rejected unless the job enables list inference.
+
+    Args:
+        project (str): Project of the client.
+        load_latency (float): Seconds each load job takes.
+        keep_rows (bool): Store the loaded rows. Benchmarks only count them, so the memory of
+            the fake does not add to the memory of the pipeline.
+    """
+
+    def __init__(self, project=None, load_latency=0.0, keep_rows=True):
+        self.project = project
+        self.load_latency = load_latency
+        self.keep_rows = keep_rows
+        self.tables = {}
+        self.load_jobs = []
+        self._lock = threading.Lock()
+
+    def dataset(self, dataset_id):
+        return FakeDatasetReference(dataset_id)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        if getattr(job_config, "source_format", None) == "PARQUET":
+            import pyarrow.parquet
+
+            # Without list inference BigQuery loads the lists written by pyarrow as wrapped records
+            parquet_options = getattr(job_config, "parquet_options", None)
+            if not getattr(parquet_options, "enable_list_inference", False):
+                raise ValueError("Parquet lists are only loaded into REPEATED fields with parquet_options.enable_list_inference")
+
+            rows = pyarrow.parquet.read_table(io.BytesIO(file_obj.read())).to_pylist()
+        else:
+            rows = [json.loads(line) for line in file_obj.read().decode("utf-8").splitlines() if line]
+        if self.load_latency:
+            time.sleep(self.load_latency)
+        key = (destination.dataset_id, destination.table_id)
+        write_disposition = getattr(job_config, "write_disposition", None) or "WRITE_APPEND"
+
+        with self._lock:
+            if write_disposition == "WRITE_TRUNCATE":
+                self.tables[key] = []
+            elif write_disposition == "WRITE_EMPTY" and self.tables.get(key):
+                raise ValueError(f"Table {key[0]}.{key[1]} is not empty")
+            self.tables.setdefault(key, []).extend(rows if self.keep_rows else [])
+            self.load_jobs.append({"table": key, "rows": len(rows), "write_disposition": write_disposition})
+
+        return FakeLoadJob(len(rows))
+
+
+def build_synthetic_response(num_text=20, num_faces=2, num_labels=10, num_logos=2, num_objects=5, num_colors=10, num_web_entities=10, seed=0):
+    """
+    Builds an AnnotateImageResponse with a controllable number of annotations of every type
+    read by the formatters, filled with pseudo-random values.
+
+    Args:
+        num_text (int): Number of text annotations (the full-text block plus one per word).
+        num_faces (int): Number of faces, each with every landmark type.
+        num_labels (int): Number of labels.
+        num_logos (int): Number of logos.
+        num_objects (int): Number of localized objects.
+        num_colors (int): Number of dominant colors.
+        num_web_entities (int): Number of web entities, visually similar images and best guess labels.
+        seed (int): Seed of the pseudo-random values.
+
+    Returns:
+        vision.AnnotateImageResponse: The synthetic response.
+    """
+    from google.cloud import vision
+
+    rng = random.Random(seed)
+
+    def vertices():
+        x, y = rng.randint(0, 900), rng.randint(0, 900)
+        width, height = rng.randint(10, 100), rng.randint(10, 100)
+        return [{"x": x, "y": y}, {"x": x + width, "y": y}, {"x": x + width, "y": y + height}, {"x": x, "y": y + height}]
+
+    def normalized_vertices():
+        return [{"x": rng.random(), "y": rng.random()} for _ in range(4)]
+
+    def word():
+        return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10)))
+
+    words = [word() for _ in range(max(num_text - 1, 0))]
+    text_annotations = []
+    if num_text:
+        text_annotations.append({"description": " ".join(words), "locale": "en", "bounding_poly": {"vertices": vertices()}})
+        text_annotations.extend({"description": text, "bounding_poly": {"vertices": vertices()}} for text in words)
+
+    landmark_types = [landmark_type for landmark_type in vision.FaceAnnotation.Landmark.Type if landmark_type != 0]
+
+    return vision.AnnotateImageResponse(
+        text_annotations=text_annotations,
+        face_annotations=[{
+            "bounding_poly": {"vertices": vertices()},
+            "fd_bounding_poly": {"vertices": vertices()},
+            "landmarks": [
+                {"type_": landmark_type, "position": {"x": rng.random() * 1000, "y": rng.random() * 1000, "z": rng.random()}}
+                for landmark_type in landmark_types
+            ],
+            "roll_angle": rng.uniform(-45, 45),
+            "pan_angle": rng.uniform(-45, 45),
+            "tilt_angle": rng.uniform(-45, 45),
+            "detection_confidence": rng.random(),
+            "landmarking_confidence": rng.random(),
+            "joy_likelihood": rng.randint(0, 5),
+            "sorrow_likelihood": rng.randint(0, 5),
+            "anger_likelihood": rng.randint(0, 5),
+            "surprise_likelihood": rng.randint(0, 5),
+            "under_exposed_likelihood": rng.randint(0, 5),
+            "blurred_likelihood": rng.randint(0, 5),
+            "headwear_likelihood": rng.randint(0, 5),
+        } for _ in range(num_faces)],
+        label_annotations=[
+            {"description": word(), "score": rng.random(), "mid": f"/m/{rng.randint(0, 99999)}", "topicality": rng.random()}
+            for _ in range(num_labels)
+        ],
+        logo_annotations=[
+            {"description": word(), "score": rng.random(), "mid": f"/m/{rng.randint(0, 99999)}", "bounding_poly": {"vertices": vertices()}}
+            for _ in range(num_logos)
+        ],
+        localized_object_annotations=[
+            {"name": word(), "score": rng.random(), "mid": f"/m/{rng.randint(0, 99999)}", "bounding_poly": {"normalized_vertices": normalized_vertices()}}
+            for _ in range(num_objects)
+        ],
+        safe_search_annotation={
+            "adult": rng.randint(0, 5), "spoof": rng.randint(0, 5), "medical": rng.randint(0, 5),
+            "violence": rng.randint(0, 5), "racy": rng.randint(0, 5),
+        },
+        image_properties_annotation={"dominant_colors": {"colors": [
+            {"color": {"red": rng.randint(0, 255), "green": rng.randint(0, 255), "blue": rng.randint(0, 255)}, "score": rng.random(), "pixel_fraction": rng.random()}
+            for _ in range(num_colors)
+        ]}},
+        web_detection={
+            "web_entities": [{"entity_id": f"/m/{rng.randint(0, 99999)}", "score": rng.random() * 10, "description": word()} for _ in range(num_web_entities)],
+            "visually_similar_images": [{"url": f"https://example.com/{word()}.jpg"} for _ in range(num_web_entities)],
+            "best_guess_labels": [{"label": word(), "language_code": "en"} for _ in range(min(num_web_entities, 1))],
+        },
+    )
+
+
+class FakeBlob:
+    """
+    Stand-in for storage.Blob, holding its content in memory.
+    """
+
+    def __init__(self, bucket, name, data=b"", content_type=None, generation=1):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = content_type
+        self.generation = generation
+        self._set_data(data)
+
+    def _set_data(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.data = data
+        self.size = len(data)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+        self.crc32c = base64.b64encode(zlib.crc32(data).to_bytes(4, "big")).decode("ascii")
+        self.updated = datetime.datetime.now(datetime.timezone.utc)
+
+    def download_as_bytes(self, start=None, end=None, **kwargs):
+        # `end` is inclusive, like in the GCS client
+        if start is not None or end is not None:
+            return self.data[start or 0:None if end is None else end + 1]
+        return self.data
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        self._set_data(data)
+        self.content_type = content_type or self.content_type
+        self.generation += 1
+
+
+class FakeBlobIterator:
+    """
+    Stand-in for the page iterator returned by storage.Client.list_blobs.
+    `prefixes` is filled once the pages have been consumed.
+    """
+
+    def __init__(self, blobs, prefixes=(), page_size=1000, page_latency=0.0):
+        self._blobs = blobs
+        self._prefixes = set(prefixes)
+        self._page_size = page_size
+        self._page_latency = page_latency
+        self.prefixes = set()
+
+    @property
+    def pages(self):
+        for start in range(0, len(self._blobs), self._page_size):
+            if self._page_latency:
+                time.sleep(self._page_latency)
+            yield self._blobs[start:start + self._page_size]
+        self.prefixes = self._prefixes
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeBucket:
+    """
+    Stand-in for storage.Bucket.
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.blobs = {}
+
+    def blob(self, name):
+        return self.blobs.get(name) or FakeBlob(self, name, generation=0)
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def add_blob(self, name, data=b"", content_type=None):
+        blob = self.blobs.get(name)
+        if blob is None:
+            blob = self.blobs[name] = FakeBlob(self, name, data, content_type)
+        else:
+            blob.upload_from_string(data, content_type)
+        return blob
+
+    def list_blobs(self, prefix=None, delimiter=None, page_size=None, **kwargs):
+        prefix = prefix or ""
+        blobs = []
+        prefixes = set()
+        for name, blob in sorted(self.blobs.items()):
+            if not name.startswith(prefix):
+                continue
+            # Group the names below the next delimiter into a prefix, like GCS does
+            if delimiter and delimiter in name[len(prefix):]:
+                prefixes.add(name[:name.index(delimiter, len(prefix)) + len(delimiter)])
+            else:
+                blobs.append(blob)
+        return FakeBlobIterator(blobs, prefixes, page_size or 1000, self.client.page_latency)
+
+
+class FakeStorageClient:
+    """
+    In-process stand-in for the parts of storage.Client used by the pipelines.
+    Buckets are created on first access.
+
+    Args:
+        project (str): Project of the client.
+        page_latency (float): Seconds taken by each page of a listing.
+    """
+
+    def __init__(self, project=None, page_latency=0.0):
+        self.project = project
+        self.page_latency = page_latency
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name):
+        with self._lock:
+            if bucket_name not in self.buckets:
+                self.buckets[bucket_name] = FakeBucket(self, bucket_name)
+            return self.buckets[bucket_name]
+
+    def get_bucket(self, bucket_name):
+        return self.bucket(bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, FakeBucket) else self.bucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix, **kwargs)
+
+    def add_blob(self, bucket_name, name, data=b"", content_type=None):
+        with self._lock:
+            bucket = self.buckets.setdefault(bucket_name, FakeBucket(self, bucket_name))
+            return bucket.add_blob(name, data, content_type)
+
+
+class FakeOperation:
+    """
+    Stand-in for google.api_core.operation.Operation, done after `polls_until_done` calls to `done`.
+    """
+
+    def __init__(self, result=None, exception=None, polls_until_done=1):
+        self._result = result
+        self._exception = exception
+        self._polls_left = polls_until_done
+
+    def done(self):
+        self._polls_left -= 1
+        return self._polls_left <= 0
+
+    def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class FakeImageAnnotatorClient:
+    """
+    In-process stand-in for vision.ImageAnnotatorClient returning synthetic responses.
+
+    The response of an image is built by `build_synthetic_response` seeded with its URI, or its
+    content, so the same image always gets the same response. Images whose URI is in `error_uris` get an
+    INVALID_ARGUMENT error instead. Async batches write their output JSON files,
+    `output_config.batch_size` responses per file, into `storage_client`, like the Vision API
+    does in GCS.
+
+    Args:
+        storage_client (FakeStorageClient): Storage receiving the output of async batches.
+        error_uris (Iterable[str]): URIs of the images that fail.
+        polls_until_done (int): Number of polls before an async batch operation is done.
+        response_kwargs (dict): Arguments of `build_synthetic_response` controlling the payload.
+        latency (float): Seconds each call takes, on top of building the responses.
+        latency_jitter (float): Random extra seconds added to each call, up to this value.
+        error_rate (float): Fraction of the images failing with INVALID_ARGUMENT, always the
+            same ones.
+        transient_error_rate (float): Probability that an image fails with UNAVAILABLE on a
+            call, which the pipelines retry.
+        distinct_responses (int): Build this many responses once and hand out copies, so
+            building them does not weigh on benchmarks. None builds the response of every image.
+        seed (int): Seed of the latency jitter and of the transient errors.
+    """
+
+    def __init__(self, storage_client=None, error_uris=(), polls_until_done=1, response_kwargs=None, latency=0.0, latency_jitter=0.0, error_rate=0.0, transient_error_rate=0.0, distinct_responses=None, seed=0):
+        self.storage_client = storage_client
+        self.error_uris = set(error_uris)
+        self.polls_until_done = polls_until_done
+        self.response_kwargs = response_kwargs or {}
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.transient_error_rate = transient_error_rate
+        self.calls = 0
+        self.images = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self._responses = None
+        if distinct_responses:
+            self._responses = [build_synthetic_response(seed=index, **self.response_kwargs) for index in range(distinct_responses)]
+
+    def _annotate(self, request):
+        from google.cloud import vision
+
+        image_uri = request.image.source.image_uri
+
+        # Images sent as content are identified by their bytes
+        seed = zlib.crc32(image_uri.encode("utf-8") if image_uri else request.image.content)
+
+        with self._lock:
+            transient = self.transient_error_rate and self._rng.random() < self.transient_error_rate
+
+        if image_uri in self.error_uris or seed / 2 ** 32 < self.error_rate:
+            response = vision.AnnotateImageResponse(error={"code": 3, "message": f"Bad image data: {image_uri}"})
+        elif transient:
+            response = vision.AnnotateImageResponse(error={"code": 14, "message": "The service is currently unavailable"})
+        elif self._responses is not None:
+            response = vision.AnnotateImageResponse()
+            vision.AnnotateImageResponse.pb(response).CopyFrom(vision.AnnotateImageResponse.pb(self._responses[seed % len(self._responses)]))
+        else:
+            response = build_synthetic_response(seed=seed, **self.response_kwargs)
+        response.context.uri = image_uri
+        return response
+
+    def _wait(self):
+        if not (self.latency or self.latency_jitter):
+            return
+        with self._lock:
+            jitter = self._rng.uniform(0, self.latency_jitter)
+        time.sleep(self.latency + jitter)
+
+    def _count(self, requests):
+        with self._lock:
+            self.calls += 1
+            self.images += len(requests)
+
+    def annotate_image(self, request, **kwargs):
+        self._count([request])
+        self._wait()
+        return self._annotate(request)
+
+    def batch_annotate_images(self, requests, **kwargs):
+        from google.cloud import vision
+
+        self._count(requests)
+        self._wait()
+        return vision.BatchAnnotateImagesResponse(responses=[self._annotate(request) for request in requests])
+
+    def async_batch_annotate_images(self, requests, output_config, **kwargs):
+        from google.cloud import vision
+
+        self._count(requests)
+        responses = [self._annotate(request) for request in requests]
+
+        # Write the output files the way the Vision API names them
+        bucket_name, _, prefix = output_config.gcs_destination.uri[len("gs://"):].partition("/")
+        batch_size = output_config.batch_size or 20
+        for start in range(0, len(responses), batch_size):
+            chunk = responses[start:start + batch_size]
+            data = vision.BatchAnnotateImagesResponse.to_json(vision.BatchAnnotateImagesResponse(responses=chunk))
+            self.storage_client.add_blob(bucket_name, f"{prefix}output-{start + 1}-to-{start + len(chunk)}.json", data, "application/json")
+
+        return FakeOperation(polls_until_done=self.polls_until_done)
+
+
+class FakeClientRegistry:
+    """
+    Stand-in for `client_utils.ClientRegistry` handing out fake clients, so the pipelines can
+    run offline.
+
+    Args:
+        storage_client (FakeStorageClient): Storage client. A new one by default.
+        vision_client (FakeImageAnnotatorClient): Vision client. By default one writing its async
+            output into `storage_client`.
+        bigquery_client (FakeBigQueryClient): BigQuery client. A new one by default.
+    """
+
+    def __init__(self, storage_client=None, vision_client=None, bigquery_client=None):
+        self._storage_client = storage_client or FakeStorageClient()
+        self._vision_client = vision_client or FakeImageAnnotatorClient(self._storage_client)
+        self._bigquery_client = bigquery_client or FakeBigQueryClient()
+
+    def vision_client(self):
+        return self._vision_client
+
+    def storage_client(self):
+        return self._storage_client
+
+    def bigquery_client(self):
+        return self._bigquery_client
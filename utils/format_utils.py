@@ -3,36 +3,57 @@ from typing import List, Dict, Any
 import math
 
 
-def format_json(response, creative_id, creative_uri):
+def format_json(response, creative_id, creative_uri, features=None, ocr_mode="full"):
     """
-    Formats the response and writes it to BigQuery.
+    Formats the response into the output row of the creative.
 
     Args:
         response (object): Response object from the Vision API.
         creative_id (str): ID of the creative.
         creative_uri (str): URI of the creative.
-        config (dict): Configuration dictionary containing project_id and dataset_name.
+        features (list): Feature types requested to the Vision API. Only the columns of these
+            features are formatted. If None, every column is formatted.
+        ocr_mode (str): Entries of the `text_annotations` column, see `OCR_MODES`.
 
     Returns:
-        None
+        dict: The formatted creative data.
     """
     # Format the creative data
     creative_data = {
         "creative_id": str(creative_id),
         "creative_uri": str(creative_uri),
-        "localized_object_annotations": format_localized_object_annotations(response),
-        "face_annotations": format_face_annotations(response),
-        "logo_annotations": format_logo_annotations(response),
-        "label_annotations": format_label_annotations(response),
-        "text_annotations": format_text_annotations(response),
-        "search_safe_annotations": format_safe_search_annotations(response),
-        "dominant_color_annotations": format_dominant_color_annotations(response),
-        "web_detection_annotations": format_web_detection_annotations(response)
     }
+    for column, formatter in get_formatters(features, ocr_mode):
+        creative_data[column] = formatter(response)
 
     return creative_data
 
 
+def get_formatters(features=None, ocr_mode="full"):
+    """
+    Returns the output columns and formatters of the given features, in output order.
+
+    Args:
+        features (list): Feature types, as `vision.Feature.Type` values or names. If None, every
+            column is returned.
+        ocr_mode (str): Entries of the `text_annotations` column, see `OCR_MODES`.
+
+    Returns:
+        list: Pairs of column name and formatter function.
+    """
+    if ocr_mode not in OCR_MODES:
+        raise ValueError(f"Unknown OCR mode '{ocr_mode}'. Use one of: {', '.join(OCR_MODES)}")
+
+    if features is None:
+        feature_names = set(FEATURE_COLUMNS)
+    else:
+        feature_names = {vision.Feature.Type[feature].name if isinstance(feature, str) else vision.Feature.Type(feature).name for feature in features}
+
+    columns = {FEATURE_COLUMNS[name] for name in feature_names if name in FEATURE_COLUMNS}
+
+    return [(column, OCR_MODES[ocr_mode] if column == "text_annotations" else formatter) for column, formatter in COLUMN_FORMATTERS.items() if column in columns]
+
+
 # web detection annotations
 def format_web_detection_annotations(response):
     """
@@ -188,6 +209,105 @@ def format_text_annotations(response):
     return text_annotations
 
 
+# full text annotation
+def format_full_text_annotations(response):
+    """
+    Formats only the first text annotation from the response object, which holds the full
+    text detected in the image and its bounding box.
+
+    Args:
+        response (object): Response object containing text.
+
+    Returns:
+        list: List with the dictionary of the full text annotation.
+    """
+    text_annotations = []
+    for text in response.text_annotations[:1]:
+        # Extract relevant information and convert to appropriate types
+        data = {
+            "description": str(text.description),
+            "x0": float(text.bounding_poly.vertices[0].x),
+            "y0": float(text.bounding_poly.vertices[0].y),
+            "x1": float(text.bounding_poly.vertices[1].x),
+            "y1": float(text.bounding_poly.vertices[1].y),
+            "x2": float(text.bounding_poly.vertices[2].x),
+            "y2": float(text.bounding_poly.vertices[2].y),
+            "x3": float(text.bounding_poly.vertices[3].x),
+            "y3": float(text.bounding_poly.vertices[3].y),
+        }
+
+        # Append the formatted data to the list
+        text_annotations.append(data)
+
+    text_annotations = text_annotations if text_annotations else fill_empty_text_annotations()
+
+    return text_annotations
+
+
+# text annotations without geometry
+def format_text_word_annotations(response):
+    """
+    Formats the text annotations from the response object, without their bounding boxes.
+
+    Args:
+        response (object): Response object containing text.
+
+    Returns:
+        list: List of dictionaries containing formatted annotations.
+    """
+    # Iterate over each element in the response
+    text_annotations = []
+    for text in response.text_annotations:
+        # Extract relevant information and convert to appropriate types
+        data = {
+            "description": str(text.description),
+        }
+
+        # Append the formatted data to the list
+        text_annotations.append(data)
+
+    text_annotations = text_annotations if text_annotations else fill_empty_text_word_annotations()
+
+    return text_annotations
+
+
+# text annotations with packed geometry
+def format_packed_text_annotations(response):
+    """
+    Formats the text annotations from the response object, packing the four vertices of each
+    bounding box into a list of eight integers, `[x0, y0, x1, y1, x2, y2, x3, y3]`. The
+    vertices of the text annotations are whole pixels, so no precision is lost.
+
+    Args:
+        response (object): Response object containing text.
+
+    Returns:
+        list: List of dictionaries containing formatted annotations.
+    """
+    # Iterate over each element in the response
+    text_annotations = []
+    for text in response.text_annotations:
+        vertices = text.bounding_poly.vertices
+
+        # Extract relevant information and convert to appropriate types
+        data = {
+            "description": str(text.description),
+            "vertices": [
+                int(vertices[0].x), int(vertices[0].y),
+                int(vertices[1].x), int(vertices[1].y),
+                int(vertices[2].x), int(vertices[2].y),
+                int(vertices[3].x), int(vertices[3].y),
+            ],
+        }
+
+        # Append the formatted data to the list
+        text_annotations.append(data)
+
+    text_annotations = text_annotations if text_annotations else fill_empty_packed_text_annotations()
+
+    return text_annotations
+
+
 # label annotations
 def format_label_annotations(response):
     """
@@ -441,6 +561,37 @@ def fill_empty_text_annotations() -> List[Dict[str, Any]]:
     return [empty_data]
 
 
+def fill_empty_text_word_annotations() -> List[Dict[str, Any]]:
+    """
+    Creates a list with a dictionary representing empty text annotations without geometry.
+
+    Returns:
+        List[Dict[str, Any]]: List containing a dictionary with empty text annotations.
+    """
+    # format json
+    empty_data = {
+        "description": str('Not Found'),
+    }
+
+    return [empty_data]
+
+
+def fill_empty_packed_text_annotations() -> List[Dict[str, Any]]:
+    """
+    Creates a list with a dictionary representing empty text annotations with packed geometry.
+
+    Returns:
+        List[Dict[str, Any]]: List containing a dictionary with empty text annotations.
+    """
+    # format json
+    empty_data = {
+        "description": str('Not Found'),
+        "vertices": [0] * 8,
+    }
+
+    return [empty_data]
+
+
 def fill_empty_label_annotations() -> List[Dict[str, Any]]:
     """
     Creates a list with a dictionary representing empty label annotations.
@@ -557,6 +708,41 @@ def fill_empty_localized_object_annotations() -> List[Dict[str, Any]]:
     return [empty_data]
 
 
+# Output columns and their formatters, in output order
+COLUMN_FORMATTERS = {
+    "localized_object_annotations": format_localized_object_annotations,
+    "face_annotations": format_face_annotations,
+    "logo_annotations": format_logo_annotations,
+    "label_annotations": format_label_annotations,
+    "text_annotations": format_text_annotations,
+    "search_safe_annotations": format_safe_search_annotations,
+    "dominant_color_annotations": format_dominant_color_annotations,
+    "web_detection_annotations": format_web_detection_annotations,
+}
+
+# Formatter of the text_annotations column of each OCR mode: every entry with its bounding
+# box, the full text only, every entry without geometry, or with its bounding box packed
+OCR_MODES = {
+    "full": format_text_annotations,
+    "full_text": format_full_text_annotations,
+    "words": format_text_word_annotations,
+    "words_packed": format_packed_text_annotations,
+}
+
+# Output column filled by each Vision feature
+FEATURE_COLUMNS = {
+    "OBJECT_LOCALIZATION": "localized_object_annotations",
+    "FACE_DETECTION": "face_annotations",
+    "LOGO_DETECTION": "logo_annotations",
+    "LABEL_DETECTION": "label_annotations",
+    "TEXT_DETECTION": "text_annotations",
+    "DOCUMENT_TEXT_DETECTION": "text_annotations",
+    "SAFE_SEARCH_DETECTION": "search_safe_annotations",
+    "IMAGE_PROPERTIES": "dominant_color_annotations",
+    "WEB_DETECTION": "web_detection_annotations",
+}
+
+
 #######
 
 
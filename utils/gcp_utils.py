@@ -1,7 +1,45 @@
-import ndjson
-from google.cloud import bigquery
+import io
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.metrics_utils import get_metrics
 
-def write_to_bq(bq_client, dataset_name, table_name, table_data, write_disposition):
+
+def build_load_job_config(write_disposition, schema=None, source_format="NEWLINE_DELIMITED_JSON"):
+    """
+    Builds the configuration of the load jobs.
+
+    Parquet files are loaded with list inference, so the `list/element` groups pyarrow writes
+    for list columns map onto the REPEATED fields of the schema instead of wrapped records.
+
+    Args:
+        write_disposition (str): BigQuery write disposition.
+        schema (List[bigquery.SchemaField]): Explicit schema of the table. If None, the schema
+            is autodetected from the data.
+        source_format (str): Format of the loaded data.
+
+    Returns:
+        bigquery.LoadJobConfig: The load job configuration.
+    """
+    from google.cloud import bigquery
+
+    job_config = bigquery.LoadJobConfig()
+    job_config.create_disposition = 'CREATE_IF_NEEDED'
+    job_config.write_disposition = write_disposition
+    job_config.source_format = source_format
+    if source_format == "PARQUET":
+        parquet_options = bigquery.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        job_config.parquet_options = parquet_options
+    if schema is not None:
+        job_config.schema = schema
+    else:
+        job_config.autodetect = True
+
+    return job_config
+
+
+def write_to_bq(bq_client, dataset_name, table_name, table_data, write_disposition, schema=None):
     """
     Writes table data to BigQuery.
 
@@ -10,34 +48,219 @@ def write_to_bq(bq_client, dataset_name, table_name, table_data, write_dispositi
         dataset_name (str): Name of the dataset.
         table_name (str): Name of the table.
         table_data (list): List of table data.
+        schema (List[bigquery.SchemaField]): Explicit schema of the table. Autodetected if None.
 
     Returns:
         None
     """
     try:
-        # Set the table file name
-        table_file_name = f"{table_name}.json"
-
-        # Write table data to a JSON file
-        with open(table_file_name, 'w') as file:
-            ndjson.dump(table_data, file)
+        # Serialize the table data in memory
+        source_file = io.BytesIO("".join(json.dumps(row) + "\n" for row in table_data).encode("utf-8"))
 
         # Create dataset and table references
         dataset_ref = bq_client.dataset(dataset_name)
         table_ref = dataset_ref.table(table_name)
 
         # Configure the job for loading data into BigQuery
-        job_config = bigquery.LoadJobConfig()
-        job_config.create_disposition = 'CREATE_IF_NEEDED'
-        job_config.write_disposition = write_disposition
-        job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
-        job_config.autodetect = True
+        job_config = build_load_job_config(write_disposition, schema)
 
-        # Load the data from the file into the table
-        with open(table_file_name, "rb") as source_file:
-            job = bq_client.load_table_from_file(source_file, table_ref, job_config=job_config)
-            job.result()
+        # Load the data into the table
+        job = bq_client.load_table_from_file(source_file, table_ref, job_config=job_config)
+        job.result()
 
         print(f"Loaded {table_name} table")
     except Exception as e:
         print(f"ERROR - {table_name}: {e}")
+
+
+def load_files_to_bq(bq_client, dataset_name, table_name, file_paths, write_disposition, schema=None):
+    """
+    Loads local NDJSON or Parquet files into a BigQuery table.
+
+    The first file is loaded with `write_disposition` and the rest are appended.
+
+    Args:
+        bq_client (object): BigQuery client object.
+        dataset_name (str): Name of the dataset.
+        table_name (str): Name of the table.
+        file_paths (List[str]): Paths to the `.ndjson` or `.parquet` files.
+        write_disposition (str): BigQuery write disposition.
+        schema (List[bigquery.SchemaField]): Explicit schema of the table. Autodetected if None.
+    """
+    table_ref = bq_client.dataset(dataset_name).table(table_name)
+
+    for file_path in file_paths:
+        if file_path.endswith(".parquet"):
+            source_format = "PARQUET"
+        else:
+            source_format = "NEWLINE_DELIMITED_JSON"
+        job_config = build_load_job_config(write_disposition, schema, source_format)
+
+        with open(file_path, "rb") as source_file:
+            job = bq_client.load_table_from_file(source_file, table_ref, job_config=job_config)
+            job.result()
+
+        # Only the first file decides the write disposition of the table
+        write_disposition = 'WRITE_APPEND'
+
+    print(f"Loaded {len(file_paths)} files into {table_name} table")
+
+
+class BigQuerySink:
+    """
+    Streams rows into a BigQuery table while they are produced.
+
+    Rows are serialized into an in-memory NDJSON buffer and every `chunk_rows` rows or
+    `chunk_bytes` bytes the buffer is sent as a load job, without going through a local file.
+    Up to `max_pending_jobs` load jobs run in parallel; writing waits for the oldest one when
+    the limit is reached, so memory is bounded by `max_pending_jobs + 1` chunks.
+
+    The first chunk is loaded with `write_disposition` and waited for before any other job is
+    started, so a WRITE_TRUNCATE never races with the appends that follow it.
+
+    Loaded rows cannot be rolled back. With `load_on_flush`, the rows are only sent by `flush`,
+    e.g. at the checkpoints of an incremental run, so a crashed run never leaves rows in the
+    table whose blobs the manifest does not record.
+
+    Args:
+        bq_client (bigquery.Client): BigQuery client, or a fake exposing the same methods.
+        dataset_name (str): Name of the dataset.
+        table_name (str): Name of the table.
+        write_disposition (str): Write disposition of the first load job.
+        schema (List[bigquery.SchemaField]): Explicit schema of the table. Autodetected if None.
+        chunk_rows (int): Maximum number of rows per load job.
+        chunk_bytes (int): Maximum size in bytes of each load job.
+        max_pending_jobs (int): Maximum number of load jobs running at the same time.
+        load_on_flush (bool): Only send the rows when `flush` is called, ignoring `chunk_rows`
+            and `chunk_bytes`.
+    """
+
+    def __init__(self, bq_client, dataset_name, table_name, write_disposition='WRITE_APPEND', schema=None, chunk_rows=5000, chunk_bytes=50 * 1024 * 1024, max_pending_jobs=4, load_on_flush=False):
+        self.bq_client = bq_client
+        self.table_ref = bq_client.dataset(dataset_name).table(table_name)
+        self.table_name = table_name
+        self.write_disposition = write_disposition or 'WRITE_APPEND'
+        self.schema = schema
+        self.chunk_rows = chunk_rows
+        self.chunk_bytes = chunk_bytes
+        self.load_on_flush = load_on_flush
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.jobs_committed = 0
+        # Labels of the rows_emitted and bytes_emitted metrics, e.g. the table of the rows
+        self.metric_labels = {}
+
+        self._buffer = io.BytesIO()
+        self._buffer_rows = 0
+        self._first_job_done = False
+        self._pending = deque()
+        self._max_pending_jobs = max_pending_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_pending_jobs)
+
+    def write(self, row: dict):
+        """
+        Adds a row to the current chunk, sending the chunk once it is full.
+
+        Args:
+            row (dict): Row to write.
+        """
+        with get_metrics().timer("serialize"):
+            line = (json.dumps(row) + "\n").encode("utf-8")
+        self.write_line(line)
+
+    def write_line(self, line: bytes):
+        """
+        Adds a row already serialized as an NDJSON line, e.g. by a formatting process.
+
+        Args:
+            line (bytes): The line, ending with a newline.
+        """
+        metrics = get_metrics()
+        with metrics.timer("sink_write"):
+            self._buffer.write(line)
+            self._buffer_rows += 1
+            self.rows_written += 1
+            self.bytes_written += len(line)
+
+            if not self.load_on_flush and (self._buffer_rows >= self.chunk_rows or self._buffer.tell() >= self.chunk_bytes):
+                self._commit_chunk()
+        metrics.increment("rows_emitted", **self.metric_labels)
+        metrics.increment("bytes_emitted", len(line), **self.metric_labels)
+
+    def _commit_chunk(self):
+        """
+        Sends the current chunk as a load job.
+        """
+        if not self._buffer_rows:
+            return
+
+        chunk = self._buffer
+        chunk.seek(0)
+        self._buffer = io.BytesIO()
+        self._buffer_rows = 0
+
+        # The first job decides the write disposition of the table
+        if not self._first_job_done:
+            self._load(chunk, self.write_disposition)
+            self._first_job_done = True
+            return
+
+        # Wait for the oldest job if too many are running
+        while len(self._pending) >= self._max_pending_jobs:
+            self._pending.popleft().result()
+
+        self._pending.append(self._executor.submit(self._load, chunk, 'WRITE_APPEND'))
+
+    def _load(self, chunk, write_disposition):
+        job_config = build_load_job_config(write_disposition, self.schema)
+        with get_metrics().timer("bq_load"):
+            job = self.bq_client.load_table_from_file(chunk, self.table_ref, job_config=job_config)
+            job.result()
+        self.jobs_committed += 1
+
+    def flush(self):
+        """
+        Sends the current chunk and waits until every row written so far is in the table.
+        """
+        self._commit_chunk()
+        while self._pending:
+            self._pending.popleft().result()
+
+    def committed_files(self):
+        """
+        Loaded rows cannot be rolled back, so a resumed run keeps the table as is. Use
+        `load_on_flush` to only load the rows of a checkpoint.
+        """
+        return None
+
+    def abort(self):
+        """
+        Drops the rows not sent yet when they are only loaded by `flush`, so a failed run does
+        not load the rows written after its last checkpoint.
+        """
+        if self.load_on_flush:
+            self.rows_written -= self._buffer_rows
+            self._buffer = io.BytesIO()
+            self._buffer_rows = 0
+
+    def close(self):
+        """
+        Flushes the remaining rows and releases the worker threads.
+        """
+        try:
+            # Truncate a table that received no rows, rather than keep the rows of the previous run
+            if not self._first_job_done and self.write_disposition == 'WRITE_TRUNCATE' and self.schema is not None:
+                self._load(io.BytesIO(), self.write_disposition)
+                self._first_job_done = True
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+        print(f"Loaded {self.rows_written} rows into {self.table_name} table in {self.jobs_committed} load jobs")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        self.close()
@@ -0,0 +1,225 @@
+from google.cloud import vision
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+import io
+import threading
+
+# Bytes read from the start of a blob to find its dimensions before downloading it
+HEADER_BYTES = 64 * 1024
+
+
+def import_pillow():
+    """
+    Imports Pillow the first time an image has to be decoded, so the runs that never downscale
+    or deduplicate images do not load it.
+
+    Returns:
+        module: The `PIL.Image` module.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Pillow is required to decode images. Install it with `pip install Pillow`") from None
+    return Image
+
+
+def downscale_image(data: bytes, max_dimension: int = 1024, quality: int = 85) -> Tuple[bytes, float, float]:
+    """
+    Downscales an image so its largest side is at most `max_dimension` pixels, re-encoding it
+    as JPEG. Transparent pixels are flattened on white, and the EXIF data is kept so the
+    orientation of the image does not change.
+
+    Args:
+        data (bytes): Encoded image.
+        max_dimension (int): Maximum width and height in pixels.
+        quality (int): JPEG quality of the downscaled image.
+
+    Returns:
+        Tuple[bytes, float, float]: The encoded image, and the factors from its pixels to the
+            pixels of the original image along x and y. Images already small enough are
+            returned unchanged with factors of 1.
+    """
+    Image = import_pillow()
+
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        if max(width, height) <= max_dimension:
+            return data, 1.0, 1.0
+
+        exif = image.info.get("exif")
+
+        # Let the JPEG decoder skip the detail that is thrown away anyway
+        image.draft("RGB", (max_dimension, max_dimension))
+
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        else:
+            image = image.convert("RGB")
+
+        image.thumbnail((max_dimension, max_dimension), getattr(Image, "Resampling", Image).LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, **({"exif": exif} if exif else {}))
+
+    return output.getvalue(), width / image.width, height / image.height
+
+
+def _scale_vertices(bounding_poly, scale_x, scale_y):
+    for vertex in bounding_poly.vertices:
+        vertex.x = round(vertex.x * scale_x)
+        vertex.y = round(vertex.y * scale_y)
+
+
+def rescale_response(response, scale_x: float, scale_y: float):
+    """
+    Scales the pixel coordinates of a response in place, e.g. from a downscaled image back to
+    the original one. Normalized vertices do not depend on the size of the image and are kept.
+
+    Args:
+        response (object): Response from the Vision API, either the proto-plus
+            `vision.AnnotateImageResponse` or its underlying protobuf message.
+        scale_x (float): Factor applied to the x coordinates.
+        scale_y (float): Factor applied to the y coordinates.
+
+    Returns:
+        object: The same response.
+    """
+    pb = vision.AnnotateImageResponse.pb(response) if isinstance(response, vision.AnnotateImageResponse) else response
+
+    for annotations in (pb.text_annotations, pb.logo_annotations, pb.landmark_annotations):
+        for annotation in annotations:
+            _scale_vertices(annotation.bounding_poly, scale_x, scale_y)
+
+    for face in pb.face_annotations:
+        _scale_vertices(face.bounding_poly, scale_x, scale_y)
+        _scale_vertices(face.fd_bounding_poly, scale_x, scale_y)
+        for landmark in face.landmarks:
+            landmark.position.x *= scale_x
+            landmark.position.y *= scale_y
+
+    for crop_hint in pb.crop_hints_annotation.crop_hints:
+        _scale_vertices(crop_hint.bounding_poly, scale_x, scale_y)
+
+    for page in pb.full_text_annotation.pages:
+        page.width = round(page.width * scale_x)
+        page.height = round(page.height * scale_y)
+        for block in page.blocks:
+            _scale_vertices(block.bounding_box, scale_x, scale_y)
+            for paragraph in block.paragraphs:
+                _scale_vertices(paragraph.bounding_box, scale_x, scale_y)
+                for word in paragraph.words:
+                    _scale_vertices(word.bounding_box, scale_x, scale_y)
+                    for symbol in word.symbols:
+                        _scale_vertices(symbol.bounding_box, scale_x, scale_y)
+
+    return response
+
+
+class ImagePreprocessor:
+    """
+    Downscales the images larger than `max_dimension` before they are sent to the Vision API.
+
+    The first HEADER_BYTES of each blob are range-read to find its dimensions. Images small
+    enough are still sent by URI, without downloading them. The others are downloaded,
+    downscaled and sent as `image.content`, and the coordinates of their responses have to be
+    scaled back with `rescale_response`.
+
+    Args:
+        storage_client (storage.Client): Client for GCS.
+        max_dimension (int): Maximum width and height in pixels of the images sent.
+        quality (int): JPEG quality of the downscaled images.
+        workers (int): Number of blobs read at the same time for each batch.
+    """
+
+    def __init__(self, storage_client, max_dimension=1024, quality=85, workers=8):
+        self._image = import_pillow()
+        self.storage_client = storage_client
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.downscaled = 0
+        self.unchanged = 0
+        self.bytes_saved = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+
+    @property
+    def cache_variant(self) -> str:
+        """
+        Identifies the preprocessing in the annotation cache keys.
+        """
+        return f"max{self.max_dimension}q{self.quality}"
+
+    def _blob(self, image_uri):
+        bucket_name, _, name = image_uri[len("gs://"):].partition("/")
+        return self.storage_client.bucket(bucket_name).blob(name)
+
+    def prepare(self, image_uri: str) -> Tuple[Optional[bytes], float, float]:
+        """
+        Prepares an image to be sent to the Vision API.
+
+        Args:
+            image_uri (str): The gs:// URI of the image.
+
+        Returns:
+            Tuple[Optional[bytes], float, float]: The content to send, or None to send the URI,
+                and the factors from the pixels sent to the original pixels along x and y.
+        """
+        blob = self._blob(image_uri)
+
+        # Small images keep being fetched by the Vision API
+        try:
+            with self._image.open(io.BytesIO(blob.download_as_bytes(start=0, end=HEADER_BYTES - 1))) as header:
+                if max(header.size) <= self.max_dimension:
+                    with self._lock:
+                        self.unchanged += 1
+                    return None, 1.0, 1.0
+        except self._image.DecompressionBombError:
+            # Never download and decode an image whose header already claims too many pixels
+            with self._lock:
+                self.unchanged += 1
+            return None, 1.0, 1.0
+        except (OSError, SyntaxError, ValueError):
+            # The header alone was not enough, decide on the full image
+            pass
+
+        data = blob.download_as_bytes()
+        try:
+            content, scale_x, scale_y = downscale_image(data, self.max_dimension, self.quality)
+        except (OSError, SyntaxError, ValueError, self._image.DecompressionBombError):
+            # Let the Vision API report the images that cannot be decoded
+            with self._lock:
+                self.unchanged += 1
+            return None, 1.0, 1.0
+
+        with self._lock:
+            if content is not data:
+                self.downscaled += 1
+                self.bytes_saved += len(data) - len(content)
+            else:
+                self.unchanged += 1
+
+        # The full image was downloaded anyway
+        return content, scale_x, scale_y
+
+    def prepare_all(self, image_uris: List[str]) -> List[Tuple[Optional[bytes], float, float]]:
+        """
+        Prepares a batch of images, several at a time.
+
+        Args:
+            image_uris (List[str]): The gs:// URIs of the images.
+
+        Returns:
+            List[Tuple[Optional[bytes], float, float]]: The result of `prepare` for each image.
+        """
+        return list(self._executor.map(self.prepare, image_uris))
+
+    def summary(self) -> str:
+        """
+        Returns a one-line summary of the preprocessing.
+        """
+        return f"{self.downscaled} images downscaled ({self.bytes_saved / 1024 / 1024:.1f} MiB saved), {self.unchanged} sent unchanged"
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,308 @@
+from collections import Counter
+from typing import Iterator, List
+import datetime
+import fnmatch
+import os
+import queue
+import threading
+from utils.shard_utils import shard_of, validate_shard
+
+# Extensions of the image formats accepted by the Vision API, used when a blob has no content type
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".jfif", ".png", ".gif", ".bmp", ".webp", ".ico", ".raw"}
+
+# Content types sent by tools that do not detect the type of the uploaded file
+GENERIC_CONTENT_TYPES = {"", "application/octet-stream", "binary/octet-stream"}
+
+# Only the blob properties read by the pipelines are requested, which shrinks every listing page
+LIST_FIELDS = "items(name,size,contentType,md5Hash,crc32c,generation,updated),prefixes,nextPageToken"
+
+
+class BlobFilter:
+    """
+    Decides which blobs of a bucket listing are sent to the Vision API.
+
+    Folder markers (names ending with "/"), hidden files such as `.DS_Store`, and objects below
+    `min_size` are always rejected. A blob must then match every filter that is set. The content
+    type of the blob is checked against `content_types`; blobs without a meaningful content type
+    are checked against IMAGE_EXTENSIONS instead.
+
+    The number of rejected blobs is counted per reason in `rejected`. A filter can be shared by
+    the threads of a listing or of an event handler, the counts are updated under a lock.
+
+    Args:
+        prefix (str): Only list the blobs whose name starts with this prefix.
+        glob (str): fnmatch pattern matched against the full blob name, e.g. "*/banners/*.png".
+        content_types (List[str]): Accepted content types or content type prefixes ending with
+            "/", e.g. ["image/"] or ["image/png", "image/jpeg"]. None accepts any content type.
+        min_size (int): Minimum size in bytes. Defaults to 1, which rejects empty objects.
+        max_size (int): Maximum size in bytes. None disables the limit.
+        updated_after (Union[datetime.datetime, str]): Only accept blobs updated after this time.
+            Naive datetimes and ISO strings without offset are taken as UTC.
+        num_shards (int): Number of workers the bucket is split across.
+        shard_index (int): Shard of this worker. Only the blobs whose name hashes to this shard
+            are accepted, see `shard_utils.shard_of`.
+    """
+
+    def __init__(self, prefix=None, glob=None, content_types=("image/",), min_size=1, max_size=None, updated_after=None, num_shards=1, shard_index=0):
+        validate_shard(num_shards, shard_index)
+
+        self.prefix = prefix or ""
+        self.glob = glob
+        self.content_types = list(content_types) if content_types else None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.updated_after = parse_datetime(updated_after) if updated_after else None
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.accepted = 0
+        self.rejected = Counter()
+        self._lock = threading.Lock()
+
+    def rejection_reason(self, blob):
+        """
+        Returns why the blob is rejected, or None if it is accepted.
+
+        Args:
+            blob (storage.Blob): Blob of the listing.
+
+        Returns:
+            str: The reason of the rejection, or None.
+        """
+        name = blob.name
+        if name.endswith("/"):
+            return "folder"
+        if os.path.basename(name).startswith("."):
+            return "hidden"
+        size = blob.size or 0
+        if size < self.min_size:
+            return "size"
+        if self.max_size is not None and size > self.max_size:
+            return "size"
+        if not name.startswith(self.prefix):
+            return "prefix"
+        if self.glob and not fnmatch.fnmatchcase(name, self.glob):
+            return "glob"
+        if self.content_types is not None and not self._is_accepted_type(blob):
+            return "content_type"
+        if self.updated_after is not None and (blob.updated is None or blob.updated <= self.updated_after):
+            return "updated"
+        if self.num_shards > 1 and shard_of(name, self.num_shards) != self.shard_index:
+            return "shard"
+        return None
+
+    def _is_accepted_type(self, blob):
+        content_type = (blob.content_type or "").split(";")[0].strip().lower()
+
+        # Fall back to the extension when the content type says nothing about the file
+        if content_type in GENERIC_CONTENT_TYPES:
+            return os.path.splitext(blob.name)[1].lower() in IMAGE_EXTENSIONS
+
+        return any(
+            content_type.startswith(accepted) if accepted.endswith("/") else content_type == accepted
+            for accepted in self.content_types
+        )
+
+    def accepts(self, blob) -> bool:
+        """
+        Checks a blob and counts the result.
+
+        Args:
+            blob (storage.Blob): Blob of the listing.
+
+        Returns:
+            bool: True if the blob has to be annotated.
+        """
+        reason = self.rejection_reason(blob)
+        with self._lock:
+            if reason is None:
+                self.accepted += 1
+            else:
+                self.rejected[reason] += 1
+        return reason is None
+
+    def summary(self) -> str:
+        """
+        Returns a one-line summary of the accepted and rejected blobs.
+        """
+        rejected = ", ".join(f"{count} {reason}" for reason, count in sorted(self.rejected.items())) or "none"
+        return f"{self.accepted} blobs accepted, rejected: {rejected}"
+
+
+def parse_datetime(value) -> datetime.datetime:
+    """
+    Parses a datetime or ISO string into a timezone-aware datetime, assuming UTC when no
+    offset is given.
+
+    Args:
+        value (Union[datetime.datetime, str]): The datetime.
+
+    Returns:
+        datetime.datetime: The timezone-aware datetime.
+    """
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def iter_pages(iterator) -> Iterator[list]:
+    """
+    Iterates a listing page by page. Plain lists are a single page.
+    """
+    pages = getattr(iterator, "pages", None)
+    if pages is None:
+        yield list(iterator)
+        return
+    for page in pages:
+        yield list(page)
+
+
+def iter_blobs(iterator) -> Iterator:
+    """
+    Iterates the blobs of a listing page by page, so every page is requested only when the
+    previous one is consumed.
+    """
+    for page in iter_pages(iterator):
+        yield from page
+
+
+def discover_prefixes(storage_client, bucket_name, shard_prefixes: List[str], prefix="", depth=1, delimiter="/") -> Iterator:
+    """
+    Splits the namespace under `prefix` into the "folders" found `depth` levels down, listing
+    one level at a time with a delimiter.
+
+    The prefixes of the shards are appended to `shard_prefixes` once the listing is consumed.
+    The blobs found directly in the levels above them belong to no shard and are yielded while
+    listing, so a bucket without folders is never held in memory.
+
+    Args:
+        storage_client (storage.Client): Client for GCS.
+        bucket_name (str): Name of the bucket.
+        shard_prefixes (List[str]): Receives the prefixes of the shards.
+        prefix (str): Prefix to split.
+        depth (int): Number of levels to descend.
+        delimiter (str): Delimiter of the levels.
+
+    Yields:
+        storage.Blob: The blobs outside of the shards.
+    """
+    level_prefixes = [prefix]
+    for _ in range(depth):
+        next_prefixes = []
+        for level_prefix in level_prefixes:
+            iterator = storage_client.list_blobs(bucket_name, prefix=level_prefix, delimiter=delimiter, fields=LIST_FIELDS)
+            yield from iter_blobs(iterator)
+            # The prefixes are only known once every page has been listed
+            next_prefixes.extend(sorted(getattr(iterator, "prefixes", ())))
+        level_prefixes = next_prefixes
+        if not level_prefixes:
+            break
+
+    shard_prefixes.extend(level_prefixes)
+
+
+def list_blobs_parallel(storage_client, bucket_name, prefixes: List[str], workers: int, max_pending_pages: int = 16) -> Iterator:
+    """
+    Lists several prefixes at the same time, one thread per prefix up to `workers`.
+
+    Pages are handed over through a bounded queue, so at most `max_pending_pages` pages wait
+    to be consumed. Blobs of different prefixes are interleaved.
+
+    Args:
+        storage_client (storage.Client): Client for GCS.
+        bucket_name (str): Name of the bucket.
+        prefixes (List[str]): Prefixes to list. They must not overlap.
+        workers (int): Maximum number of prefixes listed at the same time.
+        max_pending_pages (int): Maximum number of listed pages waiting to be consumed.
+
+    Yields:
+        storage.Blob: The blobs under the prefixes.
+    """
+    pages = queue.Queue(maxsize=max_pending_pages)
+    remaining = queue.Queue()
+    for prefix in prefixes:
+        remaining.put(prefix)
+    stop = threading.Event()
+    done = object()
+
+    def list_prefixes():
+        try:
+            while not stop.is_set():
+                try:
+                    prefix = remaining.get_nowait()
+                except queue.Empty:
+                    return
+                iterator = storage_client.list_blobs(bucket_name, prefix=prefix, fields=LIST_FIELDS)
+                for page in iter_pages(iterator):
+                    # Give up on the page if the consumer went away
+                    while not stop.is_set():
+                        try:
+                            pages.put(page, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(done)
+
+    threads = [threading.Thread(target=list_prefixes, daemon=True) for _ in range(max(1, min(workers, len(prefixes))))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            page = pages.get()
+            if page is done:
+                running -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        stop.set()
+        # Unblock the threads still waiting for a free slot
+        while any(thread.is_alive() for thread in threads):
+            try:
+                pages.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def list_image_blobs(storage_client, bucket_name, blob_filter: BlobFilter = None, workers: int = 1, shard_depth: int = 1) -> Iterator:
+    """
+    Lists the blobs of a bucket that have to be annotated.
+
+    With `workers` greater than one, the namespace under the filter prefix is split into the
+    prefixes found `shard_depth` levels down, and the prefixes are listed in parallel instead of
+    as a single paginated stream.
+
+    Args:
+        storage_client (storage.Client): Client for GCS.
+        bucket_name (str): Name of the bucket.
+        blob_filter (BlobFilter): Filter of the blobs. Defaults to images of any size above zero.
+        workers (int): Maximum number of prefixes listed at the same time.
+        shard_depth (int): Number of "folder" levels used to split the listing.
+
+    Yields:
+        storage.Blob: The accepted blobs.
+    """
+    blob_filter = blob_filter or BlobFilter()
+
+    if workers > 1:
+        shard_prefixes = []
+        for blob in discover_prefixes(storage_client, bucket_name, shard_prefixes, blob_filter.prefix, shard_depth):
+            if blob_filter.accepts(blob):
+                yield blob
+        print(f"Listing {len(shard_prefixes)} prefixes with {workers} workers")
+        blobs = list_blobs_parallel(storage_client, bucket_name, shard_prefixes, workers)
+    else:
+        blobs = iter_blobs(storage_client.list_blobs(bucket_name, prefix=blob_filter.prefix, fields=LIST_FIELDS))
+
+    for blob in blobs:
+        if blob_filter.accepts(blob):
+            yield blob
+
+    print(f"Listing: {blob_filter.summary()}")
@@ -0,0 +1,362 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Iterator, Tuple
+import bisect
+import cProfile
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefix of the metric names in the OpenMetrics output
+NAMESPACE = "vision_pipeline"
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets, with their count, sum and extremes.
+
+    Args:
+        buckets (Tuple[float]): Upper bounds of the buckets, in increasing order. Values above
+            the last one fall in an implicit `+Inf` bucket.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile, interpolating linearly inside its bucket.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = max(self.buckets[index - 1], self.min) if index else self.min
+                upper = min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "min": self.min,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Profiler:
+    """
+    cProfile hooks around the hot functions of the pipeline, enabled by name.
+
+    Each thread profiles its own calls, and the profiles of a hook are merged when they are
+    written. Only one profiler can be active at a time on Python 3.12 and later, so calls
+    overlapping another profiled call are then skipped.
+
+    Args:
+        names (Iterable[str]): Hooks to profile, e.g. "vision_call", "format" and "sink_write".
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.names = set(names)
+        self.skipped = 0
+        self._profiles = defaultdict(list)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hook(self, name: str):
+        """
+        Profiles the code of the block if `name` is enabled.
+        """
+        if name not in self.names or getattr(self._local, "active", False):
+            yield
+            return
+
+        profiles = getattr(self._local, "profiles", None)
+        if profiles is None:
+            profiles = self._local.profiles = {}
+        profile = profiles.get(name)
+        if profile is None:
+            profile = profiles[name] = cProfile.Profile()
+            with self._lock:
+                self._profiles[name].append(profile)
+
+        try:
+            profile.enable()
+        except ValueError:
+            with self._lock:
+                self.skipped += 1
+            yield
+            return
+
+        self._local.active = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.active = False
+
+    def dump(self, directory: str) -> list:
+        """
+        Writes the merged profile of each hook to `{directory}/{name}.prof`, readable with
+        `python -m pstats` or snakeviz.
+
+        Returns:
+            list: Paths to the profile files.
+        """
+        import pstats
+
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        with self._lock:
+            for name, profiles in sorted(self._profiles.items()):
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                path = os.path.join(directory, f"{name}.prof")
+                stats.dump_stats(path)
+                paths.append(path)
+        return paths
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms of a run, reported as JSON or in the OpenMetrics text
+    format.
+
+    Counters and histograms are identified by a name and optional labels, e.g.
+    `increment("vision_images", 16)` or `observe("vision_call_seconds", 0.8, features="creative")`.
+    Time spent in each stage of the pipeline is accumulated in the `stage_seconds` counter.
+
+    Args:
+        profiler (Profiler): cProfile hooks. None disables profiling.
+    """
+
+    def __init__(self, profiler: Profiler = None):
+        self.profiler = profiler
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """
+        Adds `value` to a counter.
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Adds a value to a histogram.
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name: str, **labels) -> float:
+        """
+        Returns the value of a counter.
+        """
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes the duration of the block in the `{name}_seconds` histogram and adds it to
+        `stage_seconds{stage=name}`. The block is profiled when the `name` hook is enabled.
+        """
+        with self.profiler.hook(name) if self.profiler is not None else nullcontext():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                elapsed = time.perf_counter() - start
+                self.observe(f"{name}_seconds", elapsed, **labels)
+                self.increment("stage_seconds", elapsed, stage=name)
+
+    def timed_iter(self, iterable: Iterable, stage: str) -> Iterator:
+        """
+        Yields the elements of a lazy iterable, e.g. the bucket listing, accumulating the time
+        spent producing them in `stage_seconds{stage=...}`.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                self.increment("stage_seconds", time.perf_counter() - start, stage=stage)
+                return
+            self.increment("stage_seconds", time.perf_counter() - start, stage=stage)
+            yield element
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def report(self) -> dict:
+        """
+        Returns the run report: elapsed time, throughput, counters and histogram summaries.
+        """
+        elapsed = self.elapsed
+        with self._lock:
+            counters = defaultdict(dict)
+            for (name, key), value in sorted(self._counters.items()):
+                counters[name][_format_labels(key) or "total"] = value
+            histograms = defaultdict(dict)
+            for (name, key), histogram in sorted(self._histograms.items()):
+                histograms[name][_format_labels(key) or "total"] = histogram.summary()
+
+        rows = counters.get("rows_emitted", {}).get("total", 0)
+        return {
+            "start_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.start_time)),
+            "elapsed_seconds": elapsed,
+            "images_per_second": rows / elapsed if elapsed else 0.0,
+            "counters": dict(counters),
+            "histograms": dict(histograms),
+        }
+
+    def write_report(self, path: str):
+        """
+        Writes the run report as JSON.
+        """
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def to_openmetrics(self) -> str:
+        """
+        Renders every counter and histogram in the OpenMetrics text format.
+        """
+        lines = []
+        with self._lock:
+            counter_names = sorted({name for name, _ in self._counters})
+            for name in counter_names:
+                lines.append(f"# TYPE {NAMESPACE}_{name} counter")
+                for (counter_name, key), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{NAMESPACE}_{name}_total{_format_labels(key)} {value}")
+
+            histogram_names = sorted({name for name, _ in self._histograms})
+            for name in histogram_names:
+                lines.append(f"# TYPE {NAMESPACE}_{name} histogram")
+                for (histogram_name, key), histogram in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{NAMESPACE}_{name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                    lines.append(f"{NAMESPACE}_{name}_count{_format_labels(key)} {histogram.count}")
+                    lines.append(f"{NAMESPACE}_{name}_sum{_format_labels(key)} {histogram.sum}")
+
+        lines.append(f"# TYPE {NAMESPACE}_elapsed_seconds gauge")
+        lines.append(f"{NAMESPACE}_elapsed_seconds {self.elapsed}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_openmetrics(self, path: str):
+        """
+        Writes the metrics in the OpenMetrics text format, e.g. for the textfile collector of
+        the Prometheus node exporter.
+        """
+        with open(path + ".tmp", "w") as file:
+            file.write(self.to_openmetrics())
+        os.replace(path + ".tmp", path)
+
+    def serve(self, port: int) -> "ThreadingHTTPServer":
+        """
+        Serves the metrics in the OpenMetrics text format on `http://0.0.0.0:{port}/metrics`
+        from a background thread, until `shutdown` is called on the returned server.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.to_openmetrics().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# Registry of the current run, replaced by `start_run`
+_metrics = MetricsRegistry()
+
+
+def get_metrics() -> MetricsRegistry:
+    """
+    Returns the metrics registry of the current run.
+    """
+    return _metrics
+
+
+def start_run(profile_functions: Iterable[str] = ()) -> MetricsRegistry:
+    """
+    Starts collecting the metrics of a new run, so each run reports only its own.
+
+    Args:
+        profile_functions (Iterable[str]): cProfile hooks to enable.
+
+    Returns:
+        MetricsRegistry: The registry of the run.
+    """
+    global _metrics
+    _metrics = MetricsRegistry(Profiler(profile_functions) if profile_functions else None)
+    return _metrics
@@ -0,0 +1,164 @@
+from google.cloud import vision
+from typing import Any, Dict, List, Tuple
+import functools
+from utils.fast_format_utils import RECORD_FORMATTERS
+from utils.format_utils import OCR_MODES, get_formatters
+
+# Normalized layout of the output.
+#
+# Instead of one wide nested row per creative, where every missing annotation type is padded
+# with "Not Found" placeholders, each creative has a slim row in the `creatives` table and
+# each of its annotations a row in the child table of its type, keyed by `creative_id` and
+# ordered by `position`. An annotation type missing from the response produces no rows. The
+# records are formatted by the same functions as `format_json_fast`.
+
+# Table holding one row per creative, with its safe search likelihoods
+CREATIVES_TABLE = "creatives"
+
+# Child tables filled by each output column of `format_utils.COLUMN_FORMATTERS`
+COLUMN_TABLES = {
+    "localized_object_annotations": ["objects"],
+    "face_annotations": ["faces", "face_landmarks"],
+    "logo_annotations": ["logos"],
+    "label_annotations": ["labels"],
+    "text_annotations": ["text"],
+    "dominant_color_annotations": ["colors"],
+    "web_detection_annotations": ["web_entities", "web_best_guess_labels", "web_similar_images"],
+}
+
+
+def _child_rows(creative_id, elements, record_formatter) -> List[Dict[str, Any]]:
+    """
+    Formats the elements of a repeated field into child rows.
+    """
+    return [{"creative_id": creative_id, "position": position, **record_formatter(element)} for position, element in enumerate(elements)]
+
+
+def _list_tables(table, field_name, record_formatter):
+    """
+    Builds the formatter of a child table holding one row per element of a repeated field.
+    """
+    def format_tables(pb, creative_id):
+        return {table: _child_rows(creative_id, getattr(pb, field_name), record_formatter)}
+    return format_tables
+
+
+def _format_full_text_tables(pb, creative_id):
+    return {"text": _child_rows(creative_id, pb.text_annotations[:1], RECORD_FORMATTERS["format_text"])}
+
+
+def _format_face_tables(pb, creative_id):
+    format_face = RECORD_FORMATTERS["format_face"]
+    faces = []
+    face_landmarks = []
+    for position, face in enumerate(pb.face_annotations):
+        row = format_face(face, position + 1)
+
+        # The position replaces the "face1", "face2"... names of the nested layout
+        del row["name"]
+        for landmark_position, landmark in enumerate(row.pop("landmarks")):
+            face_landmarks.append({"creative_id": creative_id, "face_position": position, "position": landmark_position, **landmark})
+
+        faces.append({"creative_id": creative_id, "position": position, **row})
+
+    return {"faces": faces, "face_landmarks": face_landmarks}
+
+
+def _format_color_tables(pb, creative_id):
+    return {"colors": _child_rows(creative_id, pb.image_properties_annotation.dominant_colors.colors, RECORD_FORMATTERS["format_dominant_color"])}
+
+
+def _format_web_tables(pb, creative_id):
+    web_detection = pb.web_detection
+    return {
+        "web_entities": _child_rows(creative_id, web_detection.web_entities, RECORD_FORMATTERS["format_web_entity"]),
+        "web_best_guess_labels": _child_rows(creative_id, web_detection.best_guess_labels, RECORD_FORMATTERS["format_best_guess_label"]),
+        "web_similar_images": _child_rows(creative_id, web_detection.visually_similar_images, RECORD_FORMATTERS["format_visually_similar_image"]),
+    }
+
+
+# Formatter of the child tables of each output column
+TABLE_FORMATTERS = {
+    "localized_object_annotations": _list_tables("objects", "localized_object_annotations", RECORD_FORMATTERS["format_localized_object"]),
+    "face_annotations": _format_face_tables,
+    "logo_annotations": _list_tables("logos", "logo_annotations", RECORD_FORMATTERS["format_logo"]),
+    "label_annotations": _list_tables("labels", "label_annotations", RECORD_FORMATTERS["format_label"]),
+    "text_annotations": _list_tables("text", "text_annotations", RECORD_FORMATTERS["format_text"]),
+    "dominant_color_annotations": _format_color_tables,
+    "web_detection_annotations": _format_web_tables,
+}
+
+# Formatter of the text table of each OCR mode of `format_utils.OCR_MODES`
+TEXT_TABLE_FORMATTERS = {
+    "full": TABLE_FORMATTERS["text_annotations"],
+    "full_text": _format_full_text_tables,
+    "words": _list_tables("text", "text_annotations", RECORD_FORMATTERS["format_text_word"]),
+    "words_packed": _list_tables("text", "text_annotations", RECORD_FORMATTERS["format_packed_text"]),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_columns(features) -> Tuple[str, ...]:
+    """
+    Returns the output columns of the given features, cached per feature set.
+    """
+    return tuple(column for column, _ in get_formatters(features))
+
+
+def normalized_tables(features=None) -> List[str]:
+    """
+    Returns the tables of the normalized layout written for the given features, the
+    `creatives` table first.
+
+    Args:
+        features (list): Feature types requested to the Vision API. If None, every table is
+            returned.
+
+    Returns:
+        List[str]: Names of the tables.
+    """
+    columns = _get_columns(None if features is None else tuple(features))
+    return [CREATIVES_TABLE] + [table for column in columns for table in COLUMN_TABLES.get(column, [])]
+
+
+def format_normalized(response, creative_id, creative_uri, features=None, ocr_mode="full"):
+    """
+    Formats the response into the rows of the normalized layout.
+
+    The creative row holds `creative_id`, `creative_uri` and the safe search likelihoods, plus
+    the rows of each child table under the name of the table. `sink_utils.NormalizedSink`
+    writes them to their own tables.
+
+    Args:
+        response (object): Response from the Vision API, either the proto-plus
+            `vision.AnnotateImageResponse` or its underlying protobuf message.
+        creative_id (str): ID of the creative.
+        creative_uri (str): URI of the creative.
+        features (list): Feature types requested to the Vision API. Only the tables and
+            columns of these features are formatted. If None, every table is formatted.
+        ocr_mode (str): Rows of the `text` table, see `format_utils.OCR_MODES`.
+
+    Returns:
+        dict: The creative row, with the rows of its child tables.
+    """
+    if ocr_mode not in OCR_MODES:
+        raise ValueError(f"Unknown OCR mode '{ocr_mode}'. Use one of: {', '.join(OCR_MODES)}")
+
+    # Read the protobuf message directly instead of going through the proto-plus wrappers
+    pb = vision.AnnotateImageResponse.pb(response) if isinstance(response, vision.AnnotateImageResponse) else response
+
+    creative_id = str(creative_id)
+    creative_data = {
+        "creative_id": creative_id,
+        "creative_uri": str(creative_uri),
+    }
+    for column in _get_columns(None if features is None else tuple(features)):
+        # Safe search has exactly one value per likelihood, kept on the creative row
+        if column == "search_safe_annotations":
+            creative_data.update(RECORD_FORMATTERS["format_safe_search"](pb.safe_search_annotation))
+        elif column == "text_annotations":
+            creative_data.update(TEXT_TABLE_FORMATTERS[ocr_mode](pb, creative_id))
+        else:
+            creative_data.update(TABLE_FORMATTERS[column](pb, creative_id))
+
+    return creative_data
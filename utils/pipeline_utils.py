@@ -0,0 +1,212 @@
+from google.cloud import vision
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Tuple
+import functools
+import json
+import queue
+import threading
+import time
+from utils.metrics_utils import get_metrics
+from utils.fast_format_utils import format_json_fast
+from utils.format_utils import OCR_MODES, format_json
+from utils.normalized_format_utils import format_normalized
+
+FORMATTERS = {"fast": format_json_fast, "reference": format_json}
+
+# Marks the end of the stream in the queue between two stages
+_END = object()
+
+
+def get_row_formatter(formatter: str = "fast", layout: str = "nested", ocr_mode: str = "full"):
+    """
+    Returns the function formatting a response into an output row.
+
+    Args:
+        formatter (str): "fast" for `format_json_fast`, "reference" for `format_json`. Both
+            produce the same rows of the nested layout.
+        layout (str): "nested" for one wide row per creative, "normalized" for a creative row
+            and the rows of its child tables, see `normalized_format_utils`.
+        ocr_mode (str): Entries of the text annotations, see `format_utils.OCR_MODES`.
+
+    Returns:
+        Callable: The formatter.
+    """
+    if formatter not in FORMATTERS:
+        raise ValueError(f"Unknown formatter '{formatter}'. Use one of: {', '.join(FORMATTERS)}")
+    if ocr_mode not in OCR_MODES:
+        raise ValueError(f"Unknown OCR mode '{ocr_mode}'. Use one of: {', '.join(OCR_MODES)}")
+    if layout == "normalized":
+        return functools.partial(format_normalized, ocr_mode=ocr_mode)
+    if layout != "nested":
+        raise ValueError(f"Unknown output layout '{layout}'. Use nested or normalized")
+    return functools.partial(FORMATTERS[formatter], ocr_mode=ocr_mode)
+
+
+def format_chunk(records: List[Tuple[str, str, bytes, dict]], features, formatter: str = "fast", serialize: bool = True, layout: str = "nested", ocr_mode: str = "full") -> Tuple[list, float, float]:
+    """
+    Formats a chunk of serialized responses in a worker process.
+
+    Args:
+        records (List[Tuple[str, str, bytes, dict]]): ID and URI of each creative, its serialized
+            `AnnotateImageResponse`, and extra columns added to its row.
+        features (list): Feature types whose columns are formatted.
+        formatter (str): "fast" for `format_json_fast`, "reference" for `format_json`.
+        serialize (bool): Return NDJSON lines instead of rows, so the parent process does not
+            serialize them.
+        layout (str): "nested" or "normalized", see `get_row_formatter`.
+        ocr_mode (str): Entries of the text annotations, see `format_utils.OCR_MODES`.
+
+    Returns:
+        Tuple[list, float, float]: The row of each record, or its NDJSON line as bytes, and
+            the seconds spent formatting and serializing the chunk.
+    """
+    format_row = get_row_formatter(formatter, layout, ocr_mode)
+
+    # Only the reference formatter goes through the proto-plus wrappers
+    if format_row.func is format_json:
+        parse = vision.AnnotateImageResponse.deserialize
+    else:
+        parse = vision.AnnotateImageResponse.pb().FromString
+
+    rows = []
+    start = time.perf_counter()
+    for creative_id, creative_uri, payload, extra_columns in records:
+        creative_data = format_row(parse(payload), creative_id, creative_uri, features)
+        creative_data.update(extra_columns)
+        rows.append(creative_data)
+    format_seconds = time.perf_counter() - start
+
+    if not serialize:
+        return rows, format_seconds, 0.0
+
+    start = time.perf_counter()
+    lines = [(json.dumps(creative_data) + "\n").encode("utf-8") for creative_data in rows]
+    return lines, format_seconds, time.perf_counter() - start
+
+
+def serialize_response(response) -> bytes:
+    """
+    Serializes a proto-plus or protobuf `AnnotateImageResponse`.
+    """
+    if isinstance(response, vision.AnnotateImageResponse):
+        return vision.AnnotateImageResponse.serialize(response)
+    return response.SerializeToString()
+
+
+class FormatterPool:
+    """
+    Formats and serializes the rows in a process pool, as a stage of its own between the
+    annotation and the sink.
+
+    `format` drives the annotation stage from a feeder thread, which serializes the responses
+    into chunks of protobuf bytes and submits them to the worker processes. The futures of the
+    chunks wait in a bounded queue, so at most `max_pending_chunks` chunks are being formatted
+    or waiting for the sink; the feeder blocks when the sink falls behind. The rows come out
+    in the order of the annotated responses.
+
+    Args:
+        workers (int): Number of worker processes.
+        features (list): Feature types whose columns are formatted.
+        formatter (str): "fast" for `format_json_fast`, "reference" for `format_json`.
+        serialize (bool): Yield NDJSON lines as bytes instead of rows, for the sinks with a
+            `write_line` method.
+        chunk_rows (int): Number of rows sent to a worker at once.
+        max_pending_chunks (int): Maximum number of chunks between the annotation and the sink.
+            Defaults to twice the number of workers.
+        layout (str): "nested" or "normalized", see `get_row_formatter`.
+        ocr_mode (str): Entries of the text annotations, see `format_utils.OCR_MODES`.
+    """
+
+    def __init__(self, workers, features, formatter="fast", serialize=True, chunk_rows=256, max_pending_chunks=None, layout="nested", ocr_mode="full"):
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        get_row_formatter(formatter, layout, ocr_mode)
+
+        self.workers = workers
+        self.features = features
+        self.formatter = formatter
+        self.layout = layout
+        self.ocr_mode = ocr_mode
+        self.serialize = serialize
+        self.chunk_rows = chunk_rows
+        self.max_pending_chunks = max_pending_chunks or 2 * workers
+        self.chunks = 0
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+
+    def _submit(self, chunk):
+        records = [(image_uri, image_uri, payload, extra_columns) for _, _, image_uri, payload, extra_columns in chunk]
+        future = self._executor.submit(format_chunk, records, self.features, self.formatter, self.serialize, self.layout, self.ocr_mode)
+        self.chunks += 1
+        return [(blob_name, blob_generation) for blob_name, blob_generation, _, _, _ in chunk], future
+
+    def _feed(self, annotated, pending: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            chunk = []
+            for blob_name, blob_generation, image_uri, response, extra_columns in annotated:
+                if stop.is_set():
+                    return
+                chunk.append((blob_name, blob_generation, image_uri, serialize_response(response), extra_columns))
+                if len(chunk) >= self.chunk_rows:
+                    put(self._submit(chunk))
+                    chunk = []
+            if chunk:
+                put(self._submit(chunk))
+            put(_END)
+        except BaseException as e:
+            put(e)
+
+    def format(self, annotated: Iterable[Tuple[str, int, str, object, dict]]) -> Iterator[Tuple[str, int, object]]:
+        """
+        Formats the annotated images, see `vision_utils.iter_annotated`.
+
+        Args:
+            annotated (Iterable[Tuple[str, int, str, object, dict]]): Name and generation of the
+                blob, URI, response and extra columns of each image.
+
+        Yields:
+            Tuple[str, int, object]: Name and generation of the blob, and its row, or its NDJSON
+                line if `serialize` is True.
+        """
+        pending = queue.Queue(maxsize=self.max_pending_chunks)
+        stop = threading.Event()
+        feeder = threading.Thread(target=self._feed, args=(annotated, pending, stop), daemon=True)
+        feeder.start()
+
+        metrics = get_metrics()
+        try:
+            while True:
+                item = pending.get()
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+
+                blobs, future = item
+                results, format_seconds, serialize_seconds = future.result()
+
+                # The worker processes report their own time
+                metrics.increment("stage_seconds", format_seconds, stage="format")
+                metrics.increment("stage_seconds", serialize_seconds, stage="serialize")
+                for (blob_name, blob_generation), result in zip(blobs, results):
+                    yield blob_name, blob_generation, result
+        finally:
+            # Let the feeder exit if the rows are not consumed to the end
+            stop.set()
+            feeder.join()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,191 @@
+from typing import Any, Dict, List
+
+
+def import_pyarrow():
+    """
+    Imports pyarrow and its Parquet module the first time columnar output is needed, so the
+    NDJSON runs never load them.
+
+    Returns:
+        module: The `pyarrow` module.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required for columnar output. Install it with `pip install pyarrow`") from None
+    return pyarrow
+
+
+def build_sample_response() -> "vision.AnnotateImageResponse":
+    """
+    Builds a response with one element of every annotation read by `format_json`, so that
+    formatting it produces every field of the output rows.
+
+    Returns:
+        vision.AnnotateImageResponse: The sample response.
+    """
+    from google.cloud import vision
+
+    vertices = [{"x": 1, "y": 1}] * 4
+    normalized_vertices = [{"x": 0.5, "y": 0.5}] * 4
+
+    return vision.AnnotateImageResponse(
+        localized_object_annotations=[{"name": "sample", "score": 1.0, "bounding_poly": {"normalized_vertices": normalized_vertices}}],
+        face_annotations=[{
+            "bounding_poly": {"vertices": vertices},
+            "fd_bounding_poly": {"vertices": vertices},
+            "landmarks": [{"type_": vision.FaceAnnotation.Landmark.Type.LEFT_EYE, "position": {"x": 1.0, "y": 1.0, "z": 1.0}}],
+        }],
+        logo_annotations=[{"description": "sample", "score": 1.0, "mid": "sample", "bounding_poly": {"vertices": vertices}}],
+        label_annotations=[{"description": "sample", "score": 1.0, "mid": "sample", "topicality": 1.0}],
+        text_annotations=[{"description": "sample", "bounding_poly": {"vertices": vertices}}],
+        image_properties_annotation={"dominant_colors": {"colors": [{"color": {"red": 1.0, "green": 1.0, "blue": 1.0}, "score": 1.0, "pixel_fraction": 1.0}]}},
+        web_detection={
+            "best_guess_labels": [{"label": "sample", "language_code": "en"}],
+            "visually_similar_images": [{"url": "sample"}],
+            "web_entities": [{"entity_id": "sample", "score": 1.0, "description": "sample"}],
+        },
+    )
+
+
+def derive_schema(row: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Derives a schema from the field names and value types of a formatted row.
+
+    Each field is described as `{"name", "type", "mode"}` plus `"fields"` for records, using
+    the BigQuery type names: STRING, FLOAT, INTEGER, BOOLEAN and RECORD. Lists become
+    REPEATED fields of the type of their first element.
+
+    Args:
+        row (Dict[str, Any]): A formatted row with every list populated.
+
+    Returns:
+        List[Dict[str, Any]]: The schema of the row.
+    """
+    schema = []
+    for name, value in row.items():
+        mode = "NULLABLE"
+        if isinstance(value, list):
+            if not value:
+                raise ValueError(f"Cannot derive the type of the empty list '{name}'")
+            mode = "REPEATED"
+            value = value[0]
+        schema.append(_derive_field(name, value, mode))
+
+    return schema
+
+
+def _derive_field(name, value, mode):
+    if isinstance(value, dict):
+        return {"name": name, "type": "RECORD", "mode": mode, "fields": derive_schema(value)}
+    # bool is checked before int because it is a subclass of int
+    if isinstance(value, bool):
+        return {"name": name, "type": "BOOLEAN", "mode": mode}
+    if isinstance(value, int):
+        return {"name": name, "type": "INTEGER", "mode": mode}
+    if isinstance(value, float):
+        return {"name": name, "type": "FLOAT", "mode": mode}
+    if isinstance(value, str):
+        return {"name": name, "type": "STRING", "mode": mode}
+    raise TypeError(f"Unsupported type {type(value).__name__} for field '{name}'")
+
+
+def annotation_schema(features=None, with_cluster_id=False, ocr_mode="full") -> List[Dict[str, Any]]:
+    """
+    Returns the schema of the rows produced by `format_json`.
+
+    Args:
+        features (list): Feature types requested to the Vision API. If None, the schema has
+            every column.
+        with_cluster_id (bool): Add the `cluster_id` column written when near-duplicates are
+            grouped.
+        ocr_mode (str): Entries of the `text_annotations` column, see `format_utils.OCR_MODES`.
+
+    Returns:
+        List[Dict[str, Any]]: The schema of the annotation rows.
+    """
+    from utils.format_utils import format_json
+
+    row = format_json(build_sample_response(), creative_id="sample", creative_uri="sample", features=features, ocr_mode=ocr_mode)
+    if with_cluster_id:
+        row["cluster_id"] = "sample"
+    return derive_schema(row)
+
+
+def normalized_schema(features=None, with_cluster_id=False, ocr_mode="full") -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Returns the schema of each table of the normalized layout, see `normalized_format_utils`.
+
+    Args:
+        features (list): Feature types requested to the Vision API. If None, every table is
+            returned.
+        with_cluster_id (bool): Add the `cluster_id` column to the `creatives` table.
+        ocr_mode (str): Rows of the `text` table, see `format_utils.OCR_MODES`.
+
+    Returns:
+        Dict[str, List[Dict[str, Any]]]: The schema of each table, the `creatives` table first.
+    """
+    from utils.normalized_format_utils import CREATIVES_TABLE, format_normalized, normalized_tables
+
+    row = format_normalized(build_sample_response(), creative_id="sample", creative_uri="sample", features=features, ocr_mode=ocr_mode)
+    if with_cluster_id:
+        row["cluster_id"] = "sample"
+
+    child_tables = normalized_tables(features)[1:]
+    schemas = {table: derive_schema(row.pop(table)[0]) for table in child_tables}
+    return {CREATIVES_TABLE: derive_schema(row), **schemas}
+
+
+def to_bigquery_schema(schema: List[Dict[str, Any]]) -> list:
+    """
+    Converts a schema into BigQuery schema fields.
+
+    Args:
+        schema (List[Dict[str, Any]]): Schema built by `derive_schema`.
+
+    Returns:
+        List[bigquery.SchemaField]: The BigQuery schema.
+    """
+    from google.cloud import bigquery
+
+    return [
+        bigquery.SchemaField(
+            field["name"],
+            field["type"],
+            mode=field["mode"],
+            fields=to_bigquery_schema(field.get("fields", [])),
+        )
+        for field in schema
+    ]
+
+
+def to_arrow_schema(schema: List[Dict[str, Any]]):
+    """
+    Converts a schema into an Arrow schema.
+
+    Args:
+        schema (List[Dict[str, Any]]): Schema built by `derive_schema`.
+
+    Returns:
+        pyarrow.Schema: The Arrow schema.
+    """
+    pyarrow = import_pyarrow()
+    return pyarrow.schema([_to_arrow_field(pyarrow, field) for field in schema])
+
+
+def _to_arrow_field(pyarrow, field):
+    if field["type"] == "RECORD":
+        arrow_type = pyarrow.struct([_to_arrow_field(pyarrow, child) for child in field["fields"]])
+    else:
+        arrow_type = {
+            "STRING": pyarrow.string(),
+            "FLOAT": pyarrow.float64(),
+            "INTEGER": pyarrow.int64(),
+            "BOOLEAN": pyarrow.bool_(),
+        }[field["type"]]
+
+    if field["mode"] == "REPEATED":
+        arrow_type = pyarrow.list_(arrow_type)
+
+    return pyarrow.field(field["name"], arrow_type)
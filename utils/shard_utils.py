@@ -0,0 +1,186 @@
+from typing import Any, Dict, Iterator, List
+import glob
+import hashlib
+import json
+import os
+from utils.schema_utils import import_pyarrow
+
+# Suffix of the marker written by a shard once all of its output is on disk
+MARKER_SUFFIX = ".done.json"
+
+
+def shard_of(name: str, num_shards: int) -> int:
+    """
+    Returns the shard of a blob name.
+
+    The shard only depends on the name, through its MD5 digest, so every worker computes the
+    same partition of the bucket on any machine and Python version.
+
+    Args:
+        name (str): Name of the blob.
+        num_shards (int): Number of shards.
+
+    Returns:
+        int: The shard index, between 0 and `num_shards - 1`.
+    """
+    return int.from_bytes(hashlib.md5(name.encode("utf-8")).digest()[:8], "big") % num_shards
+
+
+def validate_shard(num_shards: int, shard_index: int):
+    """
+    Raises a ValueError if `shard_index` is not a shard of `num_shards`.
+    """
+    if num_shards < 1:
+        raise ValueError(f"num_shards must be at least 1, got {num_shards}")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index must be between 0 and {num_shards - 1}, got {shard_index}")
+
+
+def shard_path_prefix(path_prefix: str, shard_index: int, num_shards: int) -> str:
+    """
+    Returns the prefix of the output part of a shard, e.g. `dataset-shard-00003-of-00008`.
+    """
+    return f"{path_prefix}-shard-{shard_index:05d}-of-{num_shards:05d}"
+
+
+def _part_paths(part_prefix, extension):
+    return sorted(glob.glob(glob.escape(part_prefix) + "-[0-9][0-9][0-9][0-9][0-9]" + extension))
+
+
+def clear_shard_marker(part_prefix: str):
+    """
+    Removes the marker of a shard before its output is written again, so a run that does not
+    finish leaves the shard incomplete.
+    """
+    if os.path.exists(part_prefix + MARKER_SUFFIX):
+        os.remove(part_prefix + MARKER_SUFFIX)
+
+
+def write_shard_marker(part_prefix: str, shard_index: int, num_shards: int, extension: str, schema: List[Dict[str, Any]]):
+    """
+    Marks a shard as complete, listing every file of its output part.
+
+    The marker is written to a temporary file and renamed, so it either exists whole or not at all.
+
+    Args:
+        part_prefix (str): Prefix of the output part, see `shard_path_prefix`.
+        shard_index (int): Index of the shard.
+        num_shards (int): Number of shards.
+        extension (str): Extension of the part files, ".ndjson" or ".parquet".
+        schema (List[Dict[str, Any]]): Schema of the rows, see `schema_utils.annotation_schema`.
+    """
+    marker = {
+        "shard_index": shard_index,
+        "num_shards": num_shards,
+        "files": [os.path.basename(path) for path in _part_paths(part_prefix, extension)],
+        "schema": schema,
+    }
+
+    marker_path = part_prefix + MARKER_SUFFIX
+    with open(marker_path + ".tmp", "w") as file:
+        json.dump(marker, file)
+    os.replace(marker_path + ".tmp", marker_path)
+
+
+def find_shard_parts(path_prefix: str, num_shards: int, extension: str) -> List[str]:
+    """
+    Returns the files of every shard, checking that no shard is missing or incomplete.
+
+    A shard is incomplete when it has no marker, or when it has part files the marker does
+    not list, which a run that did not finish leaves behind.
+
+    Args:
+        path_prefix (str): Output prefix given to every worker.
+        num_shards (int): Number of shards of the run.
+        extension (str): Extension of the part files, ".ndjson" or ".parquet".
+
+    Returns:
+        List[str]: Paths to the part files, shard after shard.
+    """
+    paths = []
+    problems = []
+    schema = None
+    for shard_index in range(num_shards):
+        part_prefix = shard_path_prefix(path_prefix, shard_index, num_shards)
+        marker_path = part_prefix + MARKER_SUFFIX
+        if not os.path.exists(marker_path):
+            problems.append(f"shard {shard_index} has no marker {marker_path}")
+            continue
+
+        with open(marker_path) as file:
+            marker = json.load(file)
+
+        directory = os.path.dirname(part_prefix)
+        listed = [os.path.join(directory, name) for name in marker["files"]]
+        missing = [path for path in listed if not os.path.exists(path)]
+        unlisted = sorted(set(_part_paths(part_prefix, extension)) - set(listed))
+        if missing:
+            problems.append(f"shard {shard_index} is missing {', '.join(missing)}")
+        if unlisted:
+            problems.append(f"shard {shard_index} has files of an unfinished run: {', '.join(unlisted)}")
+        if schema is not None and marker["schema"] != schema:
+            problems.append(f"shard {shard_index} was written with other features")
+        schema = marker["schema"]
+
+        paths.extend(listed)
+
+    if problems:
+        raise ValueError("Cannot merge the shards: " + "; ".join(problems))
+
+    return paths
+
+
+def shard_schema(path_prefix: str, num_shards: int) -> List[Dict[str, Any]]:
+    """
+    Returns the schema recorded in the marker of the first shard.
+    """
+    with open(shard_path_prefix(path_prefix, 0, num_shards) + MARKER_SUFFIX) as file:
+        return json.load(file)["schema"]
+
+
+def iter_part_rows(path: str) -> Iterator[dict]:
+    """
+    Reads the rows of an NDJSON or Parquet part file.
+    """
+    if path.endswith(".parquet"):
+        pyarrow = import_pyarrow()
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def merge_shard_parts(paths: List[str], sink) -> int:
+    """
+    Writes the rows of the part files into a single sink, keeping one row per `creative_id`.
+
+    A creative is only in one shard, but resumed runs append a new row when it changes, so the
+    last row of each `creative_id` wins. The files are read twice: once to find the last row of
+    each creative, once to write it.
+
+    Args:
+        paths (List[str]): Paths to the part files, in the order they were written.
+        sink (RotatingFileSink): Sink receiving the merged rows.
+
+    Returns:
+        int: Number of duplicate rows dropped.
+    """
+    # Position of the last row of each creative
+    last_rows = {}
+    position = 0
+    for path in paths:
+        for row in iter_part_rows(path):
+            last_rows[row["creative_id"]] = position
+            position += 1
+
+    position = 0
+    for path in paths:
+        for row in iter_part_rows(path):
+            if last_rows[row["creative_id"]] == position:
+                sink.write(row)
+            position += 1
+
+    return position - len(last_rows)
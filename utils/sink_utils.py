@@ -0,0 +1,346 @@
+import glob
+import json
+import os
+from utils.metrics_utils import get_metrics
+from utils.schema_utils import import_pyarrow, to_arrow_schema
+
+
+def _roll_back(path, size) -> bool:
+    """
+    Truncates a file to its size at the last checkpoint, or removes it if it was started after.
+
+    Returns:
+        bool: True if the file is kept.
+    """
+    if size is None:
+        os.remove(path)
+        return False
+    if os.path.getsize(path) > size:
+        os.truncate(path, size)
+    return True
+
+
+class RotatingFileSink:
+    """
+    Base class of the sinks that write rows to local files as they are produced, keeping
+    memory flat regardless of the number of rows.
+
+    Files are named `{path_prefix}-00000{extension}`, `{path_prefix}-00001{extension}`, ...
+    and a new file is started once the current one reaches `max_rows` rows or `max_bytes`
+    bytes.
+
+    Args:
+        path_prefix (str): Prefix of the output files.
+        max_rows (int): Maximum number of rows per file. None for no limit.
+        max_bytes (int): Maximum size in bytes of each file. None for no limit.
+        append (bool): If True, the numbering continues after the files already written with
+            the same prefix, so resumed runs never overwrite them. Otherwise those files are
+            replaced by the new output.
+        committed_files (Dict[str, int]): Size of each file at the last checkpoint of the
+            previous run, see `committed_files`. When appending, the files are truncated back
+            to it and the files started after it are removed, which drops the rows written
+            after the checkpoint, including a line cut by a crash. None keeps the files as is.
+    """
+
+    extension = None
+
+    def __init__(self, path_prefix, max_rows=None, max_bytes=None, append=False, committed_files=None):
+        self.path_prefix = path_prefix
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.paths = []
+        self.rows_written = 0
+        self.bytes_written = 0
+        # Labels of the rows_emitted and bytes_emitted metrics, e.g. the table of the rows
+        self.metric_labels = {}
+
+        self._file = None
+        self._file_rows = 0
+        self._file_bytes = 0
+
+        existing_paths = glob.glob(glob.escape(path_prefix) + "-[0-9][0-9][0-9][0-9][0-9]" + self.extension)
+        if append and committed_files is not None:
+            existing_paths = [path for path in existing_paths if _roll_back(path, committed_files.get(path))]
+        self._committed = {path: os.path.getsize(path) for path in existing_paths} if append else {}
+        if append:
+            suffix_length = len(self.extension) + 5
+            self._next_index = max((int(path[-suffix_length:-len(self.extension)]) + 1 for path in existing_paths), default=0)
+        else:
+            for path in existing_paths:
+                os.remove(path)
+            self._next_index = 0
+
+    def committed_files(self) -> dict:
+        """
+        Returns the size of every file of the prefix, including the files of previous runs.
+        Called right after `flush`, it is the state a resumed run is rolled back to.
+
+        Returns:
+            Dict[str, int]: Size in bytes of each file.
+        """
+        for path in self.paths:
+            self._committed[path] = os.path.getsize(path)
+        return dict(self._committed)
+
+    def _is_full(self, next_row_bytes):
+        if self.max_rows is not None and self._file_rows >= self.max_rows:
+            return True
+        return self.max_bytes is not None and self._file_bytes + next_row_bytes > self.max_bytes
+
+    def _rotate(self, next_row_bytes):
+        """
+        Closes the current file if it is full and opens a new one if needed.
+        """
+        if self._file is not None and self._is_full(next_row_bytes):
+            self._close_file()
+        if self._file is None:
+            path = f"{self.path_prefix}-{self._next_index:05d}{self.extension}"
+            self._next_index += 1
+            self._file = self._open_file(path)
+            self._file_rows = 0
+            self._file_bytes = 0
+            self.paths.append(path)
+
+    def _open_file(self, path):
+        raise NotImplementedError
+
+    def _close_file(self):
+        raise NotImplementedError
+
+    def write(self, row: dict):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Flushes and closes the current file.
+        """
+        if self._file is not None:
+            self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NdjsonSink(RotatingFileSink):
+    """
+    Writes rows to rotating NDJSON files. See `RotatingFileSink`.
+    """
+
+    extension = ".ndjson"
+
+    def write(self, row: dict):
+        """
+        Writes a row, rotating to a new file if the current one is full.
+
+        Args:
+            row (dict): Row to write.
+        """
+        with get_metrics().timer("serialize"):
+            line = (json.dumps(row) + "\n").encode("utf-8")
+        self.write_line(line)
+
+    def write_line(self, line: bytes):
+        """
+        Writes a row already serialized as an NDJSON line, e.g. by a formatting process.
+
+        Args:
+            line (bytes): The line, ending with a newline.
+        """
+        metrics = get_metrics()
+        with metrics.timer("sink_write"):
+            self._rotate(len(line))
+            self._file.write(line)
+
+        self._file_rows += 1
+        self._file_bytes += len(line)
+        self.rows_written += 1
+        self.bytes_written += len(line)
+        metrics.increment("rows_emitted", **self.metric_labels)
+        metrics.increment("bytes_emitted", len(line), **self.metric_labels)
+
+    def _open_file(self, path):
+        return open(path, "wb")
+
+    def _close_file(self):
+        self.flush()
+        self._file.close()
+        self._file = None
+
+    def flush(self):
+        """
+        Makes every row written so far durable on disk.
+        """
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+class ParquetSink(RotatingFileSink):
+    """
+    Writes rows to rotating, compressed Parquet files with an explicit schema. See
+    `RotatingFileSink`.
+
+    Rows are buffered and written as row groups of `row_group_rows` rows. The size of a file
+    is only known after each row group, so `max_bytes` is approximate. A Parquet file is only
+    readable once closed, so `flush` closes the current file and the next row starts a new one.
+
+    Args:
+        path_prefix (str): Prefix of the output files.
+        schema (List[Dict[str, Any]]): Schema of the rows, see `schema_utils.derive_schema`.
+        row_group_rows (int): Number of rows per row group.
+        compression (str): Parquet compression codec.
+        **kwargs: Rotation options, see `RotatingFileSink`.
+    """
+
+    extension = ".parquet"
+
+    def __init__(self, path_prefix, schema, row_group_rows=10000, compression="zstd", **kwargs):
+        self._pyarrow = import_pyarrow()
+
+        super().__init__(path_prefix, **kwargs)
+        self.arrow_schema = to_arrow_schema(schema)
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self._path = None
+        self._rows = []
+
+    def write(self, row: dict):
+        """
+        Buffers a row, writing a row group once the buffer is full.
+
+        Args:
+            row (dict): Row to write.
+        """
+        metrics = get_metrics()
+        with metrics.timer("sink_write"):
+            self._rotate(0)
+
+            self._rows.append(row)
+            self._file_rows += 1
+            self.rows_written += 1
+
+            if len(self._rows) >= self.row_group_rows:
+                self._write_row_group()
+        metrics.increment("rows_emitted", **self.metric_labels)
+
+    def _write_row_group(self):
+        if not self._rows:
+            return
+
+        self._file.write_table(self._pyarrow.Table.from_pylist(self._rows, schema=self.arrow_schema))
+        self._rows = []
+
+        # Track the size of the file as written so far
+        file_bytes = os.path.getsize(self._path)
+        self.bytes_written += file_bytes - self._file_bytes
+        get_metrics().increment("bytes_emitted", file_bytes - self._file_bytes, **self.metric_labels)
+        self._file_bytes = file_bytes
+
+    def _open_file(self, path):
+        self._path = path
+        return self._pyarrow.parquet.ParquetWriter(path, self.arrow_schema, compression=self.compression)
+
+    def _close_file(self):
+        self._write_row_group()
+        self._file.close()
+        self._file = None
+
+        file_bytes = os.path.getsize(self._path)
+        self.bytes_written += file_bytes - self._file_bytes
+        get_metrics().increment("bytes_emitted", file_bytes - self._file_bytes, **self.metric_labels)
+
+    def flush(self):
+        """
+        Makes every row written so far durable on disk by closing the current file.
+        """
+        if self._file is not None:
+            self._close_file()
+
+
+class NormalizedSink:
+    """
+    Writes the rows of the normalized layout, see `normalized_format_utils`, each table to its
+    own sink.
+
+    The rows of the child tables are taken out of the creative row, and the rest of the
+    creative row is written to the `creatives` table. The metrics of the child tables are
+    counted under their `table` label, so the unlabeled `rows_emitted` still counts images.
+
+    Args:
+        sinks (Dict[str, object]): Sink of each table, the `creatives` table first. Any sink
+            with `write`, `flush` and `close` methods. The `abort` method of the sinks having
+            one is called when the run fails.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.creatives_table, *self.child_tables = sinks
+        for table in self.child_tables:
+            sinks[table].metric_labels = {"table": table}
+
+    @property
+    def rows_written(self) -> int:
+        return self.sinks[self.creatives_table].rows_written
+
+    @property
+    def paths(self) -> list:
+        return [path for sink in self.sinks.values() for path in getattr(sink, "paths", [])]
+
+    def write(self, row: dict):
+        """
+        Writes a creative row and the rows of its child tables.
+
+        Args:
+            row (dict): Row built by `format_normalized`.
+        """
+        row = dict(row)
+        for table in self.child_tables:
+            sink = self.sinks[table]
+            for child_row in row.pop(table, ()):
+                sink.write(child_row)
+        self.sinks[self.creatives_table].write(row)
+
+    def flush(self):
+        for sink in self.sinks.values():
+            sink.flush()
+
+    def committed_files(self):
+        """
+        Returns the size of the files of every table, or None if a sink cannot be rolled back.
+        """
+        committed_files = {}
+        for sink in self.sinks.values():
+            sink_files = sink.committed_files()
+            if sink_files is None:
+                return None
+            committed_files.update(sink_files)
+        return committed_files
+
+    def close(self):
+        """
+        Closes every sink, even if one of them fails.
+        """
+        errors = []
+        for sink in self.sinks.values():
+            try:
+                sink.close()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for sink in self.sinks.values():
+                if hasattr(sink, "abort"):
+                    sink.abort()
+        self.close()
@@ -0,0 +1,278 @@
+from typing import Iterator, List, Mapping, Optional
+import base64
+import datetime
+import hashlib
+import mmap
+import os
+import urllib.parse
+import urllib.request
+import zlib
+from utils.listing_utils import BlobFilter, list_image_blobs
+
+# URI scheme of the images of an `InMemorySource`
+MEMORY_SCHEME = "memory://"
+
+# Leading bytes of the image formats accepted by the Vision API, used to type in-memory images
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"\x00\x00\x01\x00", "image/x-icon"),
+]
+
+
+def sniff_content_type(data: bytes) -> Optional[str]:
+    """
+    Guesses the content type of an encoded image from its leading bytes.
+
+    Args:
+        data (bytes): Encoded image, or at least its first 12 bytes.
+
+    Returns:
+        Optional[str]: The content type, or None if the format is not recognized.
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return None
+
+
+def read_mapped(path: str) -> bytes:
+    """
+    Reads a file through a read-only memory map, so its pages are copied once from the page
+    cache into the returned bytes instead of going through the buffers of a file object.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        bytes: Content of the file.
+    """
+    with open(path, "rb") as file:
+        # Empty files cannot be mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[:]
+
+
+def _md5_base64(data) -> str:
+    # Same encoding as the md5Hash of GCS objects, so a creative keeps its cache key wherever it is read from
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+class LocalImage:
+    """
+    File of a `LocalDirectorySource`, with the properties of a GCS blob read by the pipelines.
+
+    `generation` is the modification time in nanoseconds, so incremental runs annotate a file
+    again once it is rewritten. `md5_hash` is only computed when it is read, e.g. for the
+    annotation cache key.
+
+    Args:
+        path (str): Path to the file.
+        name (str): Path relative to the directory of the source, with "/" separators.
+        stat (os.stat_result): Status of the file.
+    """
+
+    content_type = None
+    crc32c = None
+
+    def __init__(self, path, name, stat):
+        self.path = path
+        self.name = name
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+        self.updated = datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc)
+        self._md5_hash = None
+
+    @property
+    def md5_hash(self) -> str:
+        if self._md5_hash is None and self.size == 0:
+            self._md5_hash = _md5_base64(b"")
+        elif self._md5_hash is None:
+            with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                self._md5_hash = _md5_base64(mapped)
+        return self._md5_hash
+
+
+class MemoryImage:
+    """
+    Image of an `InMemorySource`, with the properties of a GCS blob read by the pipelines.
+
+    `generation` is the CRC32 of the content, so incremental runs annotate an image again once
+    its content changes.
+
+    Args:
+        name (str): Name of the image in the source.
+        content (bytes): Encoded image.
+    """
+
+    crc32c = None
+    updated = None
+
+    def __init__(self, name, content):
+        self.name = name
+        self.size = len(content)
+        self.generation = zlib.crc32(content)
+        self.content_type = sniff_content_type(content)
+        self._content = content
+        self._md5_hash = None
+
+    @property
+    def md5_hash(self) -> str:
+        if self._md5_hash is None:
+            self._md5_hash = _md5_base64(self._content)
+        return self._md5_hash
+
+
+class ImageSource:
+    """
+    Where the images of a run come from.
+
+    A source lists its images as blob-like objects (`name`, `generation`, `size`, `md5_hash`,
+    `crc32c`, `content_type` and `updated`), so the filters, checkpoints, cache keys and
+    dead letters work the same whatever the source. Each image is identified by a URI that
+    stays the same from one run to the next, used as `creative_id` and `creative_uri`.
+
+    Sources with `sends_content` send the bytes of their images as `image.content`. The others
+    send the URI and let the Vision API fetch the image.
+    """
+
+    sends_content = False
+
+    def list_images(self, blob_filter: BlobFilter = None) -> Iterator:
+        """
+        Lists the images to annotate.
+
+        Args:
+            blob_filter (BlobFilter): Filter of the images. Defaults to images of any size above zero.
+
+        Yields:
+            object: The accepted images.
+        """
+        raise NotImplementedError
+
+    def image_uri(self, image) -> str:
+        """
+        Returns the URI of an image of the listing.
+        """
+        raise NotImplementedError
+
+    def read(self, image_uri: str) -> Optional[bytes]:
+        """
+        Returns the content of an image sent to the Vision API, or None to send its URI.
+        """
+        return None
+
+    def read_all(self, image_uris: List[str]) -> List[Optional[bytes]]:
+        """
+        Returns the result of `read` for each image of a batch.
+        """
+        return [self.read(image_uri) for image_uri in image_uris]
+
+
+class GcsImageSource(ImageSource):
+    """
+    Images of a GCS bucket, sent by `gs://` URI and fetched by the Vision API.
+
+    Args:
+        storage_client (storage.Client): Client for GCS.
+        bucket_name (str): Name of the bucket.
+        workers (int): Maximum number of prefixes listed at the same time, see `list_image_blobs`.
+        shard_depth (int): Number of "folder" levels used to split the listing.
+    """
+
+    def __init__(self, storage_client, bucket_name, workers=1, shard_depth=1):
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.workers = workers
+        self.shard_depth = shard_depth
+
+    def list_images(self, blob_filter: BlobFilter = None) -> Iterator:
+        return list_image_blobs(self.storage_client, self.bucket_name, blob_filter, self.workers, self.shard_depth)
+
+    def image_uri(self, image) -> str:
+        return f"gs://{self.bucket_name}/{image.name}"
+
+
+class LocalDirectorySource(ImageSource):
+    """
+    Image files of a local directory, read through a memory map and sent as `image.content`,
+    so images produced on the machine are annotated without uploading them first.
+
+    The directory is walked in sorted order. The files are filtered by their path relative to
+    the directory, and by their extension since they have no content type. Each image is
+    identified by its `file://` URI.
+
+    Args:
+        directory (str): Directory of the images, walked recursively.
+    """
+
+    sends_content = True
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise ValueError(f"Input directory '{directory}' does not exist")
+        self.directory = os.path.abspath(directory)
+
+    def list_images(self, blob_filter: BlobFilter = None) -> Iterator[LocalImage]:
+        blob_filter = blob_filter or BlobFilter()
+
+        for root, directories, files in os.walk(self.directory):
+            directories.sort()
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                # Broken links and special files are skipped
+                if not os.path.isfile(path):
+                    continue
+                image = LocalImage(path, name, os.stat(path))
+                if blob_filter.accepts(image):
+                    yield image
+
+        print(f"Listing: {blob_filter.summary()}")
+
+    def image_uri(self, image) -> str:
+        return "file://" + urllib.request.pathname2url(image.path)
+
+    def read(self, image_uri: str) -> bytes:
+        return read_mapped(urllib.request.url2pathname(urllib.parse.urlparse(image_uri).path))
+
+
+class InMemorySource(ImageSource):
+    """
+    Encoded images held in memory, sent as `image.content`, for applications embedding the
+    pipeline. Each image is identified by its `memory://{name}` URI.
+
+    The images are typed from their leading bytes, so names do not need an extension.
+
+    Args:
+        images (Mapping[str, bytes]): Encoded image of each name. The names must be unique and
+            stable from one run to the next.
+    """
+
+    sends_content = True
+
+    def __init__(self, images: Mapping[str, bytes]):
+        self.images = images
+
+    def list_images(self, blob_filter: BlobFilter = None) -> Iterator[MemoryImage]:
+        blob_filter = blob_filter or BlobFilter()
+
+        for name in sorted(self.images):
+            image = MemoryImage(name, self.images[name])
+            if blob_filter.accepts(image):
+                yield image
+
+        print(f"Listing: {blob_filter.summary()}")
+
+    def image_uri(self, image) -> str:
+        return MEMORY_SCHEME + image.name
+
+    def read(self, image_uri: str) -> bytes:
+        return bytes(self.images[image_uri[len(MEMORY_SCHEME):]])
@@ -0,0 +1,246 @@
+from google.api_core import exceptions as api_exceptions
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+import threading
+import time
+from utils.fast_format_utils import format_json_fast
+from utils.gcp_utils import BigQuerySink
+from utils.listing_utils import BlobFilter, parse_datetime
+from utils.schema_utils import annotation_schema, to_bigquery_schema
+from utils.vision_utils import MAX_IMAGES_PER_BATCH, RETRYABLE_CODES, AnnotationScheduler, analyze_images_in_batches, format_responses
+
+
+class MicroBatcher:
+    """
+    Groups items submitted from any thread into batches, flushed when `max_batch_size` items
+    are waiting or when the oldest one has waited `max_wait_seconds`.
+
+    Every call to `submit` returns a future resolved once the batch holding the item has been
+    processed, or failed with the exception raised while processing it. `process_batch` may
+    also return the exception of each item that failed on its own, failing only their futures.
+    Full batches are processed in the thread that completes them, and expired ones in a
+    background thread.
+
+    Args:
+        process_batch (Callable[[List[Any]], Optional[Dict[Any, Exception]]]): Function
+            processing a batch of items, returning the exceptions of the failed items.
+        max_batch_size (int): Number of items that triggers a flush.
+        max_wait_seconds (float): Maximum time an item waits for its batch to fill up.
+        clock (Callable[[], float]): Monotonic clock, in seconds.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], None], max_batch_size: int = 64, max_wait_seconds: float = 2.0, clock=time.monotonic):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.batches = 0
+        self.items = 0
+
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._pending = []
+        self._deadline = None
+        self._closed = False
+        self._timer = threading.Thread(target=self._flush_expired, daemon=True)
+        self._timer.start()
+
+    def submit(self, item) -> Future:
+        """
+        Adds an item to the current batch.
+
+        Args:
+            item (Any): The item.
+
+        Returns:
+            Future: Resolved once the batch holding the item has been processed.
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The batcher is closed")
+            self._pending.append((item, future))
+            if len(self._pending) == 1:
+                self._deadline = self._clock() + self.max_wait_seconds
+                self._condition.notify_all()
+            batch = self._take() if len(self._pending) >= self.max_batch_size else None
+
+        if batch:
+            self._process(batch)
+        return future
+
+    def _take(self):
+        batch = self._pending
+        self._pending = []
+        self._deadline = None
+        return batch
+
+    def _process(self, batch):
+        try:
+            failures = self.process_batch([item for item, _ in batch]) or {}
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for item, future in batch:
+                if item in failures:
+                    future.set_exception(failures[item])
+                else:
+                    future.set_result(None)
+        with self._condition:
+            self.batches += 1
+            self.items += len(batch)
+
+    def _flush_expired(self):
+        while True:
+            with self._condition:
+                while not self._closed and (self._deadline is None or self._clock() < self._deadline):
+                    self._condition.wait(None if self._deadline is None else max(0.0, self._deadline - self._clock()))
+                if self._closed:
+                    return
+                batch = self._take()
+            self._process(batch)
+
+    def flush(self):
+        """
+        Processes the waiting items right away.
+        """
+        with self._condition:
+            batch = self._take()
+        if batch:
+            self._process(batch)
+
+    def close(self):
+        """
+        Processes the waiting items and stops the background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._timer.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class GcsObjectEvent:
+    """
+    Object of a GCS `finalize` event, exposing the properties of `storage.Blob` read by the
+    pipelines.
+
+    Args:
+        data (Dict[str, Any]): Payload of the event, i.e. the object resource: `bucket`,
+            `name`, `generation`, `contentType`, `size`, `md5Hash`, `crc32c` and `updated`.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        self.bucket_name = data["bucket"]
+        self.name = data["name"]
+        self.generation = int(data["generation"]) if data.get("generation") else None
+        self.content_type = data.get("contentType")
+        self.size = int(data.get("size") or 0)
+        self.md5_hash = data.get("md5Hash")
+        self.crc32c = data.get("crc32c")
+        self.updated = parse_datetime(data["updated"]) if data.get("updated") else None
+
+    @property
+    def uri(self) -> str:
+        return f"gs://{self.bucket_name}/{self.name}"
+
+    @classmethod
+    def from_cloud_event(cls, cloud_event) -> "GcsObjectEvent":
+        """
+        Reads the object of a CloudEvent, or of the plain payload dict of a background function.
+        """
+        return cls(cloud_event.data if hasattr(cloud_event, "data") else cloud_event)
+
+
+class GcsEventProcessor:
+    """
+    Annotates micro-batches of GCS finalize events and appends each batch to BigQuery with a
+    single load job.
+
+    Images still failing with a transient error once the retries of the scheduler are used up
+    fail the events of their object, so the platform delivers them again instead of acking
+    them without a row.
+
+    The clients of `registry` are built once and shared by every batch. Events of objects
+    that are not images are dropped, and an object uploaded several times in the same batch
+    is only annotated in its latest generation.
+
+    Args:
+        registry (ClientRegistry): Registry providing the Vision and BigQuery clients.
+        dataset_name (str): Name of the output BQ dataset.
+        table_name (str): Name of the output table.
+        features (List[vision.Feature.Type]): Features requested to the Vision API.
+        blob_filter (BlobFilter): Filter of the objects. Defaults to non-empty images.
+        concurrency (int): Maximum number of Vision API calls in flight for each batch.
+        formatter (Callable): Function formatting a response into a row.
+    """
+
+    def __init__(self, registry, dataset_name, table_name, features, blob_filter=None, concurrency=4, formatter=format_json_fast):
+        self.registry = registry
+        self.dataset_name = dataset_name
+        self.table_name = table_name
+        self.features = features
+        self.blob_filter = blob_filter or BlobFilter()
+        self.concurrency = concurrency
+        self.formatter = formatter
+        self.scheduler = AnnotationScheduler(max_concurrency=concurrency)
+        self.schema = to_bigquery_schema(annotation_schema(features))
+        self.rows_written = 0
+
+    def process_batch(self, events: List[GcsObjectEvent]) -> Optional[Dict[GcsObjectEvent, Exception]]:
+        """
+        Annotates a batch of events and loads their rows.
+
+        Args:
+            events (List[GcsObjectEvent]): The events of the batch.
+
+        Returns:
+            Optional[Dict[GcsObjectEvent, Exception]]: The exception of each event to deliver
+                again, or None if every event was handled.
+        """
+        # Keep the latest generation of each object
+        latest = {}
+        for event in events:
+            if event.uri not in latest or (event.generation or 0) > (latest[event.uri].generation or 0):
+                latest[event.uri] = event
+        objects = [event for event in latest.values() if self.blob_filter.accepts(event)]
+        if not objects:
+            return
+
+        in_flight = {event.uri: (event.name, event.generation) for event in objects}
+        responses = analyze_images_in_batches(
+            [(event.uri, None) for event in objects],
+            self.features,
+            MAX_IMAGES_PER_BATCH,
+            self.concurrency,
+            registry=self.registry,
+            scheduler=self.scheduler
+        )
+
+        # Keep the transient errors the scheduler gave up on
+        retryable_errors = {}
+
+        def track_errors(responses):
+            for image_uri, response in responses:
+                if response.error.code in RETRYABLE_CODES:
+                    retryable_errors[image_uri] = response.error
+                yield image_uri, response
+
+        # A single load job per batch, so the sink never fills a chunk
+        with BigQuerySink(self.registry.bigquery_client(), self.dataset_name, self.table_name, 'WRITE_APPEND', schema=self.schema, chunk_rows=len(objects) + 1) as sink:
+            for _, _, creative_data in format_responses(track_errors(responses), in_flight, self.features, self.formatter):
+                sink.write(creative_data)
+
+        self.rows_written += sink.rows_written
+
+        # Every event of the object is delivered again, older generations included
+        return {
+            event: api_exceptions.from_grpc_status(retryable_errors[event.uri].code, retryable_errors[event.uri].message)
+            for event in events if event.uri in retryable_errors
+        } or None
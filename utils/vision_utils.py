@@ -1,34 +1,338 @@
-from google.cloud import storage, vision, bigquery
-from google.oauth2 import service_account
-from typing import List
+from google.api_core import exceptions as api_exceptions
+from google.cloud import vision
+from typing import Iterable, Iterator, List, Optional, Tuple
+import datetime
+import functools
 import io
-from utils.format_utils import format_json
-from utils.gcp_utils import write_to_bq
+import itertools
 import json
+import random
+import threading
+import time
+import uuid
+from utils.fast_format_utils import format_json_fast
+from utils.gcp_utils import BigQuerySink
+from utils.concurrency_utils import AdaptiveConcurrencyLimiter, TokenBucket, bounded_map
+from utils.client_utils import ClientRegistry, get_default_registry
+from utils.listing_utils import BlobFilter
+from utils.source_utils import GcsImageSource, ImageSource, LocalDirectorySource
+from utils.sink_utils import NdjsonSink, NormalizedSink, ParquetSink
+from utils.metrics_utils import get_metrics, start_run
+from utils.pipeline_utils import FormatterPool, get_row_formatter
+from utils.schema_utils import annotation_schema, normalized_schema, to_bigquery_schema
 
-def analyze_image_from_uri(image_uri: str, feature_types: List[str]) -> vision.AnnotateImageResponse:
+# Maximum number of images accepted by a single synchronous batch_annotate_images call
+MAX_IMAGES_PER_BATCH = 16
+
+# Largest image the Vision API accepts as content
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+# Content sent in a single call, below the limit of about 40 MB per request to leave room for the rest of it
+MAX_REQUEST_CONTENT_BYTES = 32 * 1024 * 1024
+
+# Status code of the images rejected before calling the Vision API
+INVALID_ARGUMENT = 3
+
+# Named sets of features that can be requested instead of listing them one by one
+FEATURE_PROFILES = {
+    # Every feature with an output column
+    "full": [
+        vision.Feature.Type.OBJECT_LOCALIZATION,
+        vision.Feature.Type.FACE_DETECTION,
+        # vision.Feature.Type.LANDMARK_DETECTION, # detects popular natural and human-made structures in the image, providing lat and long.
+        vision.Feature.Type.LOGO_DETECTION,
+        vision.Feature.Type.LABEL_DETECTION,
+        vision.Feature.Type.TEXT_DETECTION,
+        #vision.Feature.Type.DOCUMENT_TEXT_DETECTION, # for documents
+        vision.Feature.Type.SAFE_SEARCH_DETECTION,
+        vision.Feature.Type.IMAGE_PROPERTIES,
+        vision.Feature.Type.WEB_DETECTION,
+    ],
+    # What the creative shows and says
+    "creative": [
+        vision.Feature.Type.OBJECT_LOCALIZATION,
+        vision.Feature.Type.LOGO_DETECTION,
+        vision.Feature.Type.LABEL_DETECTION,
+        vision.Feature.Type.TEXT_DETECTION,
+        vision.Feature.Type.IMAGE_PROPERTIES,
+    ],
+    # Brand safety checks
+    "safety": [
+        vision.Feature.Type.LABEL_DETECTION,
+        vision.Feature.Type.SAFE_SEARCH_DETECTION,
+    ],
+    # OCR only
+    "text": [
+        vision.Feature.Type.TEXT_DETECTION,
+    ],
+}
+
+
+# Status codes of the errors worth retrying: RESOURCE_EXHAUSTED, UNAVAILABLE, DEADLINE_EXCEEDED and INTERNAL
+RESOURCE_EXHAUSTED = 8
+RETRYABLE_CODES = {RESOURCE_EXHAUSTED, 14, 4, 13}
+
+# Status code of each exception of a whole call worth retrying
+RETRYABLE_EXCEPTIONS = {
+    api_exceptions.ResourceExhausted: RESOURCE_EXHAUSTED,
+    api_exceptions.ServiceUnavailable: 14,
+    api_exceptions.DeadlineExceeded: 4,
+    api_exceptions.InternalServerError: 13,
+}
+
+
+class AnnotationScheduler:
     """
-    Analyzes an image from the given URI using the specified feature types and returns the response.
-    
+    Sends the batches to the Vision API at the rate allowed by the project quota, retrying the
+    transient failures.
+
+    Before each call, one token per image is taken from a token bucket refilled at
+    `max_images_per_minute`. The number of calls in flight is adjusted additively up and
+    multiplicatively down: it grows while calls succeed and halves when the Vision API
+    answers RESOURCE_EXHAUSTED.
+
+    When a whole call fails with a retryable error, or some images of a batch come back with
+    a retryable error code, only the failed images are sent again, after a backoff with full
+    jitter. Images still failing after `max_attempts` keep their error in `response.error`;
+    calls failing with any other exception raise it.
+
+    Args:
+        max_concurrency (int): Highest number of calls in flight.
+        max_images_per_minute (float): Images sent per minute, usually the quota of the
+            project. None disables the rate limit.
+        max_attempts (int): Number of attempts of each image, including the first one.
+        backoff_base (float): Upper bound in seconds of the first backoff, doubled on every attempt.
+        backoff_max (float): Upper bound in seconds of any backoff.
+        sleep (Callable[[float], None]): Function used to wait.
+    """
+
+    def __init__(self, max_concurrency=1, max_images_per_minute=None, max_attempts=5, backoff_base=1.0, backoff_max=60.0, sleep=time.sleep):
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+        self.bucket = None
+        if max_images_per_minute:
+            rate = max_images_per_minute / 60
+            # Allow a burst of one full batch or one second of quota
+            self.bucket = TokenBucket(rate, capacity=max(MAX_IMAGES_PER_BATCH, rate), sleep=sleep)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    def annotate(self, client: vision.ImageAnnotatorClient, image_uris: List[str], feature_types: List[str], preprocessor: "ImagePreprocessor" = None, source: ImageSource = None) -> List[Tuple[str, vision.AnnotateImageResponse]]:
+        """
+        Analyzes a group of images with batch_annotate_images calls, retrying the failed ones.
+
+        Args:
+            client (vision.ImageAnnotatorClient): Client for the Vision API.
+            image_uris (List[str]): URIs of the images to analyze, at most MAX_IMAGES_PER_BATCH.
+            feature_types (List[str]): A list of feature types to include in the analysis.
+            preprocessor (ImagePreprocessor): Downscales the large images before sending them.
+            source (ImageSource): Source reading the content of the images sent as content.
+
+        Returns:
+            List[Tuple[str, vision.AnnotateImageResponse]]: Pairs of image URI and its response,
+                in the same order as `image_uris`.
+        """
+        results = {}
+        pending = list(image_uris)
+
+        for attempt in range(1, self.max_attempts + 1):
+            batch_results, throttled = self._call(client, pending, feature_types, preprocessor, source)
+
+            # Keep the responses that are final and send the rest again
+            retry = []
+            for image_uri, response in batch_results:
+                if response.error.code in RETRYABLE_CODES and attempt < self.max_attempts:
+                    retry.append(image_uri)
+                else:
+                    results[image_uri] = response
+
+            if not retry:
+                break
+
+            with self._lock:
+                self.retries += len(retry)
+            get_metrics().increment("vision_retries", len(retry))
+            self._sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))))
+            pending = retry
+
+        return [(image_uri, results[image_uri]) for image_uri in image_uris]
+
+    def _call(self, client, image_uris, feature_types, preprocessor=None, source=None):
+        """
+        Sends a single call once the rate and concurrency limits allow it.
+
+        Returns:
+            Tuple[List[Tuple[str, vision.AnnotateImageResponse]], bool]: The responses, and
+                whether the call was throttled.
+        """
+        if self.bucket is not None:
+            self.bucket.acquire(len(image_uris))
+
+        ticket = self.limiter.acquire()
+        throttled = False
+        try:
+            batch_results = analyze_images_from_uris(client, image_uris, feature_types, preprocessor, source)
+            throttled = any(response.error.code == RESOURCE_EXHAUSTED for _, response in batch_results)
+        except tuple(RETRYABLE_EXCEPTIONS) as e:
+            # Turn the failure of the whole call into an error of each image
+            code = next(code for exception_type, code in RETRYABLE_EXCEPTIONS.items() if isinstance(e, exception_type))
+            throttled = code == RESOURCE_EXHAUSTED
+            batch_results = [
+                (image_uri, vision.AnnotateImageResponse(error={"code": code, "message": str(e)}))
+                for image_uri in image_uris
+            ]
+        finally:
+            self.limiter.release(ticket, throttled)
+
+        with self._lock:
+            self.calls += 1
+            self.throttled += throttled
+        if throttled:
+            get_metrics().increment("vision_throttled_calls")
+
+        return batch_results, throttled
+
+    def summary(self) -> str:
+        """
+        Returns a one-line summary of the calls sent.
+        """
+        return f"{self.calls} calls, {self.retries} image retries, {self.throttled} throttled calls, concurrency limit {self.limiter.limit:.1f}"
+
+
+class DeadLetterWriter:
+    """
+    Appends the images that could not be annotated to an NDJSON file, one line per image:
+    `{"creative_uri", "blob_name", "generation", "code", "message", "failed_at"}`.
+
+    Args:
+        path (str): Path to the dead-letter file. Lines are appended to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, "a")
+
+    def write(self, creative_uri, blob_name, generation, error):
+        """
+        Records a failed image.
+
+        Args:
+            creative_uri (str): URI of the creative.
+            blob_name (str): Name of the blob.
+            generation (int): Generation of the blob.
+            error (google.rpc.Status): Error of the response.
+        """
+        self._file.write(json.dumps({
+            "creative_uri": creative_uri,
+            "blob_name": blob_name,
+            "generation": generation,
+            "code": error.code,
+            "message": error.message,
+            "failed_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }) + "\n")
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def parse_features(features) -> List[vision.Feature.Type]:
+    """
+    Resolves the features requested for a run.
+
+    Args:
+        features (Union[str, List]): A profile name of FEATURE_PROFILES, a comma-separated list of
+            `vision.Feature.Type` names (e.g. "LABEL_DETECTION,LOGO_DETECTION"), or a list of
+            feature types.
+
+    Returns:
+        List[vision.Feature.Type]: The feature types, without duplicates.
+    """
+    if isinstance(features, str):
+        if features in FEATURE_PROFILES:
+            return list(FEATURE_PROFILES[features])
+        names = [name.strip().upper() for name in features.split(",") if name.strip()]
+        try:
+            features = [vision.Feature.Type[name] for name in names]
+        except KeyError as e:
+            raise ValueError(f"Unknown feature {e}. Use a profile ({', '.join(FEATURE_PROFILES)}) or vision.Feature.Type names") from None
+
+    return list(dict.fromkeys(vision.Feature.Type(feature) for feature in features))
+
+
+@functools.lru_cache(maxsize=None)
+def _feature_set_name(feature_types: tuple) -> str:
+    for name, profile in FEATURE_PROFILES.items():
+        if set(profile) == set(feature_types):
+            return name
+    return "+".join(sorted(vision.Feature.Type(feature).name for feature in feature_types))
+
+
+def feature_set_name(feature_types: List[str]) -> str:
+    """
+    Names a set of features in the metrics: the name of its profile, or its sorted feature types.
+    """
+    return _feature_set_name(tuple(vision.Feature.Type(feature) for feature in feature_types))
+
+
+def build_annotate_request(image_uri: str, feature_types: List[str], content: bytes = None) -> vision.AnnotateImageRequest:
+    """
+    Builds the AnnotateImageRequest for the image in the given URI.
+
     Args:
         image_uri (str): The URI of the image to analyze.
         feature_types (List[str]): A list of feature types to include in the analysis.
-    
+        content (bytes): Encoded image sent instead of the URI, e.g. a downscaled version.
+
     Returns:
-        vision.AnnotateImageResponse: The response from the Vision API containing the analysis results.
+        vision.AnnotateImageRequest: The request ready to be sent to the Vision API.
     """
-    # Create a client for the Vision API
-    client = vision.ImageAnnotatorClient()
-
-    # Create an Image object and set the image URI
+    # Create an Image object and set the image URI, or its content when it is already loaded
     image = vision.Image()
-    image.source.image_uri = image_uri
+    if content is not None:
+        image.content = content
+    else:
+        image.source.image_uri = image_uri
 
     # Create a list of Feature objects based on the given feature types
     features = [vision.Feature(type_=feature_type) for feature_type in feature_types]
 
     # Create an AnnotateImageRequest with the image and features
-    request = vision.AnnotateImageRequest(image=image, features=features)
+    return vision.AnnotateImageRequest(image=image, features=features)
+
+
+def analyze_image_from_uri(image_uri: str, feature_types: List[str], client: vision.ImageAnnotatorClient = None) -> vision.AnnotateImageResponse:
+    """
+    Analyzes an image from the given URI using the specified feature types and returns the response.
+    
+    Args:
+        image_uri (str): The URI of the image to analyze.
+        feature_types (List[str]): A list of feature types to include in the analysis.
+        client (vision.ImageAnnotatorClient): Client for the Vision API. Defaults to a pooled
+            client of the default registry.
+    
+    Returns:
+        vision.AnnotateImageResponse: The response from the Vision API containing the analysis results.
+    """
+    # Reuse a pooled client for the Vision API
+    client = client or get_default_registry().vision_client()
+
+    # Create the request for the image
+    request = build_annotate_request(image_uri, feature_types)
 
     # Send the request to the Vision API and get the response
     response = client.annotate_image(request=request)
@@ -36,9 +340,193 @@ def analyze_image_from_uri(image_uri: str, feature_types: List[str]) -> vision.A
     return response
 
 
-def process_images(input_bucket_name, output_dataset_name, project_id, auth_path, write_disposition):
+def analyze_images_from_uris(client: vision.ImageAnnotatorClient, image_uris: List[str], feature_types: List[str], preprocessor: "ImagePreprocessor" = None, source: ImageSource = None) -> List[Tuple[str, vision.AnnotateImageResponse]]:
+    """
+    Analyzes a group of images with a single batch_annotate_images call.
+
+    The responses of a batch come back in the same order as the requests, so each
+    one is paired with the URI it belongs to. Images sent as content are split across
+    several calls when they add up to more than MAX_REQUEST_CONTENT_BYTES. Images that fail inside the batch keep
+    their error in `response.error` and do not affect the rest of the batch.
+
+    Args:
+        client (vision.ImageAnnotatorClient): Client for the Vision API.
+        image_uris (List[str]): URIs of the images to analyze, at most MAX_IMAGES_PER_BATCH.
+        feature_types (List[str]): A list of feature types to include in the analysis.
+        preprocessor (ImagePreprocessor): Downscales the large images, which are then sent as
+            content. Their coordinates are scaled back to the original pixels.
+        source (ImageSource): Source reading the images sent as content, e.g. the files of a
+            local directory. None sends the URIs.
+
+    Returns:
+        List[Tuple[str, vision.AnnotateImageResponse]]: Pairs of image URI and its response.
+    """
+    if len(image_uris) > MAX_IMAGES_PER_BATCH:
+        raise ValueError(f"A batch can contain at most {MAX_IMAGES_PER_BATCH} images, got {len(image_uris)}")
+
+    metrics = get_metrics()
+
+    # Downscale the large images before sending them, or read the images that are not in GCS
+    if preprocessor is not None:
+        prepared = preprocessor.prepare_all(image_uris)
+    elif source is not None:
+        with metrics.timer("image_read"):
+            prepared = [(content, 1.0, 1.0) for content in source.read_all(image_uris)]
+    else:
+        prepared = [(None, 1.0, 1.0)] * len(image_uris)
+
+    # Create one request per image
+    requests = [build_annotate_request(image_uri, feature_types, content) for image_uri, (content, _, _) in zip(image_uris, prepared)]
+
+    # Send the requests in as few calls to the Vision API as the request size allows
+    responses = []
+    for call_requests in chunk_by_content_bytes(requests, [content for content, _, _ in prepared], MAX_REQUEST_CONTENT_BYTES):
+        with metrics.timer("vision_call", features=feature_set_name(feature_types)):
+            batch_response = client.batch_annotate_images(requests=call_requests)
+        metrics.increment("vision_calls")
+        metrics.increment("vision_images", len(call_requests))
+        responses.extend(batch_response.responses)
+
+    # Report the coordinates in the pixels of the original images
+    for response, (_, scale_x, scale_y) in zip(responses, prepared):
+        if scale_x != 1.0 or scale_y != 1.0:
+            from utils.image_utils import rescale_response
+            rescale_response(response, scale_x, scale_y)
+
+    return list(zip(image_uris, responses))
+
+
+def chunk_by_content_bytes(requests: list, contents: List[Optional[bytes]], max_bytes: int) -> Iterator[list]:
+    """
+    Splits the requests of a batch into consecutive groups whose content adds up to at most
+    `max_bytes`. Requests sent by URI weigh nothing, so a batch without content is a single group.
+
+    Args:
+        requests (list): Requests of the batch.
+        contents (List[Optional[bytes]]): Content of each request, None for the ones sent by URI.
+        max_bytes (int): Maximum content of a group. A single larger request gets a group alone.
+
+    Yields:
+        list: The next group of requests.
+    """
+    group = []
+    group_bytes = 0
+    for request, content in zip(requests, contents):
+        content_bytes = len(content) if content is not None else 0
+        if group and group_bytes + content_bytes > max_bytes:
+            yield group
+            group = []
+            group_bytes = 0
+        group.append(request)
+        group_bytes += content_bytes
+    if group:
+        yield group
+
+
+def analyze_images_with_cache(client: vision.ImageAnnotatorClient, images: List[Tuple[str, Optional[str]]], feature_types: List[str], cache: "AnnotationCache" = None, scheduler: AnnotationScheduler = None, preprocessor: "ImagePreprocessor" = None, source: ImageSource = None) -> List[Tuple[str, vision.AnnotateImageResponse]]:
+    """
+    Analyzes a group of images, serving the ones already in the cache without calling the Vision API.
+
+    Args:
+        client (vision.ImageAnnotatorClient): Client for the Vision API.
+        images (List[Tuple[str, Optional[str]]]): Pairs of image URI and cache key. A None key
+            always calls the Vision API.
+        feature_types (List[str]): A list of feature types to include in the analysis.
+        cache (AnnotationCache): Cache of previous responses. None disables the cache.
+        scheduler (AnnotationScheduler): Scheduler sending the misses with rate limiting and
+            retries. If None, the misses are sent in a single call.
+        preprocessor (ImagePreprocessor): Downscales the large images before sending them.
+        source (ImageSource): Source reading the images sent as content. None sends the URIs.
+
+    Returns:
+        List[Tuple[str, vision.AnnotateImageResponse]]: Pairs of image URI and its response,
+            in the same order as `images`.
+    """
+    # Look up every image in the cache
+    responses = [cache.get(key) if cache is not None and key else None for _, key in images]
+
+    # Send the misses in a single call to the Vision API, once per distinct content
+    misses = {}
+    for index, response in enumerate(responses):
+        if response is None:
+            key = images[index][1]
+            misses.setdefault(key if cache is not None and key else index, []).append(index)
+    if misses:
+        miss_indexes = [indexes[0] for indexes in misses.values()]
+        miss_uris = [images[index][0] for index in miss_indexes]
+        if scheduler is not None:
+            miss_results = scheduler.annotate(client, miss_uris, feature_types, preprocessor, source)
+        else:
+            miss_results = analyze_images_from_uris(client, miss_uris, feature_types, preprocessor, source)
+        for (key, indexes), (_, response) in zip(misses.items(), miss_results):
+            for index in indexes:
+                responses[index] = response
+            if isinstance(key, str):
+                cache.put(key, response)
+
+    return [(image_uri, response) for (image_uri, _), response in zip(images, responses)]
+
+
+def analyze_images_in_batches(images: Iterable[Tuple[str, Optional[str]]], feature_types: List[str], batch_size: int = MAX_IMAGES_PER_BATCH, concurrency: int = 1, ordered: bool = False, registry: ClientRegistry = None, cache: "AnnotationCache" = None, scheduler: AnnotationScheduler = None, preprocessor: "ImagePreprocessor" = None, source: ImageSource = None) -> Iterator[Tuple[str, vision.AnnotateImageResponse]]:
+    """
+    Analyzes images grouping them into batch_annotate_images calls.
+
+    With `concurrency` greater than one, several batches are sent at the same time from a
+    thread pool. At most `concurrency` batches are in flight, and the images are only pulled
+    from `images` as slots free up.
+
+    Args:
+        images (Iterable[Tuple[str, Optional[str]]]): Pairs of image URI and cache key.
+        feature_types (List[str]): A list of feature types to include in the analysis.
+        batch_size (int): Number of images per call, up to MAX_IMAGES_PER_BATCH.
+        concurrency (int): Maximum number of batches in flight.
+        ordered (bool): If True, responses are yielded in the same order as `images`.
+        registry (ClientRegistry): Registry providing the pooled Vision clients. Defaults to
+            the default registry.
+        cache (AnnotationCache): Cache of previous responses. None disables the cache.
+        scheduler (AnnotationScheduler): Scheduler of the calls, applying rate limiting and
+            retries. None sends every batch once, as soon as a slot is free.
+        preprocessor (ImagePreprocessor): Downscales the large images before sending them.
+        source (ImageSource): Source reading the images sent as content. None sends the URIs.
+
+    Yields:
+        Tuple[str, vision.AnnotateImageResponse]: Pairs of image URI and its response.
+    """
+    registry = registry or get_default_registry()
+
+    batches = chunk_iterable(images, min(batch_size, MAX_IMAGES_PER_BATCH))
+
+    # Each batch takes the next channel of the pool
+    def analyze_batch(batch):
+        return analyze_images_with_cache(registry.vision_client(), batch, feature_types, cache, scheduler, preprocessor, source)
+
+    for batch_results in bounded_map(analyze_batch, batches, concurrency, ordered=ordered):
+        yield from batch_results
+
+
+def chunk_iterable(iterable: Iterable, size: int) -> Iterator[list]:
+    """
+    Splits an iterable into lists of at most `size` elements without materializing it.
+
+    Args:
+        iterable (Iterable): Elements to split.
+        size (int): Maximum number of elements per chunk.
+
+    Yields:
+        list: The next chunk of elements.
     """
-    Process images in a GCS bucket using the Cloud Vision API and save the output in another GCS bucket.
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_images(input_bucket_name, output_dataset_name, project_id, auth_path, write_disposition, batch_size=MAX_IMAGES_PER_BATCH, concurrency=1, ordered=False, channel_pool_size=1, cache_backend=None, cache_path=None, cache_max_entries=None, cache_max_bytes=None, cache_max_age_seconds=None, checkpoint_path=None, checkpoint_interval=1000, output_max_rows=None, output_max_bytes=None, sink_type="file", output_format="ndjson", bq_chunk_rows=5000, bq_max_pending_jobs=4, features="full", formatter="fast", output_layout="nested", ocr_mode="full", archive_dir=None, mode="sync", async_output_uri=None, async_shard_size=2000, async_max_pending_operations=10, async_poll_interval=10.0, input_prefix=None, input_glob=None, content_types=("image/",), min_size=1, max_size=None, updated_after=None, listing_workers=1, listing_shard_depth=1, input_dir=None, source=None, max_images_per_minute=None, max_attempts=5, dead_letter_path=None, downscale_max_dimension=None, downscale_quality=85, dedup=None, dedup_threshold=8, num_shards=1, shard_index=0, format_workers=0, format_chunk_rows=256, pipeline_queue_size=None, metrics_path=None, openmetrics_path=None, metrics_port=None, profile_functions=(), profile_dir="profiles", registry=None):
+    """
+    Process images in a GCS bucket, or another image source, using the Cloud Vision API and
+    stream the output into NDJSON files named after the output dataset.
     
     Args:
         input_bucket_name (str): Name of the input GCS bucket containing the images.
@@ -46,7 +534,129 @@ def process_images(input_bucket_name, output_dataset_name, project_id, auth_path
         project_id (str): Name of the GCP project required for authentication.
         auth_path (str): Path to GCP authentication JSON file.
         write_disposition (str): BigQuery write disposition.
+        batch_size (int): Number of images sent in each Vision API call.
+        concurrency (int): Maximum number of Vision API calls in flight.
+        ordered (bool): Keep the output rows in the same order as the bucket listing.
+        channel_pool_size (int): Number of gRPC channels shared by the Vision API calls.
+        cache_backend (str): Annotation cache backend, "sqlite" or "disk". None disables the cache.
+        cache_path (str): Database file or directory of the annotation cache.
+        cache_max_entries (int): Maximum number of entries kept in the cache.
+        cache_max_bytes (int): Maximum total size of the cached responses.
+        cache_max_age_seconds (float): Maximum age of a cached response.
+        checkpoint_path (str): Path to the checkpoint manifest. When set, the run is incremental:
+            blobs already processed in their current generation are skipped, and the output is
+            synced together with the manifest every `checkpoint_interval` images. The rows of
+            a changed object are appended after the rows of its previous versions, so consumers
+            dedupe on `creative_id`, keeping the last row of the output files.
+        checkpoint_interval (int): Number of processed images between two checkpoints.
+        output_max_rows (int): Maximum number of rows per output file.
+        output_max_bytes (int): Maximum size in bytes of each output file.
+        sink_type (str): "file" to write NDJSON files, "bigquery" to stream the rows into the
+            output dataset with chunked load jobs while the annotation is running.
+        output_format (str): Format of the files written by the "file" sink, "ndjson" or
+            "parquet". Parquet files are compressed and use the explicit annotation schema.
+        bq_chunk_rows (int): Number of rows per BigQuery load job.
+        bq_max_pending_jobs (int): Maximum number of BigQuery load jobs running in parallel.
+        features (Union[str, List]): Features to request, see `parse_features`. Only the output
+            columns of these features are formatted and written.
+        formatter (str): "fast" for `format_json_fast`, "reference" for `format_json`. Both
+            produce the same rows.
+        output_layout (str): "nested" writes one wide row per creative, where the missing
+            annotations are padded with "Not Found" placeholders. "normalized" writes a slim
+            `creatives` table and a child table per annotation type keyed by `creative_id`
+            (labels, logos, text, faces, face_landmarks, objects, colors and web_entities),
+            without placeholders, see `normalized_format_utils`. Each table is written to its
+            own files, `{output_dataset_name}-{table}`, or its own BigQuery table.
+        ocr_mode (str): Entries of the text annotations. "full" keeps every entry with its
+            bounding box: the full text, then every word. "full_text" keeps the full text
+            only, "words" every entry without its bounding box, and "words_packed" every entry
+            with its bounding box packed into a `vertices` list of eight integers. The text
+            annotations of text-heavy creatives hold thousands of words, so the last three
+            modes cut the size of the rows and the time spent serializing them.
+        archive_dir (str): Directory of the raw response archive. When set, the serialized
+            response of every image is archived so rows can be regenerated offline with
+            `reformat_archive.py`.
+        mode (str): "sync" sends batch_annotate_images calls and waits for their responses.
+            "async_batch" submits async_batch_annotate_images operations writing their output
+            to `async_output_uri`, and ingests the output files as the operations finish. The
+            annotation cache is only available in "sync" mode.
+        async_output_uri (str): GCS prefix receiving the output of the async batches. Each run
+            writes into its own folder.
+        async_shard_size (int): Number of images per async batch operation, up to 2000.
+        async_max_pending_operations (int): Maximum number of async batch operations running
+            at the same time.
+        async_poll_interval (float): Seconds between two polls of the running operations.
+        input_prefix (str): Only annotate the blobs whose name starts with this prefix.
+        input_glob (str): Only annotate the blobs whose name matches this fnmatch pattern.
+        content_types (List[str]): Accepted content types, or prefixes ending with "/". Blobs
+            without a meaningful content type are accepted by their image extension. None
+            accepts any content type.
+        min_size (int): Minimum size in bytes of the annotated blobs. Empty blobs, folder
+            markers and hidden files are always skipped.
+        max_size (int): Maximum size in bytes of the annotated blobs.
+        updated_after (Union[datetime.datetime, str]): Only annotate the blobs updated after this time.
+        listing_workers (int): Number of prefix shards listed in parallel.
+        listing_shard_depth (int): Number of "folder" levels used to split the listing into shards.
+        input_dir (str): Local directory of images annotated instead of `input_bucket_name`. The
+            files are memory-mapped and sent as content, so they do not have to be uploaded
+            first. Each one is identified by its `file://` URI. The filters apply to the paths
+            relative to the directory. The calls are split to keep their content under
+            MAX_REQUEST_CONTENT_BYTES, and files over MAX_IMAGE_BYTES go to the dead letter
+            without being sent. Not available with downscaling, deduplication or the
+            "async_batch" mode, which read the images from GCS.
+        source (ImageSource): Source of the images, e.g. an `InMemorySource` when the pipeline
+            is embedded, see `source_utils`. Replaces `input_bucket_name` and `input_dir`.
+        max_images_per_minute (float): Images sent to the Vision API per minute, usually the
+            quota of the project. None disables the rate limit. The number of calls in flight
+            is also halved on throttling and grows back up to `concurrency`.
+        max_attempts (int): Number of attempts of the images failing with a transient error
+            (RESOURCE_EXHAUSTED, UNAVAILABLE, DEADLINE_EXCEEDED or INTERNAL).
+        dead_letter_path (str): NDJSON file where the images that could not be annotated are
+            appended. None only prints them.
+        downscale_max_dimension (int): When set, images larger than this many pixels are
+            downloaded, downscaled and sent as content instead of by URI. The coordinates of
+            the output are still in the pixels of the original images. Requires Pillow and the
+            "sync" mode.
+        downscale_quality (int): JPEG quality of the downscaled images.
+        dedup (str): Perceptual hash used to group near-identical images, "phash" or "dhash".
+            Only one image per group is annotated and its response is reused for the rest of
+            the group. The group is written in the `cluster_id` column. None disables the
+            deduplication. Requires Pillow and the "sync" mode.
+        dedup_threshold (int): Maximum Hamming distance, out of 64 bits, between the hashes
+            of the images of a group.
+        num_shards (int): Number of workers the bucket is split across, each one running with
+            its own `shard_index`. Blobs are partitioned by a hash of their name. Each worker
+            writes its own output part, `{output_dataset_name}-shard-{index}-of-{num_shards}`,
+            and marks it complete once written; `merge_shards.py` checks every part is complete
+            and loads them into BigQuery at once. Requires the "file" sink.
+        shard_index (int): Shard processed by this worker, between 0 and `num_shards - 1`.
+        format_workers (int): Number of worker processes formatting and serializing the rows.
+            The responses are passed to them as serialized protobuf bytes, and the listing,
+            annotation, formatting and sink stages run at the same time. 0 formats the rows in
+            the thread writing them.
+        format_chunk_rows (int): Number of rows sent to a formatting process at once.
+        pipeline_queue_size (int): Maximum number of chunks between the annotation and the
+            sink. Defaults to twice `format_workers`.
+        metrics_path (str): JSON file receiving the run report: elapsed time, images per second,
+            counters (Vision calls, images, errors, retries, rows and bytes emitted...) and
+            latency histograms of every stage, including the Vision calls per feature set.
+        openmetrics_path (str): File receiving the same metrics in the OpenMetrics text format.
+        metrics_port (int): Serve the metrics in the OpenMetrics text format on
+            `http://0.0.0.0:{metrics_port}/metrics` while the run lasts.
+        profile_functions (List[str]): cProfile hooks to enable among "vision_call", "format",
+            "serialize", "sink_write", "bq_load" and "image_read".
+        profile_dir (str): Directory receiving a `{hook}.prof` file per enabled hook.
+        registry (ClientRegistry): Prebuilt client registry, for example one holding fake clients.
+            By default it is built from `project_id` and `auth_path`.
     """
+    # An empty batch would end the run without annotating anything
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+
+    # Collect the metrics of this run only
+    metrics = start_run(profile_functions)
+    metrics_server = metrics.serve(metrics_port) if metrics_port else None
+
     # Create the config file to avoid so many arguments
     config = {
         "project_id": project_id,
@@ -54,61 +664,446 @@ def process_images(input_bucket_name, output_dataset_name, project_id, auth_path
         "output_dataset_name": output_dataset_name
     }
 
-    # Initialize GCS client with the specified project ID
-    storage_client = storage.Client()
-
-    # Get the input and output buckets
-    input_bucket = storage_client.get_bucket(config['input_bucket_name'])
-
-    ## Get all blobs (images) in the input bucket
-    blobs = input_bucket.list_blobs()
+    # Build every client once from the same credentials
+    if registry is None:
+        registry = ClientRegistry(project_id=config['project_id'], auth_file=auth_path, channel_pool_size=channel_pool_size)
 
-    # Create credentials for BigQuery
-    credentials_bq = service_account.Credentials.from_service_account_file(auth_path)
+    # Read the images from the input bucket unless they come from elsewhere
+    if source is None and input_dir:
+        source = LocalDirectorySource(input_dir)
+    elif source is None:
+        source = GcsImageSource(registry.storage_client(), config['input_bucket_name'], listing_workers, listing_shard_depth)
 
-    # Create a BigQuery client
-    bq_client = bigquery.Client(project=config['project_id'], credentials=credentials_bq)
+    ## Get the image blobs of the input bucket, skipping everything the Vision API cannot annotate
+    blob_filter = BlobFilter(
+        prefix=input_prefix,
+        glob=input_glob,
+        content_types=content_types,
+        min_size=min_size,
+        max_size=max_size,
+        updated_after=updated_after,
+        num_shards=num_shards,
+        shard_index=shard_index
+    )
+    blobs = metrics.timed_iter(source.list_images(blob_filter), "listing")
 
     # Define the output and table name
     table_name = f"gcp_vision_api_annotations"
 
     # Features
-    features = [
-        vision.Feature.Type.OBJECT_LOCALIZATION,
-        vision.Feature.Type.FACE_DETECTION,
-        # vision.Feature.Type.LANDMARK_DETECTION, # detects popular natural and human-made structures in the image, providing lat and long.
-        vision.Feature.Type.LOGO_DETECTION, 
-        vision.Feature.Type.LABEL_DETECTION,
-        vision.Feature.Type.TEXT_DETECTION, 
-        #vision.Feature.Type.DOCUMENT_TEXT_DETECTION, # for documents
-        vision.Feature.Type.SAFE_SEARCH_DETECTION,
-        vision.Feature.Type.IMAGE_PROPERTIES,
-        vision.Feature.Type.CROP_HINTS,
-        vision.Feature.Type.WEB_DETECTION,
-        vision.Feature.Type.PRODUCT_SEARCH,
-    ]
-    
-    response_list = []
-    for blob in blobs:
-        # Get the URI of the image blob
-        image_uri = f"gs://{config['input_bucket_name']}/{blob.name}"
-
-        response = analyze_image_from_uri(image_uri, features)
-
-        # Save the analysis results to BQ
-        creative_data = format_json(
-            response=response, 
-            creative_id=image_uri, # We need to change this!
-            creative_uri=image_uri
+    features = parse_features(features)
+
+    # Reuse the responses of creatives already annotated under another name
+    cache = None
+    if cache_backend:
+        from utils.cache_utils import create_annotation_cache
+        cache = create_annotation_cache(
+            cache_backend,
+            cache_path,
+            max_entries=cache_max_entries,
+            max_bytes=cache_max_bytes,
+            max_age_seconds=cache_max_age_seconds
         )
 
-        response_list.append(creative_data)
+    # Skip the blobs already processed in their current generation
+    manifest = None
+    if checkpoint_path:
+        # Truncating the table would drop the rows of the blobs the manifest skips
+        if sink_type == "bigquery" and (write_disposition or "WRITE_APPEND") != "WRITE_APPEND":
+            raise ValueError(f"Incremental runs into BigQuery require the WRITE_APPEND write disposition, got {write_disposition}")
+        from utils.checkpoint_utils import CheckpointManifest
+        manifest = CheckpointManifest(checkpoint_path, flush_interval=checkpoint_interval)
+        print(f"Checkpoint manifest: {len(manifest)} blobs already processed")
+        blobs = (blob for blob in blobs if not manifest.is_processed(blob.name, blob.generation))
+
+    # Both formatters produce the same rows of the nested layout
+    row_formatter = get_row_formatter(formatter, output_layout, ocr_mode)
+
+    # Format and serialize on the other cores, NDJSON lines are written as they come
+    formatter_pool = None
+    if format_workers:
+        serialize = output_layout == "nested" and not (sink_type == "file" and output_format == "parquet")
+        formatter_pool = FormatterPool(format_workers, features, formatter, serialize, format_chunk_rows, pipeline_queue_size, output_layout, ocr_mode)
+
+    # Keep the raw responses for offline re-formatting and backfills
+    archive = None
+    if archive_dir:
+        from utils.archive_utils import ResponseArchiveWriter
+        archive = ResponseArchiveWriter(archive_dir)
+
+    # Record the images that keep failing
+    dead_letter = DeadLetterWriter(dead_letter_path) if dead_letter_path else None
+
+    # Send smaller versions of the large images
+    preprocessor = None
+    if downscale_max_dimension:
+        if mode != "sync":
+            raise ValueError("Downscaling is only available in sync mode")
+        if source.sends_content:
+            raise ValueError("Downscaling is only available for images read from GCS")
+        from utils.image_utils import ImagePreprocessor
+        preprocessor = ImagePreprocessor(registry.storage_client(), downscale_max_dimension, downscale_quality)
 
-    # Write the creative data to BigQuery
-    #write_to_bq(bq_client, config['output_dataset_name'], table_name, response_list, write_disposition)
-    # Save all JSON objects to a single file
-    file_path = config['output_dataset_name'] + ".json"
-    with open(file_path, "w") as file:
-        json.dump(response_list, file)
+    # Annotate a single image per group of near-duplicates
+    deduper = None
+    if dedup:
+        if mode != "sync":
+            raise ValueError("Deduplication is only available in sync mode")
+        if source.sends_content:
+            raise ValueError("Deduplication is only available for images read from GCS")
+        from utils.dedup_utils import NearDuplicateDeduper
+        deduper = NearDuplicateDeduper(registry.storage_client(), dedup, dedup_threshold)
+
+    scheduler = None
+    if mode == "sync":
+        # Stay under the quota and retry the transient failures
+        scheduler = AnnotationScheduler(max_concurrency=concurrency, max_images_per_minute=max_images_per_minute, max_attempts=max_attempts)
+        rows = iter_creative_rows(blobs, config['input_bucket_name'], features, batch_size, concurrency, ordered, registry, cache, row_formatter, archive, scheduler, dead_letter, preprocessor, deduper, formatter_pool, source)
+    elif mode == "async_batch":
+        if not async_output_uri:
+            raise ValueError("async_output_uri is required in async_batch mode")
+        if cache is not None:
+            raise ValueError("The annotation cache is not available in async_batch mode")
+        if source.sends_content:
+            raise ValueError("The async_batch mode is only available for images read from GCS")
+        rows = iter_async_batch_rows(blobs, source.bucket_name, features, async_output_uri, async_shard_size, async_max_pending_operations, async_poll_interval, concurrency, registry, row_formatter, archive, dead_letter, formatter_pool)
+    else:
+        raise ValueError(f"Unknown mode '{mode}'. Use sync or async_batch")
+
+    # Each shard writes its own output part, merged once every shard is done
+    output_prefix = config['output_dataset_name']
+    if num_shards > 1:
+        if sink_type != "file":
+            raise ValueError("Sharded runs require the file sink. Merge their parts with merge_shards.py")
+        if output_layout != "nested":
+            raise ValueError("Sharded runs require the nested layout")
+        from utils.shard_utils import clear_shard_marker, shard_path_prefix
+        output_prefix = shard_path_prefix(output_prefix, shard_index, num_shards)
+        clear_shard_marker(output_prefix)
+
+    # Resumed runs drop the rows written after the last checkpoint, their blobs are annotated again
+    committed_files = manifest.sink_files if manifest is not None else None
+
+    # Stream the rows into the sink of each table as they are formatted
+    def open_sink(table, path_prefix, schema):
+        if sink_type == "bigquery":
+            return BigQuerySink(
+                registry.bigquery_client(),
+                config['output_dataset_name'],
+                table,
+                write_disposition,
+                schema=to_bigquery_schema(schema),
+                chunk_rows=bq_chunk_rows,
+                max_pending_jobs=bq_max_pending_jobs,
+                # Rows are only loaded once their blobs are about to be checkpointed
+                load_on_flush=manifest is not None
+            )
+        elif sink_type == "file" and output_format == "parquet":
+            # Incremental runs keep the files written by the previous runs
+            return ParquetSink(path_prefix, schema, max_rows=output_max_rows, max_bytes=output_max_bytes, append=manifest is not None, committed_files=committed_files)
+        elif sink_type == "file" and output_format == "ndjson":
+            return NdjsonSink(path_prefix, max_rows=output_max_rows, max_bytes=output_max_bytes, append=manifest is not None, committed_files=committed_files)
+        raise ValueError(f"Unknown sink '{sink_type}' with output format '{output_format}'")
+
+    if output_layout == "normalized":
+        schemas = normalized_schema(features, with_cluster_id=deduper is not None, ocr_mode=ocr_mode)
+        sink = NormalizedSink({table: open_sink(table, f"{output_prefix}-{table}", schema) for table, schema in schemas.items()})
+    else:
+        sink = open_sink(table_name, output_prefix, annotation_schema(features, with_cluster_id=deduper is not None, ocr_mode=ocr_mode))
+
+    with sink:
+        # Roll a crash before the first checkpoint back to the files the run starts from
+        if manifest is not None:
+            manifest.flush(sink.committed_files())
+
+        for blob_name, blob_generation, creative_data in rows:
+            if isinstance(creative_data, bytes):
+                sink.write_line(creative_data)
+            else:
+                sink.write(creative_data)
+
+            # Make the rows durable before recording their blobs in the manifest
+            if manifest is not None:
+                manifest.mark(blob_name, blob_generation)
+                if manifest.should_flush:
+                    sink.flush()
+                    if archive is not None:
+                        archive.flush()
+                    if dead_letter is not None:
+                        dead_letter.flush()
+                    manifest.flush(sink.committed_files())
+
+        sink.flush()
+        if archive is not None:
+            archive.close()
+        if dead_letter is not None:
+            dead_letter.close()
+        if manifest is not None:
+            manifest.flush(sink.committed_files())
+
+    print(f"Wrote {sink.rows_written} rows")
+
+    if num_shards > 1:
+        from utils.shard_utils import write_shard_marker
+        write_shard_marker(output_prefix, shard_index, num_shards, sink.extension, annotation_schema(features, with_cluster_id=deduper is not None, ocr_mode=ocr_mode))
+        print(f"Shard {shard_index} of {num_shards} complete")
+
+    if scheduler is not None:
+        print(f"Vision API: {scheduler.summary()}")
+    if deduper is not None:
+        print(f"Deduplication: {deduper.summary()}")
+    if preprocessor is not None:
+        print(f"Downscaling: {preprocessor.summary()}")
+        preprocessor.close()
+    if formatter_pool is not None:
+        print(f"Formatting: {formatter_pool.chunks} chunks in {formatter_pool.workers} processes")
+        formatter_pool.close()
+    if dead_letter is not None and dead_letter.count:
+        print(f"{dead_letter.count} images could not be annotated, see {dead_letter.path}")
+
+    if cache is not None:
+        print(f"Annotation cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
+
+    # Report where the time went
+    metrics.increment("blobs_listed", blob_filter.accepted, result="accepted")
+    for reason, count in blob_filter.rejected.items():
+        metrics.increment("blobs_listed", count, result=reason)
+    if dead_letter is not None:
+        metrics.increment("dead_letters", dead_letter.count)
+    report = metrics.report()
+    print(f"Throughput: {report['images_per_second']:.1f} images/s over {report['elapsed_seconds']:.1f}s")
+    if metrics_path:
+        metrics.write_report(metrics_path)
+    if openmetrics_path:
+        metrics.write_openmetrics(openmetrics_path)
+    if metrics.profiler is not None:
+        print(f"Profiles: {', '.join(metrics.profiler.dump(profile_dir))}")
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
     return 'OK'
+
+
+def iter_creative_rows(blobs, input_bucket_name, features, batch_size=MAX_IMAGES_PER_BATCH, concurrency=1, ordered=False, registry=None, cache=None, formatter=format_json_fast, archive=None, scheduler=None, dead_letter=None, preprocessor=None, deduper=None, formatter_pool=None, source=None) -> Iterator[Tuple[str, int, dict]]:
+    """
+    Annotates the blobs and yields their formatted rows as soon as each batch finishes.
+
+    Only the batches in flight are held in memory, so the rows can be streamed into a sink
+    whatever the size of the bucket.
+
+    Args:
+        blobs (Iterable[storage.Blob]): Blobs to annotate.
+        input_bucket_name (str): Name of the bucket containing the blobs.
+        features (List[str]): A list of feature types to include in the analysis.
+        batch_size (int): Number of images sent in each Vision API call.
+        concurrency (int): Maximum number of Vision API calls in flight.
+        ordered (bool): Yield the rows in the same order as `blobs`.
+        registry (ClientRegistry): Registry providing the pooled Vision clients.
+        cache (AnnotationCache): Cache of previous responses. None disables the cache.
+        formatter (Callable): Function formatting a response into a row.
+        archive (ResponseArchiveWriter): Archive of the raw responses. None disables the archive.
+        scheduler (AnnotationScheduler): Scheduler of the calls, applying rate limiting and retries.
+        dead_letter (DeadLetterWriter): Receives the images that could not be annotated.
+        preprocessor (ImagePreprocessor): Downscales the large images before sending them.
+        deduper (NearDuplicateDeduper): Annotates one image per group of near-duplicates. The
+            rows of the rest of a group follow the row of its annotated image, whatever `ordered`.
+        formatter_pool (FormatterPool): Formats the rows in worker processes, see `format_responses`.
+        source (ImageSource): Source of the blobs, naming their URIs and reading the ones sent
+            as content. None sends the `gs://` URIs of `input_bucket_name`.
+
+    Yields:
+        Tuple[str, int, dict]: Name and generation of the blob, and its formatted row.
+    """
+    # Only the sources outside of GCS read the images themselves
+    content_source = source if source is not None and source.sends_content else None
+
+    # Cache keys hash the content of the blobs
+    if cache is not None:
+        from utils.cache_utils import annotation_cache_key
+
+    # Responses of downscaled images may differ slightly, keep them apart in the cache
+    cache_variant = preprocessor.cache_variant if preprocessor is not None else None
+
+    # Keep the name and generation of the images in flight
+    in_flight = {}
+
+    def iter_images():
+        # Hash the images ahead when near-duplicates are grouped
+        hashed_blobs = deduper.hash_blobs(blobs) if deduper is not None else ((blob, None) for blob in blobs)
+
+        # Get the URI and the content-based cache key of each image blob
+        for blob, perceptual_hash in hashed_blobs:
+            image_uri = source.image_uri(blob) if source is not None else f"gs://{input_bucket_name}/{blob.name}"
+
+            # The Vision API would reject the whole call, so the images too large to be sent as content never reach it
+            if content_source is not None and blob.size > MAX_IMAGE_BYTES:
+                reject_image(image_uri, blob.name, blob.generation, f"Image of {blob.size} bytes is over the {MAX_IMAGE_BYTES} bytes accepted as content", dead_letter)
+                continue
+
+            in_flight[image_uri] = (blob.name, blob.generation)
+
+            # Near-duplicates reuse the response of their group
+            if deduper is not None and not deduper.assign(image_uri, perceptual_hash):
+                continue
+
+            yield image_uri, annotation_cache_key(blob, features, cache_variant) if cache else None
+
+    responses = analyze_images_in_batches(iter_images(), features, batch_size, concurrency, ordered, registry, cache, scheduler, preprocessor, content_source)
+
+    if deduper is not None:
+        responses = deduper.fan_out(responses)
+
+    yield from format_responses(responses, in_flight, features, formatter, archive, dead_letter, deduper.cluster_ids if deduper is not None else None, formatter_pool)
+
+
+def iter_async_batch_rows(blobs, input_bucket_name, features, output_uri, shard_size=2000, max_pending_operations=10, poll_interval=10.0, concurrency=1, registry=None, formatter=format_json_fast, archive=None, dead_letter=None, formatter_pool=None) -> Iterator[Tuple[str, int, dict]]:
+    """
+    Annotates the blobs with async_batch_annotate_images operations and yields their
+    formatted rows as the output of each operation is ingested.
+
+    The output files are written under a folder of `output_uri` unique to the run, so the
+    output of previous runs is never ingested again.
+
+    Args:
+        blobs (Iterable[storage.Blob]): Blobs to annotate.
+        input_bucket_name (str): Name of the bucket containing the blobs.
+        features (List[str]): A list of feature types to include in the analysis.
+        output_uri (str): GCS prefix receiving the output of the operations.
+        shard_size (int): Number of images per operation.
+        max_pending_operations (int): Maximum number of operations running at the same time.
+        poll_interval (float): Seconds between two polls of the running operations.
+        concurrency (int): Maximum number of output files downloaded in parallel.
+        registry (ClientRegistry): Registry providing the Vision and Storage clients.
+        formatter (Callable): Function formatting a response into a row.
+        archive (ResponseArchiveWriter): Archive of the raw responses. None disables the archive.
+        dead_letter (DeadLetterWriter): Receives the images that could not be annotated.
+        formatter_pool (FormatterPool): Formats the rows in worker processes, see `format_responses`.
+
+    Yields:
+        Tuple[str, int, dict]: Name and generation of the blob, and its formatted row.
+    """
+    from utils.async_batch_utils import analyze_images_async
+
+    registry = registry or get_default_registry()
+
+    # Keep the name and generation of the images submitted and not ingested yet
+    in_flight = {}
+
+    def iter_image_uris():
+        for blob in blobs:
+            image_uri = f"gs://{input_bucket_name}/{blob.name}"
+            in_flight[image_uri] = (blob.name, blob.generation)
+            yield image_uri
+
+    run_output_uri = f"{output_uri.rstrip('/')}/{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}/"
+    print(f"Writing the async batch output to {run_output_uri}")
+
+    responses = analyze_images_async(
+        registry.vision_client(),
+        registry.storage_client(),
+        iter_image_uris(),
+        features,
+        run_output_uri,
+        shard_size=shard_size,
+        max_pending_operations=max_pending_operations,
+        poll_interval=poll_interval,
+        concurrency=concurrency
+    )
+
+    yield from format_responses(responses, in_flight, features, formatter, archive, dead_letter, formatter_pool=formatter_pool)
+
+
+def reject_image(image_uri, blob_name, blob_generation, message, dead_letter=None):
+    """
+    Records an image that is not sent to the Vision API as failed with INVALID_ARGUMENT, the
+    way `iter_annotated` records the images failing in the Vision API.
+
+    Args:
+        image_uri (str): URI of the image.
+        blob_name (str): Name of the blob.
+        blob_generation (int): Generation of the blob.
+        message (str): Why the image is rejected.
+        dead_letter (DeadLetterWriter): Receives the image. None only prints it.
+    """
+    error = vision.AnnotateImageResponse(error={"code": INVALID_ARGUMENT, "message": message}).error
+    get_metrics().increment("vision_errors", code=INVALID_ARGUMENT)
+    print(f"ERROR - {image_uri}: {message}")
+    if dead_letter is not None:
+        dead_letter.write(image_uri, blob_name, blob_generation, error)
+
+
+def iter_annotated(responses, in_flight, archive=None, dead_letter=None, cluster_ids=None) -> Iterator[Tuple[str, int, str, vision.AnnotateImageResponse, dict]]:
+    """
+    Matches the responses of the Vision API with their blobs, skipping the images that failed.
+
+    Args:
+        responses (Iterable[Tuple[str, vision.AnnotateImageResponse]]): Pairs of image URI and its response.
+        in_flight (dict): Name and generation of the blob of each image URI. Entries are
+            removed as their responses are matched.
+        archive (ResponseArchiveWriter): Archive of the raw responses. None disables the archive.
+        dead_letter (DeadLetterWriter): Receives the images that could not be annotated.
+        cluster_ids (dict): Group of near-duplicates of each image URI, written in the
+            `cluster_id` column. Entries are removed as their responses are matched.
+
+    Yields:
+        Tuple[str, int, str, vision.AnnotateImageResponse, dict]: Name and generation of the
+            blob, URI of the image, its response and the extra columns of its row.
+    """
+    for image_uri, response in responses:
+        blob_name, blob_generation = in_flight.pop(image_uri)
+        extra_columns = {"cluster_id": cluster_ids.pop(image_uri, None)} if cluster_ids is not None else {}
+
+        # Skip the images that failed without losing the rest of the batch
+        if response.error.code:
+            get_metrics().increment("vision_errors", code=response.error.code)
+            print(f"ERROR - {image_uri}: {response.error.message}")
+            if dead_letter is not None:
+                dead_letter.write(image_uri, blob_name, blob_generation, response.error)
+            continue
+
+        if archive is not None:
+            archive.write(image_uri, image_uri, response, extra_columns)
+
+        yield blob_name, blob_generation, image_uri, response, extra_columns
+
+
+def format_responses(responses, in_flight, features, formatter=format_json_fast, archive=None, dead_letter=None, cluster_ids=None, formatter_pool=None) -> Iterator[Tuple[str, int, dict]]:
+    """
+    Formats the responses of the Vision API into rows, skipping the images that failed.
+
+    Args:
+        responses (Iterable[Tuple[str, vision.AnnotateImageResponse]]): Pairs of image URI and its response.
+        in_flight (dict): Name and generation of the blob of each image URI. Entries are
+            removed as their responses are formatted.
+        features (List[str]): A list of feature types to include in the analysis.
+        formatter (Callable): Function formatting a response into a row.
+        archive (ResponseArchiveWriter): Archive of the raw responses. None disables the archive.
+        dead_letter (DeadLetterWriter): Receives the images that could not be annotated.
+        cluster_ids (dict): Group of near-duplicates of each image URI, written in the
+            `cluster_id` column. Entries are removed as their responses are formatted.
+        formatter_pool (FormatterPool): Formats the responses in worker processes instead of
+            the calling thread, replacing `formatter`. The rows may then be NDJSON lines.
+
+    Yields:
+        Tuple[str, int, dict]: Name and generation of the blob, and its formatted row.
+    """
+    annotated = iter_annotated(responses, in_flight, archive, dead_letter, cluster_ids)
+
+    if formatter_pool is not None:
+        yield from formatter_pool.format(annotated)
+        return
+
+    metrics = get_metrics()
+    for blob_name, blob_generation, image_uri, response, extra_columns in annotated:
+        # Format the analysis results
+        with metrics.timer("format"):
+            creative_data = formatter(
+                response=response, 
+                creative_id=image_uri, # We need to change this!
+                creative_uri=image_uri,
+                features=features
+            )
+        creative_data.update(extra_columns)
+
+        yield blob_name, blob_generation, creative_data